@@ -0,0 +1,46 @@
+"""
+Microbenchmark for cleaning usage metrics keys with :func:`_clean_bigquery_keys` (before) vs :class:`KeyPlan` (after)
+
+To run:
+
+    $ python benchmarks/key_plan.py
+"""
+import timeit
+
+from confluent.data.transformers import _clean_bigquery_keys, compile_key_plan
+
+
+RECORD = {"value": "a", "id": "c", "source": "d", "@version": "e",
+          "metric": {"request": "f", "user": "g",
+                     "physicalstatefulcluster.core.confluent.cloud/version": "h",
+                     "statefulset.kubernetes.io/pod-name": "i", "type": "j",
+                     "_deltaSeconds": 60, "job": "l", "pod-name": "m",
+                     "physicalstatefulcluster.core.confluent.cloud/name": "n",
+                     "source": "o", "tenant": "p", "clusterId": "q", "_metricname": "r",
+                     "another": "s", "instance": "t", "pscVersion": "u"},
+          "timestamp": 1234560, "datetime_pt": "1970-01-14 22:56:00", "date_pt": "1970-01-14"}
+
+CASES = {
+    'all fields': (None, None),
+    'exclude fields': (None, {'metric.another'}),
+    'select fields': ({'id', 'metric', 'metric.user', 'metric.type', 'timestamp', '@version'}, None),
+}
+
+
+def records_per_sec(func, number):
+    return number / min(timeit.repeat(func, number=number, repeat=3))
+
+
+def main(number=100000):
+    for name, (select_fields, exclude_fields) in CASES.items():
+        key_plan = compile_key_plan(select_fields, exclude_fields)
+
+        before = records_per_sec(lambda: _clean_bigquery_keys(RECORD, select_fields, exclude_fields), number)
+        after = records_per_sec(lambda: key_plan.clean(RECORD), number)
+
+        print(f'{name:>16}: {before:>12,.0f} records/sec before, {after:>12,.0f} records/sec after '
+              f'({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""
+Benchmark suite for the usage metrics transform and BigQuery admin operations. Results are written as JSON, so they can
+be compared between commits.
+
+Synthetic usage metrics data files shaped like the `mock_data` fixture in `tests/test_transformers.py` are generated
+to measure:
+
+- records/sec per core of :func:`transform_usage_metrics` (parse, transform, serialize, and compress) in-process and
+  of :func:`iter_transform` (transform only) for each engine
+- end-to-end throughput of :meth:`Transformer.transform` for different numbers of processes, with the peak RSS of
+  the parent and worker processes
+
+And :meth:`BigQueryAdmin.copy_dataset` / :meth:`BigQueryAdmin.create_views` are timed for each engine with a fake
+client (see `FakeBigQueryClient` in `tests/fakes.py`) that adds latency to each API call and copy job.
+
+To run and compare:
+
+    $ python benchmarks/suite.py run --output before.json
+    $ git checkout my-branch
+    $ python benchmarks/suite.py run --output after.json
+    $ python benchmarks/suite.py compare before.json after.json
+"""
+import contextlib
+from datetime import datetime
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, 'tests')]
+
+from confluent.data.admins import BigQueryAdmin  # noqa: E402
+from confluent.data.async_admins import AsyncBigQueryAdmin  # noqa: E402
+from confluent.data.transformers import (COLUMNAR_ENGINE, RECORD_ENGINE, Transformer, iter_transform,  # noqa: E402
+                                         numpy, transform_usage_metrics, transform_usage_metrics_chunk)
+from fakes import FakeBigQueryClient  # noqa: E402
+
+
+#: Transform engines that can be benchmarked
+ENGINES = [RECORD_ENGINE] + ([COLUMNAR_ENGINE] if numpy is not None else [])
+
+#: Admin engine name => admin class
+ADMIN_ENGINES = {'sync': BigQueryAdmin, 'async': AsyncBigQueryAdmin}
+
+#: Fields that are excluded by default by `transform usage-metrics`
+EXCLUDE_FIELDS = {'metric.another'}
+
+
+def usage_metrics_record(i, start_time=1552208400):
+    """ Synthetic usage metrics record like the `mock_data` fixture with values that vary by record """
+    return {"value": str(i % 1000), "@timestamp": "b", "id": f"id-{i}", "source": "d", "@version": "e",
+            "metric": {
+                "request": "f", "user": f"user-{i % 97}",
+                "physicalstatefulcluster.core.confluent.cloud/version": "h",
+                "statefulset.kubernetes.io/pod-name": f"pod-{i % 13}", "type": "j",
+                "_deltaSeconds": str(30 + i % 90), "job": "l", "pod-name": "m",
+                "physicalstatefulcluster.core.confluent.cloud/name": "n",
+                "source": "o", "tenant": f"tenant-{i % 31}", "clusterId": "q", "_metricname": "r",
+                "another": "s", "instance": "t", "pscVersion": "u"},
+            "timestamp": start_time + i * 7 + random.random()}
+
+
+def generate_usage_metrics(data_dir, files, records_per_file):
+    """
+    Generate gzipped usage metrics data files
+
+    :return: Paths of the data files
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    paths = []
+
+    for file_index in range(files):
+        path = os.path.join(data_dir, f'usage-metrics-{file_index:04d}.json.gz')
+        with gzip.open(path, 'wb', compresslevel=1) as fp:
+            offset = file_index * records_per_file
+            fp.write(b''.join(json.dumps(usage_metrics_record(offset + i)).encode() + b'\n'
+                              for i in range(records_per_file)))
+        paths.append(path)
+
+    return paths
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """ Peak resident set size in MB of this process or its (terminated) children """
+    max_rss = resource.getrusage(who).ru_maxrss
+    return round(max_rss / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+
+def bench_records_per_core(data_file, records, output_dir):
+    """ Records/sec of transforming a data file in this process for each engine """
+    results = {}
+
+    for engine in ENGINES:
+        output_file = os.path.join(output_dir, f'{engine}.json.gz')
+        start_time = time.perf_counter()
+        transform_usage_metrics(data_file, output_file, exclude_fields=EXCLUDE_FIELDS, engine=engine)
+        file_seconds = time.perf_counter() - start_time
+
+        with gzip.open(data_file) as fp:
+            parsed_records = [json.loads(line) for line in fp]
+        start_time = time.perf_counter()
+        for _ in iter_transform(parsed_records, exclude_fields=EXCLUDE_FIELDS, engine=engine):
+            pass
+        transform_seconds = time.perf_counter() - start_time
+
+        results[engine] = {'file_records_per_sec': round(records / file_seconds),
+                           'transform_records_per_sec': round(records / transform_seconds)}
+
+    return results
+
+
+def _run_transformer(data_dir, sink_dir, processes, results):
+    """ Run :meth:`Transformer.transform` in a child process to measure the peak RSS of one run """
+    transformer = Transformer(transform_usage_metrics, data_dir, sink_dir, select_fields={'-metric.another'},
+                              parallel_processes=processes, chunk_transform=transform_usage_metrics_chunk,
+                              use_manifest=False)
+
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        transformer.transform()
+    wall_seconds = time.perf_counter() - start_time
+
+    results.put({'wall_seconds': wall_seconds, 'parent_peak_rss_mb': peak_rss_mb(),
+                 'worker_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)})
+
+
+def bench_transformer(data_dir, records, processes_list, output_dir):
+    """ End-to-end throughput of :meth:`Transformer.transform` for each number of processes """
+    results = {}
+
+    for processes in processes_list:
+        sink_dir = os.path.join(output_dir, f'transformed-{processes}')
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_run_transformer, args=(data_dir, sink_dir, processes, queue))
+        child.start()
+        result = queue.get()
+        child.join()
+
+        result['records_per_sec'] = round(records / result['wall_seconds'])
+        result['records_per_sec_per_process'] = round(records / result['wall_seconds'] / processes)
+        result['wall_seconds'] = round(result['wall_seconds'], 3)
+        results[str(processes)] = result
+
+    return results
+
+
+def bench_admin(tables, views, latency, job_seconds, concurrent_jobs, batch_size, output_dir, view_specs_file):
+    """ Time copying a dataset and creating views for each admin engine with a fake client """
+    results = {}
+
+    for name, admin_class in ADMIN_ENGINES.items():
+        client = FakeBigQueryClient(latency=latency, job_seconds=job_seconds)
+        for i in range(tables):
+            client.add_table('project-1', 'dataset', f'table{i}')
+        for i in range(views):
+            client.add_table('project-1', 'dataset', f'view{i}',
+                             view_query=f'SELECT * FROM `project-1.dataset.table{i % max(tables, 1)}`')
+
+        # Poll jobs as often as they take, so timings are not floored by the default poll interval of 1s
+        admin = admin_class(client, poll_interval=min(job_seconds, 1))
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            admin.copy_dataset('project-1.dataset', 'project-2', max_concurrent_jobs=concurrent_jobs,
+                               checkpoint_file=os.path.join(output_dir, f'{name}.checkpoint'), batch_size=batch_size)
+        copy_seconds = time.perf_counter() - start_time
+        copy_calls = sum(client.api_calls.values())
+
+        client.api_calls.clear()
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            admin.create_views(view_specs_file)
+        create_views_seconds = time.perf_counter() - start_time
+
+        results[name] = {'copy_dataset_seconds': round(copy_seconds, 3), 'copy_dataset_api_calls': copy_calls,
+                         'create_views_seconds': round(create_views_seconds, 3),
+                         'create_views_api_calls': sum(client.api_calls.values()),
+                         'peak_running_jobs': client.peak_running_jobs}
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def _flatten(results, prefix=''):
+    """ Flatten nested results into dotted keys => numbers """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(help='Run the benchmarks and write the results as JSON')
+@click.option('--files', default=8, type=click.IntRange(1), show_default=True,
+              help='Number of synthetic data files to generate')
+@click.option('--records-per-file', default=20000, type=click.IntRange(1), show_default=True,
+              help='Number of records per data file')
+@click.option('--processes', default=f'1,2,{multiprocessing.cpu_count()}', show_default=True,
+              help='Comma separated list of process counts to run the Transformer with')
+@click.option('--tables', default=40, type=click.IntRange(0), show_default=True,
+              help='Number of tables in the dataset to copy')
+@click.option('--views', default=10, type=click.IntRange(0), show_default=True,
+              help='Number of views in the dataset to copy')
+@click.option('--latency', default=0.05, type=float, show_default=True,
+              help='Seconds that each fake API call takes')
+@click.option('--job-seconds', default=0.5, type=float, show_default=True,
+              help='Seconds that each fake copy job takes')
+@click.option('--concurrent-jobs', default=10, type=click.IntRange(1), show_default=True,
+              help='Maximum number of copy jobs to run at the same time')
+@click.option('--batch-size', default=1, type=click.IntRange(1), show_default=True,
+              help='Number of tables to copy per job')
+@click.option('--skip-admin', is_flag=True, help='Skip the admin benchmarks')
+@click.option('--output', default='benchmark-results.json', show_default=True, help='File to write results to')
+def run(files, records_per_file, processes, tables, views, latency, job_seconds, concurrent_jobs, batch_size,
+        skip_admin, output):
+    processes_list = sorted(set(int(p) for p in processes.split(',')))
+    records = files * records_per_file
+    random.seed(0)
+
+    results = {'meta': {'commit': _git_commit(), 'time': datetime.now().isoformat(timespec='seconds'),
+                        'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': multiprocessing.cpu_count(), 'files': files,
+                        'records_per_file': records_per_file}}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = os.path.join(temp_dir, 'data')
+        print(f'Generating {files} data file(s) with {records_per_file:,} records each')
+        data_files = generate_usage_metrics(data_dir, files, records_per_file)
+
+        print('Benchmarking records/sec per core')
+        results['records_per_core'] = bench_records_per_core(data_files[0], records_per_file, temp_dir)
+
+        print('Benchmarking Transformer.transform with', ', '.join(map(str, processes_list)), 'process(es)')
+        results['transformer'] = bench_transformer(data_dir, records, processes_list, temp_dir)
+
+        if not skip_admin:
+            print(f'Benchmarking admin operations with {tables} table(s) and {views} view(s)')
+            view_specs_file = os.path.join(temp_dir, 'view-specs.json')
+            with open(view_specs_file, 'w') as fp:
+                json.dump({'latest-record': {'project-2': {'dataset': {'ids': ['id'], 'datetime': 'loaded_at'}}}},
+                          fp)
+            results['admin'] = dict(bench_admin(tables, views, latency, job_seconds, concurrent_jobs, batch_size,
+                                                temp_dir, view_specs_file),
+                                    settings={'latency': latency, 'job_seconds': job_seconds,
+                                              'concurrent_jobs': concurrent_jobs, 'batch_size': batch_size})
+
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+    print(json.dumps({key: value for key, value in results.items() if key != 'meta'}, indent=2))
+    print('Wrote results to', output)
+
+
+@cli.command(help='Compare the numbers of two result files')
+@click.argument('before_file')
+@click.argument('after_file')
+def compare(before_file, after_file):
+    with open(before_file) as fp:
+        before = _flatten({key: value for key, value in json.load(fp).items() if key != 'meta'})
+    with open(after_file) as fp:
+        after = _flatten({key: value for key, value in json.load(fp).items() if key != 'meta'})
+
+    for key in sorted(set(before) | set(after)):
+        if key in before and key in after:
+            change = f'{after[key] / before[key]:.2f}x' if before[key] else ''
+            print(f'{key:<60} {before[key]:>14,} {after[key]:>14,} {change:>8}')
+        else:
+            print(f'{key:<60} {before.get(key, "-"):>14} {after.get(key, "-"):>14}')
+
+
+if __name__ == '__main__':
+    cli()
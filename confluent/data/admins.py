@@ -1,9 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import fnmatch
 import re
+import time
 
 from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
 
+from confluent.data.checkpoints import CopyCheckpoint
 from confluent.data.specs import parse_view_specs
+from confluent.data.views import ViewGraph, rewrite_table_references
+
+
+#: Default number of copy jobs to run at the same time
+DEFAULT_CONCURRENT_JOBS = 10
 
 
 class AlreadyExistsError(Exception):
@@ -17,17 +26,27 @@ class UnsupportedError(Exception):
 class BigQueryAdmin:
     """ Manages BigQuery projects, datasets, etc """
 
-    def __init__(self, client=None):
+    def __init__(self, client=None, poll_interval=1):
+        """
+        :param google.cloud.bigquery.Client client: Client to make API calls with. Defaults to one for the environment.
+        :param float poll_interval: Seconds to wait between polling running copy jobs
+        """
         self.client = client or bigquery.Client()
+        self.poll_interval = poll_interval
 
-    def move_dataset(self, from_dataset, to_project_or_dataset):
+    def move_dataset(self, from_dataset, to_project_or_dataset, max_concurrent_jobs=DEFAULT_CONCURRENT_JOBS,
+                     resume=False, batch_size=1):
         """
         Moves a dataset from a project to another
 
         :param str from_dataset: Fully qualified dataset name (project.dataset) to move from
         :param str to_project_or_dataset: Project or fully qualified dataset name (project.dataset) to move to.
+        :param int max_concurrent_jobs: Maximum number of copy jobs to run at the same time
+        :param bool resume: Resume an interrupted move from its checkpoint. See :meth:`copy_dataset`
+        :param int batch_size: Number of tables to copy per job. See :meth:`copy_dataset`
         """
-        self.copy_dataset(from_dataset, to_project_or_dataset)
+        self.copy_dataset(from_dataset, to_project_or_dataset, max_concurrent_jobs=max_concurrent_jobs, resume=resume,
+                          batch_size=batch_size)
         self._delete_dataset(from_dataset)
 
     def create_views(self, view_specs_json_file):
@@ -37,96 +56,434 @@ class BigQueryAdmin:
         :param str view_specs_json_file: Path to JSON file with view specs
         """
         view_specs = parse_view_specs(view_specs_json_file)
+        metadata = self._metadata_cache()
+
+        def needs_table(table_item, table_ids):
+            """ True if a view will be created for the table, which is fetched for its schema """
+            table_id = table_item.reference.table_id
+            return (table_item.table_type in ('TABLE', None) and not table_id.startswith('_')
+                    and table_id + '_view' not in table_ids)
+
+        dataset_refs = [self.client.dataset(dataset_id=view_spec.dataset, project=view_spec.project)
+                        for view_spec in view_specs]
+        self._prefetch_metadata(metadata, dataset_refs, get_table=needs_table)
 
-        for view_spec in view_specs:
-            dataset_ref = self.client.dataset(dataset_id=view_spec.dataset, project=view_spec.project)
+        table_views = []
+
+        for view_spec, dataset_ref in zip(view_specs, dataset_refs):
             print(f'Creating views for {view_spec.project}.{view_spec.dataset}')
 
-            for table_item in self.client.list_tables(dataset=dataset_ref):
+            for table_item in metadata.list_tables(dataset_ref):
                 table_ref = table_item.reference
 
-                table = self.client.get_table(table_ref)
-                if table.table_type == 'TABLE' and not table.table_id.startswith('_'):
-                    table_view_ref = dataset_ref.table(table_ref.table_id + '_view')
-                    try:
-                        self.client.get_table(table_view_ref)
-                        print(f'  - {table_view_ref.table_id} (already exists)')
+                if metadata.table_type(table_ref) == 'TABLE' and not table_ref.table_id.startswith('_'):
+                    table_view_id = table_ref.table_id + '_view'
+                    if metadata.table_exists(dataset_ref, table_view_id):
+                        print(f'  - {table_view_id} (already exists)')
                         continue
-                    except NotFound:
-                        pass
 
-                    print(f'  - {table_view_ref.table_id}')
+                    print(f'  - {table_view_id}')
+
+                    table = metadata.get_table(table_ref)
+                    table_views.append(self._table_view(view_spec, dataset_ref, table, table_view_id))
 
-                    fields = [f.name for f in table.schema]
-                    table_view = bigquery.Table(table_view_ref)
-                    table_view.view_query = view_spec.sql(table.table_id, fields)
-                    self.client.create_table(table_view)
+        self._create_tables(table_views)
 
-    def copy_dataset(self, from_dataset, to_project_or_dataset, error_on_unsupported=True):
+        metadata.report()
+
+    def copy_dataset(self, from_dataset, to_project_or_dataset, error_on_unsupported=True,
+                     max_concurrent_jobs=DEFAULT_CONCURRENT_JOBS, resume=False, checkpoint_file=None, batch_size=1):
         """
-        Copies a dataset from a project to another
+        Copies a dataset from a project to another. Tables are copied by concurrent copy jobs and their number of rows
+        are verified in bulk once all jobs are done.
+
+        The state of each table is recorded in a local checkpoint file (see
+        :class:`confluent.data.checkpoints.CopyCheckpoint`) that is removed once the copy is complete. If the copy is
+        interrupted, it can be resumed from the checkpoint, which skips tables that were verified/views that were
+        created and reattaches to copy jobs that were started.
 
         :param str from_dataset: Fully qualified dataset name (project.dataset) to move from
         :param str to_project_or_dataset: Project or fully qualified dataset name (project.dataset) to move to.
         :param bool error_on_unsupported: Raise an error for unsupported tables (e.g. external)
+        :param int max_concurrent_jobs: Maximum number of copy jobs to run at the same time
+        :param bool resume: Resume an interrupted copy from its checkpoint
+        :param str|None checkpoint_file: Path to the checkpoint file. Defaults to one named after the datasets in the
+                                         current directory.
+        :param int batch_size: Number of tables to copy per job. Batches of more than one table are copied by a
+                               script with a `CREATE TABLE ... COPY` statement per table, which lowers the overhead
+                               and quota used per table when there are many small tables.
         :raises AlreadyExistsError: If the destination dataset already exist
         """
         source_dataset_ref = self._to_dataset_ref(from_dataset)
         target_dataset_ref = self._to_dataset_ref(self._to_fqdn(to_project_or_dataset, source_dataset_ref.dataset_id))
+        metadata = self._metadata_cache()
+        scheduler = CopyJobScheduler(self.client, max_concurrent_jobs=max_concurrent_jobs,
+                                     poll_interval=self.poll_interval)
+
+        self._prefetch_metadata(metadata, [source_dataset_ref], get_table=self._needs_source_table)
+
+        dataset_copy = self._start_dataset_copy(source_dataset_ref, target_dataset_ref, metadata, scheduler,
+                                                error_on_unsupported=error_on_unsupported, resume=resume,
+                                                checkpoint_file=checkpoint_file, batch_size=batch_size)
+        self._finish_dataset_copies([dataset_copy], metadata, scheduler, resume=resume)
+
+        metadata.report()
+
+    def copy_project(self, from_project, to_project, dataset_pattern='*', error_on_unsupported=True,
+                     max_concurrent_jobs=DEFAULT_CONCURRENT_JOBS, resume=False, batch_size=1):
+        """
+        Copies all datasets (or those that match the pattern) from a project to another. Table copies for all
+        datasets are planned up front and run by one shared job scheduler, and views are created last once all tables
+        are copied. Throughput per dataset and overall is reported at the end.
+
+        Each dataset has its own checkpoint like :meth:`copy_dataset`.
+
+        :param str from_project: Project to copy datasets from
+        :param str to_project: Project to copy datasets to. Datasets keep the same name.
+        :param str dataset_pattern: Only copy datasets whose name matches this glob pattern
+        :param bool error_on_unsupported: Raise an error for unsupported tables (e.g. external)
+        :param int max_concurrent_jobs: Maximum number of copy jobs to run at the same time across all datasets
+        :param bool resume: Resume an interrupted copy from the checkpoints
+        :param int batch_size: Number of tables to copy per job. See :meth:`copy_dataset`
+        :raises ValueError: If the projects are the same or no datasets match the pattern
+        """
+        if from_project == to_project:
+            raise ValueError('Can not copy datasets to the same project')
+
+        metadata = self._metadata_cache()
+        scheduler = CopyJobScheduler(self.client, max_concurrent_jobs=max_concurrent_jobs,
+                                     poll_interval=self.poll_interval)
+
+        dataset_ids = sorted(dataset_item.dataset_id for dataset_item in metadata.list_datasets(from_project)
+                             if fnmatch.fnmatchcase(dataset_item.dataset_id, dataset_pattern))
+        if not dataset_ids:
+            raise ValueError(f'No datasets in project {from_project} matches {dataset_pattern}')
+
+        self._prefetch_metadata(metadata, [self.client.dataset(dataset_id, project=from_project)
+                                           for dataset_id in dataset_ids], get_table=self._needs_source_table)
+
+        started = time.time()
+        dataset_copies = []
+
+        for dataset_id in dataset_ids:
+            print(f'{from_project}.{dataset_id}')
+            dataset_copies.append(self._start_dataset_copy(self.client.dataset(dataset_id, project=from_project),
+                                                           self.client.dataset(dataset_id, project=to_project),
+                                                           metadata, scheduler,
+                                                           error_on_unsupported=error_on_unsupported, resume=resume,
+                                                           batch_size=batch_size, prefix_tables=True))
+
+        self._finish_dataset_copies(dataset_copies, metadata, scheduler, resume=resume)
+
+        self._report_throughput(dataset_copies, time.time() - started)
+        metadata.report()
+
+    def _metadata_cache(self):
+        """ :return: Metadata cache for a run """
+        return MetadataCache(self.client)
+
+    def _prefetch_metadata(self, metadata, dataset_refs, get_table=None):
+        """
+        Hook to fetch the listings of the datasets and the tables that will be needed into the metadata cache up front,
+        e.g. all at the same time. Metadata is fetched when it is needed by default.
+
+        :param MetadataCache metadata: Metadata cache to fetch into
+        :param list dataset_refs: Datasets to list tables for
+        :param callable get_table: Called with each table list item and the set of table IDs in its dataset once the
+                                   datasets are listed to return True if the table should be fetched
+        """
+
+    def _create_tables(self, tables):
+        """
+        Hook to create the tables/views, e.g. all at the same time. They are created one by one by default.
+
+        :param list[google.cloud.bigquery.table.Table] tables: Tables/views to create
+        """
+        for table in tables:
+            self.client.create_table(table)
+
+    @staticmethod
+    def _needs_source_table(table_item, table_ids):
+        """ True if the source table will be fetched to copy it, i.e. views and tables whose type is not listed """
+        return table_item.table_type in ('VIEW', None)
+
+    def _start_dataset_copy(self, source_dataset_ref, target_dataset_ref, metadata, scheduler,
+                            error_on_unsupported=True, resume=False, checkpoint_file=None, batch_size=1,
+                            prefix_tables=False):
+        """
+        Create the target dataset and submit copy jobs for the tables in the source dataset to the scheduler.
+        See :meth:`copy_dataset` for the params.
+
+        :param bool prefix_tables: Print tables as dataset.table, e.g. when copying many datasets
+
+        :rtype: DatasetCopy
+        """
+        checkpoint = CopyCheckpoint(f'{source_dataset_ref.project}.{source_dataset_ref.dataset_id}',
+                                    f'{target_dataset_ref.project}.{target_dataset_ref.dataset_id}',
+                                    path=checkpoint_file)
+        if resume:
+            checkpoint.load()
+            print(f'Resuming from checkpoint {checkpoint.path}')
 
         # Create destination dataset
-        self.client.create_dataset(target_dataset_ref)
+        self.client.create_dataset(target_dataset_ref, exists_ok=resume)
 
-        table_views = []
-        skipped_tables = []
+        dataset_copy = DatasetCopy(source_dataset_ref, target_dataset_ref, checkpoint, prefix_tables=prefix_tables)
+
+        # Job info from checkpoint => job that was reattached or None if it can not be reattached
+        reattached_jobs = {}
+
+        # Job ID => (job, list of (source_table_ref, target_table_ref)) for tables copied by reattached jobs
+        attached_tables = {}
+
+        # List of (source_table_ref, target_table_ref) for tables to copy
+        tables_to_copy = []
 
         # Copy tables
-        for source_table_item in self.client.list_tables(dataset=source_dataset_ref):
+        for source_table_item in metadata.list_tables(source_dataset_ref):
             source_table_ref = source_table_item.reference
             target_table_ref = target_dataset_ref.table(source_table_ref.table_id)
 
-            source_table = self.client.get_table(source_table_ref)
+            table_type = metadata.table_type(source_table_ref)
 
-            if source_table.table_type == 'TABLE':
-                print(f'  - {source_table_ref.table_id}')
-                job = self.client.copy_table(source_table_ref, target_table_ref)
-                job.result()
-                assert job.state == 'DONE'
+            if table_type == 'TABLE':
+                table_id = source_table_ref.table_id
+                table_state = checkpoint.state(table_id)
+
+                if table_state == CopyCheckpoint.VERIFIED:
+                    print(f'  - {dataset_copy.table_name(table_id)} (already copied)')
+                    continue
+
+                print(f'  - {dataset_copy.table_name(table_id)}')
+
+                job = None
+                if table_state == CopyCheckpoint.COPYING:
+                    job_info = checkpoint.job(table_id)
+                    if job_info not in reattached_jobs:  # Batched tables share the same job
+                        reattached_jobs[job_info] = self._reattach_job(job_info)
+                    job = reattached_jobs[job_info]
+
+                if job:
+                    print(f'    Reattached to copy job {job.job_id}')
+                    attached_tables.setdefault(job.job_id, (job, []))[1].append((source_table_ref, target_table_ref))
+                else:
+                    tables_to_copy.append((source_table_ref, target_table_ref))
 
-                target_table = self.client.get_table(target_table_ref)
-                source_table = self.client.get_table(source_table_ref)
-                assert target_table.num_rows == source_table.num_rows, \
-                    'Number of rows does not match'
+                dataset_copy.copying_tables.append(table_id)
 
-            elif source_table.table_type == 'VIEW':
-                table_views.append((source_table, source_table_ref, target_table_ref))
+            elif table_type == 'VIEW':
+                dataset_copy.table_views.append((metadata.get_table(source_table_ref), source_table_ref,
+                                                 target_table_ref))
 
             else:
-                print(f'  - {source_table_ref.table_id}')
+                print(f'  - {dataset_copy.table_name(source_table_ref.table_id)}')
                 if error_on_unsupported:
-                    raise UnsupportedError(f'Table type {source_table.table_type} is not supported for '
+                    raise UnsupportedError(f'Table type {table_type} is not supported for '
                                            f'table {source_table_ref.table_id}')
                 else:
-                    print(f'    Skipped due to unsupported table type: {source_table.table_type}')
-                    skipped_tables.append(source_table_ref.table_id)
-
-        for source_table, source_table_ref, target_table_ref in table_views:
-            print(f'  - {source_table_ref.table_id} (view)')
-            if any(table in source_table.view_query for table in skipped_tables):
-                print('    Skipped as view is for an unsupported table that was not copied')
-                skipped_tables.append(source_table_ref.table_id)
-                continue
-
-            target_view = bigquery.Table(target_table_ref)
-            target_view.view_use_legacy_sql = source_table.view_use_legacy_sql
-            target_view.view_query = source_table.view_query.replace(
-                f'{source_dataset_ref.project}.{source_dataset_ref.dataset_id}',
-                f'{target_dataset_ref.project}.{target_dataset_ref.dataset_id}')
-            self.client.create_table(target_view)
-
-        assert len(list(self.client.list_tables(dataset=source_dataset_ref))) == \
-            (len(list(self.client.list_tables(dataset=target_dataset_ref))) + len(skipped_tables)), \
-            'Number of tables does not match'
+                    print(f'    Skipped due to unsupported table type: {table_type}')
+                    dataset_copy.skipped_tables.append(source_table_ref.table_id)
+
+        for job, table_refs in attached_tables.values():
+            scheduler.attach_batch(job, table_refs, on_done=dataset_copy.table_copied)
+
+        for i in range(0, len(tables_to_copy), batch_size):
+            table_refs = tables_to_copy[i:i + batch_size]
+            job = scheduler.submit_batch(table_refs, on_done=dataset_copy.table_copied, replace=resume)
+            for source_table_ref, _ in table_refs:
+                checkpoint.set(source_table_ref.table_id, CopyCheckpoint.COPYING, job=job)
+
+        return dataset_copy
+
+    def _finish_dataset_copies(self, dataset_copies, metadata, scheduler, resume=False):
+        """
+        Wait for the copy jobs to complete, verify the copied tables, and then create the views in dependency order
+
+        :param list[DatasetCopy] dataset_copies: Dataset copies that were started
+        """
+        scheduler.wait()
+
+        for dataset_copy in dataset_copies:
+            self._verify_copied_tables(dataset_copy)
+            for table_id in dataset_copy.copying_tables:
+                dataset_copy.checkpoint.set(table_id, CopyCheckpoint.VERIFIED)
+
+        # Views reference the copied tables/views in any of the target datasets
+        datasets = {(d.source_dataset_ref.project, d.source_dataset_ref.dataset_id):
+                    (d.target_dataset_ref.project, d.target_dataset_ref.dataset_id) for d in dataset_copies}
+
+        with ThreadPoolExecutor(max_workers=scheduler.max_concurrent_jobs) as executor:
+            for level in self._plan_view_levels(dataset_copies):
+                view_creations = {executor.submit(self._create_target_view, dataset_copy, table_view, datasets,
+                                                  resume=resume):
+                                  (dataset_copy, table_view) for dataset_copy, table_view in level}
+                for view_creation in as_completed(view_creations):
+                    view_creation.result()  # Raises the error if the view could not be created
+                    dataset_copy, (_, source_table_ref, _) = view_creations[view_creation]
+                    dataset_copy.checkpoint.set(source_table_ref.table_id, CopyCheckpoint.VIEW_CREATED)
+
+        for dataset_copy in dataset_copies:
+            target_tables = metadata.list_tables(dataset_copy.target_dataset_ref, refresh=True)
+            assert len(metadata.list_tables(dataset_copy.source_dataset_ref)) == \
+                len(target_tables) + len(dataset_copy.skipped_tables), \
+                f'Number of tables does not match for dataset {dataset_copy.name}'
+
+            dataset_copy.checkpoint.remove()
+
+    def _plan_view_levels(self, dataset_copies):
+        """
+        Plan the creation of views from all dataset copies in levels based on the tables/views they reference (see
+        :class:`confluent.data.views.ViewGraph`), so views in a level can be created at the same time after the views
+        in prior levels. Views that reference tables/views that were skipped are also skipped.
+
+        :param list[DatasetCopy] dataset_copies: Dataset copies with views to create
+        :return: List of levels with a list of (dataset_copy, (source_table, source_table_ref, target_table_ref)) for
+                 views to create in each level
+        """
+        view_graph = ViewGraph()
+        views = {}
+        skipped_tables = set()
+
+        for dataset_copy in dataset_copies:
+            dataset_key = (dataset_copy.source_dataset_ref.project, dataset_copy.source_dataset_ref.dataset_id)
+            skipped_tables.update(dataset_key + (table_id,) for table_id in dataset_copy.skipped_tables)
+
+            for table_view in dataset_copy.table_views:
+                source_table, source_table_ref, _ = table_view
+                view_key = dataset_key + (source_table_ref.table_id,)
+                view_graph.add(view_key, source_table.view_query)
+                views[view_key] = (dataset_copy, table_view)
+
+        skipped_views = view_graph.skipped(skipped_tables)
+        levels = []
+
+        for view_keys in view_graph.levels():
+            level = []
+
+            for view_key in view_keys:
+                dataset_copy, (_, source_table_ref, _) = views[view_key]
+
+                if dataset_copy.checkpoint.state(source_table_ref.table_id) == CopyCheckpoint.VIEW_CREATED:
+                    print(f'  - {dataset_copy.table_name(source_table_ref.table_id)} (view already created)')
+                    continue
+
+                print(f'  - {dataset_copy.table_name(source_table_ref.table_id)} (view)')
+                if view_key in skipped_views:
+                    print('    Skipped as view references an unsupported table that was not copied')
+                    dataset_copy.skipped_tables.append(source_table_ref.table_id)
+                    continue
+
+                level.append(views[view_key])
+
+            levels.append(level)
+
+        return levels
+
+    def _create_target_view(self, dataset_copy, table_view, datasets, resume=False):
+        """
+        Create the view in the target dataset for the (source_table, source_table_ref, target_table_ref)
+
+        :param dict datasets: (project, dataset) of source datasets => (project, dataset) of the target datasets that
+                              they are copied to. See :meth:`_target_view`.
+        """
+        source_table, _, target_table_ref = table_view
+        target_view = self._target_view(source_table, dataset_copy.source_dataset_ref, datasets, target_table_ref)
+        self.client.create_table(target_view, exists_ok=resume)
+
+    def _report_throughput(self, dataset_copies, elapsed):
+        """ Print the number of tables/bytes copied per minute for each dataset and overall """
+        def throughput(tables, num_bytes, seconds):
+            minutes = max(seconds, 1) / 60
+            return (f'{tables} table(s) and {num_bytes / 1024 / 1024:,.1f} MB in {seconds:,.1f}s '
+                    f'({tables / minutes:,.1f} tables/min, {num_bytes / 1024 / 1024 / minutes:,.1f} MB/min)')
+
+        print('Throughput:')
+        for dataset_copy in dataset_copies:
+            dataset_throughput = throughput(len(dataset_copy.copying_tables), dataset_copy.bytes_copied,
+                                            dataset_copy.elapsed)
+            print(f'  - {dataset_copy.name}: {dataset_throughput}')
+
+        overall_throughput = throughput(sum(len(d.copying_tables) for d in dataset_copies),
+                                        sum(d.bytes_copied for d in dataset_copies), elapsed)
+        print(f'  - Overall: {overall_throughput}')
+
+    def _table_view(self, view_spec, dataset_ref, table, table_view_id):
+        """ Create a view object for the given table based on the view spec """
+        fields = [f.name for f in table.schema]
+        table_view = bigquery.Table(dataset_ref.table(table_view_id))
+        table_view.view_query = view_spec.sql(table.table_id, fields)
+        return table_view
+
+    def _target_view(self, source_table, source_dataset_ref, datasets, target_table_ref):
+        """
+        Create a view object for the target dataset that is a copy of the source view, with references to tables in
+        the datasets that are copied (`project.dataset.table` or legacy `[project:dataset.table]`) pointed at their
+        target datasets. See :func:`confluent.data.views.rewrite_table_references`.
+
+        :param dict datasets: (project, dataset) of source datasets => (project, dataset) of their target datasets
+        """
+        target_view = bigquery.Table(target_table_ref)
+        target_view.view_use_legacy_sql = source_table.view_use_legacy_sql
+        target_view.view_query = rewrite_table_references(source_table.view_query,
+                                                          default_project=source_dataset_ref.project,
+                                                          datasets=datasets, target_project=target_table_ref.project)
+        return target_view
+
+    def _reattach_job(self, job_info):
+        """
+        Get the copy job from a checkpoint to reattach to
+
+        :param tuple|None job_info: Tuple of (job ID, project, location) from the checkpoint
+        :return: The copy job if it is running or done without error, otherwise None to copy again.
+        """
+        if not job_info:
+            return None
+
+        job_id, project, location = job_info
+        try:
+            job = self.client.get_job(job_id, project=project, location=location)
+        except NotFound:
+            return None
+
+        if job.state == 'DONE' and job.error_result:
+            return None
+
+        return job
+
+    def _verify_copied_tables(self, dataset_copy):
+        """
+        Verify the number of rows of the copied tables match between the source and target datasets, and record the
+        number of bytes copied
+        """
+        if not dataset_copy.copying_tables:
+            return
+
+        source_table_stats = self._table_stats(dataset_copy.source_dataset_ref)
+        self._check_row_counts(source_table_stats, self._table_stats(dataset_copy.target_dataset_ref),
+                               dataset_copy.copying_tables)
+        dataset_copy.bytes_copied = sum(getattr(source_table_stats.get(table_id), 'size_bytes', 0)
+                                        for table_id in dataset_copy.copying_tables)
+
+    @staticmethod
+    def _check_row_counts(source_table_stats, target_table_stats, table_ids):
+        """ Assert the number of rows of the given tables match between the source and target table stats """
+        for table_id in table_ids:
+            assert getattr(target_table_stats.get(table_id), 'row_count', None) == \
+                getattr(source_table_stats.get(table_id), 'row_count', None), \
+                f'Number of rows does not match for table {table_id}'
+
+    def _table_stats(self, dataset_ref):
+        """
+        Stats for all tables in the given dataset using a single query on the __TABLES__ meta table
+
+        :return: Dict of table ID => row with row_count and size_bytes
+        """
+        return {row.table_id: row for row in self.client.query(self._table_stats_query(dataset_ref)).result()}
+
+    @staticmethod
+    def _table_stats_query(dataset_ref):
+        return (f'SELECT table_id, row_count, size_bytes '
+                f'FROM `{dataset_ref.project}.{dataset_ref.dataset_id}.__TABLES__`')
 
     def _to_dataset_ref(self, fqdn):
         """
@@ -155,3 +512,287 @@ class BigQueryAdmin:
         """ Delete the given dataset """
         dataset_ref = self._to_dataset_ref(dataset)
         self.client.delete_dataset(dataset_ref, delete_contents=True, not_found_ok=True)
+
+
+class DatasetCopy:
+    """ State of a dataset copy that was started by :meth:`BigQueryAdmin._start_dataset_copy` """
+
+    def __init__(self, source_dataset_ref, target_dataset_ref, checkpoint, prefix_tables=False):
+        """
+        :param google.cloud.bigquery.dataset.DatasetReference source_dataset_ref: Dataset to copy from
+        :param google.cloud.bigquery.dataset.DatasetReference target_dataset_ref: Dataset to copy to
+        :param CopyCheckpoint checkpoint: Checkpoint for the copy
+        :param bool prefix_tables: Prefix the names of tables with the dataset in :meth:`table_name`
+        """
+        self.source_dataset_ref = source_dataset_ref
+        self.target_dataset_ref = target_dataset_ref
+        self.checkpoint = checkpoint
+        self.prefix_tables = prefix_tables
+
+        #: IDs of tables that are being copied by copy jobs
+        self.copying_tables = []
+
+        #: List of (source_table, source_table_ref, target_table_ref) for views to create once tables are copied
+        self.table_views = []
+
+        #: IDs of tables that were skipped as they are not supported
+        self.skipped_tables = []
+
+        #: Number of bytes copied based on the size of the source tables
+        self.bytes_copied = 0
+
+        #: Time when the copy started and when the last table was copied
+        self.started = self.finished = time.time()
+
+    @property
+    def name(self):
+        """ Fully qualified name of the source dataset """
+        return f'{self.source_dataset_ref.project}.{self.source_dataset_ref.dataset_id}'
+
+    @property
+    def elapsed(self):
+        """ Seconds it took to copy the tables """
+        return self.finished - self.started
+
+    def table_name(self, table_id):
+        """ Name of the table to print, which is prefixed with the dataset if :attr:`prefix_tables` is set """
+        return f'{self.source_dataset_ref.dataset_id}.{table_id}' if self.prefix_tables else table_id
+
+    def table_copied(self, source_table_ref, target_table_ref):
+        """ Callback for when a table was copied """
+        self.finished = time.time()
+
+
+class MetadataCache:
+    """
+    Per-run cache of dataset listings and tables to avoid redundant API calls. Table types and existence of tables are
+    looked up from dataset listings instead of getting each table.
+    """
+
+    def __init__(self, client):
+        """
+        :param google.cloud.bigquery.Client client: Client to get metadata with
+        """
+        self.client = client
+
+        #: Number of API calls made
+        self.api_calls = 0
+
+        #: Number of API calls saved by using cached metadata
+        self.saved_calls = 0
+
+        #: Project => list of dataset list items
+        self._dataset_listings = {}
+
+        #: Dataset key => list of table list items
+        self._listings = {}
+
+        #: Dataset key => set of table IDs in the dataset
+        self._table_ids = {}
+
+        #: Table key => table list item from dataset listings
+        self._listed_tables = {}
+
+        #: Table key => table
+        self._tables = {}
+
+    def list_datasets(self, project):
+        """
+        :param str project: Project to list datasets for
+        :return: List of :class:`google.cloud.bigquery.dataset.DatasetListItem` for the project
+        """
+        if project in self._dataset_listings:
+            self.saved_calls += 1
+
+        else:
+            self.api_calls += 1
+            self._dataset_listings[project] = list(self.client.list_datasets(project=project))
+
+        return self._dataset_listings[project]
+
+    def list_tables(self, dataset_ref, refresh=False):
+        """
+        :param google.cloud.bigquery.dataset.DatasetReference dataset_ref: Dataset to list tables for
+        :param bool refresh: Refresh the listing from the API, e.g. after tables were created in the dataset
+        :return: List of :class:`google.cloud.bigquery.table.TableListItem` for the dataset
+        """
+        dataset_key = (dataset_ref.project, dataset_ref.dataset_id)
+
+        if dataset_key in self._listings and not refresh:
+            self.saved_calls += 1
+
+        else:
+            self.api_calls += 1
+            self._cache_listing(dataset_key, list(self.client.list_tables(dataset=dataset_ref)))
+
+        return self._listings[dataset_key]
+
+    def get_table(self, table_ref):
+        """
+        :param google.cloud.bigquery.table.TableReference table_ref: Table to get
+        :rtype: google.cloud.bigquery.table.Table
+        """
+        table_key = self._table_key(table_ref)
+
+        if table_key in self._tables:
+            self.saved_calls += 1
+
+        else:
+            self.api_calls += 1
+            self._tables[table_key] = self.client.get_table(table_ref)
+
+        return self._tables[table_key]
+
+    def table_type(self, table_ref):
+        """
+        :param google.cloud.bigquery.table.TableReference table_ref: Table to get the type for
+        :return: Table type (e.g. TABLE or VIEW) from the dataset listing if it was listed, otherwise from the table.
+        """
+        table_item = self._listed_tables.get(self._table_key(table_ref))
+
+        if table_item is not None and table_item.table_type:
+            self.saved_calls += 1
+            return table_item.table_type
+
+        return self.get_table(table_ref).table_type
+
+    def table_exists(self, dataset_ref, table_id):
+        """
+        :param google.cloud.bigquery.dataset.DatasetReference dataset_ref: Dataset of the table
+        :param str table_id: ID of the table to check
+        :return: True if the table exists based on the dataset listing
+        """
+        dataset_key = (dataset_ref.project, dataset_ref.dataset_id)
+        if dataset_key not in self._table_ids:
+            self.list_tables(dataset_ref)
+
+        self.saved_calls += 1  # Instead of getting the table to see if it exists
+        return table_id in self._table_ids[dataset_key]
+
+    def report(self):
+        """ Print the number of API calls made and saved """
+        print(f'Made {self.api_calls} metadata API call(s) and saved {self.saved_calls} using cached metadata')
+
+    def _cache_listing(self, dataset_key, listing):
+        """ Cache the list of table list items for the dataset key """
+        self._listings[dataset_key] = listing
+        self._table_ids[dataset_key] = set()
+        for table_item in listing:
+            self._table_ids[dataset_key].add(table_item.reference.table_id)
+            self._listed_tables[self._table_key(table_item.reference)] = table_item
+
+    @staticmethod
+    def _table_key(table_ref):
+        return table_ref.project, table_ref.dataset_id, table_ref.table_id
+
+
+class CopyJobScheduler:
+    """
+    Runs table copy jobs concurrently while limiting the number of jobs that are running at the same time. Tables can
+    also be copied in batches by a single job that runs a script with a `CREATE TABLE ... COPY` statement per table.
+    """
+
+    def __init__(self, client, max_concurrent_jobs=DEFAULT_CONCURRENT_JOBS, poll_interval=1):
+        """
+        :param google.cloud.bigquery.Client client: Client to start copy jobs with
+        :param int max_concurrent_jobs: Maximum number of copy jobs to run at the same time
+        :param float poll_interval: Seconds to wait between polling running jobs when none of them are done
+        """
+        self.client = client
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.poll_interval = poll_interval
+
+        #: List of (job, [(source_table_ref, target_table_ref)], on_done) for running jobs
+        self._running_jobs = []
+
+        #: List of (source_table_ref, target_table_ref) for completed jobs
+        self._completed_tables = []
+
+    def submit(self, source_table_ref, target_table_ref, on_done=None):
+        """
+        Start a job to copy the source table to the target table. If the maximum number of jobs are running, this
+        waits for one of them to complete first.
+
+        :param callable on_done: Called with the source and target table refs when the job is done
+        :return: The copy job
+        """
+        return self.submit_batch([(source_table_ref, target_table_ref)], on_done=on_done)
+
+    def submit_batch(self, table_refs, on_done=None, replace=False):
+        """
+        Same as :meth:`submit` for a batch of tables. If there are more than one table, they are copied by a script
+        with a `CREATE TABLE ... COPY` statement per table to save the overhead/quota of a copy job per table.
+
+        :param list[tuple] table_refs: List of (source_table_ref, target_table_ref) to copy
+        :param callable on_done: Called with the source and target table refs for each table when the job is done
+        :param bool replace: Replace target tables that exist when copied by a script, e.g. when resuming a copy that
+                             was interrupted while the script was running. See :func:`copy_script`.
+        :return: The copy or query job
+        """
+        while len(self._running_jobs) >= self.max_concurrent_jobs:
+            self._poll()
+
+        if len(table_refs) == 1:
+            job = self.client.copy_table(*table_refs[0])
+        else:
+            job = self.client.query(copy_script(table_refs, replace=replace))
+        self._running_jobs.append((job, table_refs, on_done))
+
+        return job
+
+    def attach(self, job, source_table_ref, target_table_ref, on_done=None):
+        """ Attach to a copy job that was started before, e.g. by an interrupted copy """
+        self.attach_batch(job, [(source_table_ref, target_table_ref)], on_done=on_done)
+
+    def attach_batch(self, job, table_refs, on_done=None):
+        """ Same as :meth:`attach` for a job that copies a batch of tables """
+        self._running_jobs.append((job, table_refs, on_done))
+
+    def wait(self):
+        """
+        Wait for all jobs to complete
+
+        :return: List of (source_table_ref, target_table_ref) for all completed jobs
+        :raises Exception: If a job failed
+        """
+        while self._running_jobs:
+            self._poll()
+
+        return self._completed_tables
+
+    def _poll(self):
+        """ Check all running jobs once and wait for the poll interval if none of them are done """
+        running_jobs = []
+
+        for job, table_refs, on_done in self._running_jobs:
+            if job.done():
+                job.result()  # Raises the error if the job failed
+                assert job.state == 'DONE'
+                self._completed_tables.extend(table_refs)
+                if on_done:
+                    for source_table_ref, target_table_ref in table_refs:
+                        on_done(source_table_ref, target_table_ref)
+            else:
+                running_jobs.append((job, table_refs, on_done))
+
+        if len(running_jobs) == len(self._running_jobs):
+            time.sleep(self.poll_interval)
+
+        self._running_jobs = running_jobs
+
+
+def copy_script(table_refs, replace=False):
+    """
+    Script to copy a batch of tables with a `CREATE TABLE ... COPY` statement per table. Like a copy job, the script
+    fails if a target table exists already.
+
+    :param list[tuple] table_refs: List of (source_table_ref, target_table_ref) to copy
+    :param bool replace: Replace target tables that exist with `CREATE OR REPLACE TABLE` statements instead, so the
+                         script can be run again for an interrupted copy
+    """
+    def fqtn(table_ref):
+        return f'`{table_ref.project}.{table_ref.dataset_id}.{table_ref.table_id}`'
+
+    create = 'CREATE OR REPLACE TABLE' if replace else 'CREATE TABLE'
+    return '\n'.join(f'{create} {fqtn(target_table_ref)} COPY {fqtn(source_table_ref)};'
+                     for source_table_ref, target_table_ref in table_refs)
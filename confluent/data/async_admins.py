@@ -0,0 +1,374 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import functools
+import random
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import Conflict, Forbidden, ServerError, TooManyRequests
+
+from confluent.data.admins import BigQueryAdmin, MetadataCache
+
+
+#: Default number of threads to make blocking API calls with
+DEFAULT_MAX_WORKERS = 32
+
+#: Default maximum number of API calls per second
+DEFAULT_MAX_CALLS_PER_SEC = 50
+
+#: Default number of times to retry an API call that was rate limited or failed with a server error
+DEFAULT_MAX_RETRIES = 5
+
+#: Reasons for 403 errors that are due to rate limits and should be retried
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'quotaExceeded'}
+
+
+class RateLimiter:
+    """ Token bucket that limits the rate of calls while allowing short bursts """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param float rate: Number of calls per second
+        :param int burst: Maximum number of calls that can be made at once. Defaults to the rate.
+        """
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+        #: Lock and the event loop it was created for
+        self._lock = None
+        self._lock_loop = None
+
+    async def acquire(self):
+        """ Wait until a call can be made """
+        loop = asyncio.get_event_loop()
+        if self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def is_retryable(error):
+    """ True if the error is due to rate limits (429 or 403 with a rate limit reason) or a server error (5xx) """
+    if isinstance(error, (TooManyRequests, ServerError)):
+        return True
+
+    if isinstance(error, Forbidden):
+        return any(e.get('reason') in RATE_LIMIT_REASONS for e in error.errors or [])
+
+    return False
+
+
+class AsyncBigQueryClient:
+    """
+    Asyncio wrapper of :class:`google.cloud.bigquery.Client` that runs the blocking API calls in a thread pool so many
+    of them can run at the same time. Calls are rate limited and retried with exponential backoff when they are rate
+    limited or fail with a server error.
+    """
+
+    def __init__(self, client, max_workers=DEFAULT_MAX_WORKERS, max_calls_per_sec=DEFAULT_MAX_CALLS_PER_SEC,
+                 max_retries=DEFAULT_MAX_RETRIES, initial_backoff=1, max_backoff=32):
+        """
+        :param google.cloud.bigquery.Client client: Client to make the API calls with
+        :param int max_workers: Number of threads to make API calls with
+        :param float|None max_calls_per_sec: Maximum number of API calls per second. None for no limit.
+        :param int max_retries: Number of times to retry a call that can be retried
+        :param float initial_backoff: Seconds to wait before the first retry. It is doubled for each retry after.
+        :param float max_backoff: Maximum seconds to wait before a retry
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+        self.rate_limiter = RateLimiter(max_calls_per_sec) if max_calls_per_sec else None
+
+        #: Thread pool to make API calls with, which is created when needed and shut down by :meth:`close`
+        self.executor = None
+
+        #: Number of calls that were retried
+        self.retries = 0
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Call the blocking function in the thread pool
+
+        :return: Result of the function
+        :raises Exception: Error from the function if it can not be retried or it still fails after all retries
+        """
+        loop = asyncio.get_event_loop()
+        attempt = 0
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire()
+
+            try:
+                return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+
+                self.retries += 1
+                await asyncio.sleep(self._backoff(attempt))
+                attempt += 1
+
+    async def create_job(self, func, *args, **kwargs):
+        """
+        Create a job with the blocking function (e.g. `copy_table` or `query` of the client) like :meth:`call`. Creating
+        a job is not idempotent, so the job ID is generated up front and passed to every attempt: if an attempt failed
+        after the job was created (e.g. with a server error), the retry conflicts with it and the job is returned
+        instead of starting a duplicate.
+
+        :param str job_id: ID of the job to create. Defaults to a random one.
+        :return: The job
+        """
+        job_id = kwargs.pop('job_id', None) or uuid.uuid4().hex
+
+        try:
+            return await self.call(func, *args, job_id=job_id, **kwargs)
+
+        except Conflict:
+            return await self.call(self.client.get_job, job_id, project=kwargs.get('project'),
+                                   location=kwargs.get('location'))
+
+    def close(self):
+        """ Shut down the thread pool. It is created again when a call is made after. """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _backoff(self, attempt):
+        """ Seconds to wait before the retry with full jitter so retries from many calls are spread out """
+        return random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** attempt))
+
+    async def list_tables(self, dataset_ref):
+        """ :return: List of :class:`google.cloud.bigquery.table.TableListItem` for the dataset """
+        return await self.call(lambda: list(self.client.list_tables(dataset=dataset_ref)))
+
+    async def get_table(self, table_ref):
+        return await self.call(self.client.get_table, table_ref)
+
+    async def create_table(self, table, exists_ok=False):
+        return await self.call(self.client.create_table, table, exists_ok=exists_ok)
+
+    async def create_dataset(self, dataset_ref, exists_ok=False):
+        return await self.call(self.client.create_dataset, dataset_ref, exists_ok=exists_ok)
+
+    async def copy_table(self, source_table_ref, target_table_ref, **kwargs):
+        return await self.create_job(self.client.copy_table, source_table_ref, target_table_ref, **kwargs)
+
+    async def query(self, query, **kwargs):
+        return await self.create_job(self.client.query, query, **kwargs)
+
+
+class BlockingBigQueryClient:
+    """
+    Blocking facade of :class:`AsyncBigQueryClient` with the interface of :class:`google.cloud.bigquery.Client`, so the
+    flows of :class:`confluent.data.admins.BigQueryAdmin` can run on the async client with its rate limiting and
+    retries. Coroutines run on an event loop in a background thread, so calls can be made from any thread.
+    """
+
+    #: Client methods that create jobs, see :meth:`AsyncBigQueryClient.create_job`
+    JOB_METHODS = ('copy_table', 'query')
+
+    #: Client methods that return an iterator of pages, which are listed by the call so fetching pages is retried too
+    LIST_METHODS = ('list_datasets', 'list_tables')
+
+    #: Other client methods that make an API call
+    API_METHODS = ('get_table', 'create_table', 'create_dataset', 'delete_dataset', 'get_job')
+
+    def __init__(self, async_client):
+        """
+        :param AsyncBigQueryClient async_client: Client to make the API calls with
+        """
+        self.async_client = async_client
+
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        method = getattr(self.async_client.client, name)
+
+        if name in self.JOB_METHODS:
+            return lambda *args, **kwargs: self.run(self.async_client.create_job(method, *args, **kwargs))
+
+        if name in self.LIST_METHODS:
+            return lambda *args, **kwargs: self.run(self.async_client.call(lambda: list(method(*args, **kwargs))))
+
+        if name in self.API_METHODS:
+            return lambda *args, **kwargs: self.run(self.async_client.call(method, *args, **kwargs))
+
+        return method  # E.g. dataset() that does not make an API call
+
+    def run(self, coroutine):
+        """ Run the coroutine on the event loop and wait for its result """
+        if threading.current_thread() is self._thread:
+            raise RuntimeError('Can not make a blocking call from a coroutine on the event loop')
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self._event_loop()).result()
+
+    def close(self):
+        """ Stop the event loop and shut down the thread pool of the async client. Both are started again if needed. """
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = self._thread = None
+
+        self.async_client.close()
+
+    def _event_loop(self):
+        """ Event loop that runs in the background thread, which is started if it is not running """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='bigquery-event-loop', daemon=True)
+                self._thread.start()
+
+            return self._loop
+
+
+class AsyncMetadataCache(MetadataCache):
+    """
+    Same as :class:`confluent.data.admins.MetadataCache` that can also fetch metadata with coroutines, so dataset
+    listings and tables are fetched at the same time by :meth:`prefetch`. Concurrent requests for the same metadata
+    share a single API call.
+    """
+
+    def __init__(self, client, async_client):
+        """
+        :param BlockingBigQueryClient client: Client to get metadata with when it is not fetched up front
+        :param AsyncBigQueryClient async_client: Client to fetch metadata with coroutines
+        """
+        super().__init__(client)
+        self.async_client = async_client
+
+        #: Dataset key => future of the list of table list items
+        self._listing_futures = {}
+
+        #: Table key => future of the table
+        self._table_futures = {}
+
+    async def prefetch(self, dataset_refs, get_table=None):
+        """
+        Fetch the listings of the datasets at the same time, and then the tables that are needed at the same time
+
+        :param list dataset_refs: Datasets to list tables for
+        :param callable get_table: Called with each table list item and the set of table IDs in its dataset to return
+                                   True if the table should be fetched
+        """
+        listings = await asyncio.gather(*[self.fetch_tables(dataset_ref) for dataset_ref in dataset_refs])
+
+        table_refs = []
+        for listing in listings:
+            table_ids = {table_item.reference.table_id for table_item in listing}
+            table_refs.extend(table_item.reference for table_item in listing
+                              if get_table and get_table(table_item, table_ids))
+        await asyncio.gather(*[self.fetch_table(table_ref) for table_ref in table_refs])
+
+    async def fetch_tables(self, dataset_ref):
+        """ Same as :meth:`list_tables` as a coroutine """
+        dataset_key = (dataset_ref.project, dataset_ref.dataset_id)
+
+        if dataset_key in self._listings or dataset_key in self._listing_futures:
+            self.saved_calls += 1
+
+        else:
+            self.api_calls += 1
+            self._listing_futures[dataset_key] = asyncio.ensure_future(self.async_client.list_tables(dataset_ref))
+
+        if dataset_key not in self._listings:
+            self._cache_listing(dataset_key, await self._listing_futures[dataset_key])
+
+        return self._listings[dataset_key]
+
+    async def fetch_table(self, table_ref):
+        """ Same as :meth:`get_table` as a coroutine """
+        table_key = self._table_key(table_ref)
+
+        if table_key in self._tables or table_key in self._table_futures:
+            self.saved_calls += 1
+
+        else:
+            self.api_calls += 1
+            self._table_futures[table_key] = asyncio.ensure_future(self.async_client.get_table(table_ref))
+
+        if table_key not in self._tables:
+            self._tables[table_key] = await self._table_futures[table_key]
+
+        return self._tables[table_key]
+
+
+class AsyncBigQueryAdmin(BigQueryAdmin):
+    """
+    Same as :class:`confluent.data.admins.BigQueryAdmin` with API calls made by :class:`AsyncBigQueryClient`, so they
+    are rate limited and retried, and metadata fetched and views created for datasets and projects at the same time
+    using asyncio
+    """
+
+    def __init__(self, client=None, max_workers=DEFAULT_MAX_WORKERS, max_calls_per_sec=DEFAULT_MAX_CALLS_PER_SEC,
+                 max_retries=DEFAULT_MAX_RETRIES, poll_interval=1):
+        """
+        See :class:`AsyncBigQueryClient` for the params
+
+        :param float poll_interval: Seconds to wait between polling running copy jobs
+        """
+        super().__init__(client, poll_interval=poll_interval)
+
+        self.async_client = AsyncBigQueryClient(self.client, max_workers=max_workers,
+                                                max_calls_per_sec=max_calls_per_sec, max_retries=max_retries)
+        self.client = BlockingBigQueryClient(self.async_client)
+
+    def move_dataset(self, *args, **kwargs):
+        with closing(self.client):
+            super().move_dataset(*args, **kwargs)
+
+    def create_views(self, *args, **kwargs):
+        with closing(self.client):
+            super().create_views(*args, **kwargs)
+
+    def copy_dataset(self, *args, **kwargs):
+        with closing(self.client):
+            super().copy_dataset(*args, **kwargs)
+
+    def copy_project(self, *args, **kwargs):
+        with closing(self.client):
+            super().copy_project(*args, **kwargs)
+
+    def _metadata_cache(self):
+        return AsyncMetadataCache(self.client, self.async_client)
+
+    def _prefetch_metadata(self, metadata, dataset_refs, get_table=None):
+        self.client.run(metadata.prefetch(dataset_refs, get_table=get_table))
+
+    def _create_tables(self, tables):
+        async def create_tables():
+            await asyncio.gather(*[self.async_client.create_table(table) for table in tables])
+
+        self.client.run(create_tables())
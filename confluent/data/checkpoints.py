@@ -0,0 +1,82 @@
+import json
+import os
+import re
+
+
+class CopyCheckpoint:
+    """
+    Local checkpoint of the state of each table being copied from a dataset to another, which is used to resume an
+    interrupted copy without copying tables again.
+    """
+
+    #: Table has not been copied yet
+    PENDING = 'pending'
+
+    #: Table is being copied by a copy job (job ID is recorded)
+    COPYING = 'copying'
+
+    #: Table has been copied and its number of rows verified
+    VERIFIED = 'verified'
+
+    #: View has been created
+    VIEW_CREATED = 'view-created'
+
+    def __init__(self, from_dataset, to_dataset, path=None):
+        """
+        :param str from_dataset: Fully qualified dataset name (project.dataset) being copied from
+        :param str to_dataset: Fully qualified dataset name (project.dataset) being copied to
+        :param str|None path: Path to the checkpoint file. Defaults to a file named after the datasets in the current
+                              directory.
+        """
+        self.from_dataset = from_dataset
+        self.to_dataset = to_dataset
+        self.path = path or re.sub(r'[^a-zA-Z0-9_.-]', '_', f'.bq-admin-checkpoint-{from_dataset}-{to_dataset}.json')
+
+        #: Table ID => dict with state and optional job info
+        self.tables = {}
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """ Load the table states from the checkpoint file if it exists """
+        if self.exists():
+            with open(self.path) as fp:
+                self.tables = json.load(fp)['tables']
+
+    def state(self, table_id):
+        """ State of the given table """
+        return self.tables.get(table_id, {}).get('state', self.PENDING)
+
+    def job(self, table_id):
+        """ Tuple of (job ID, project, location) of the copy job for the given table or None if there isn't one """
+        table = self.tables.get(table_id, {})
+        return (table['job_id'], table.get('project'), table.get('location')) if 'job_id' in table else None
+
+    def set(self, table_id, state, job=None):
+        """
+        Set the state of a table and save the checkpoint
+
+        :param str table_id: ID of the table
+        :param str state: State of the table
+        :param google.cloud.bigquery.job.CopyJob job: Copy job (or query job for batched copies) for the table to
+                                                      record, so it can be reattached
+        """
+        self.tables[table_id] = {'state': state}
+        if job:
+            self.tables[table_id].update(job_id=job.job_id, project=job.project, location=job.location)
+
+        self.save()
+
+    def save(self):
+        """ Write the checkpoint atomically, so an interrupted write doesn't corrupt it """
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump({'from_dataset': self.from_dataset, 'to_dataset': self.to_dataset, 'tables': self.tables},
+                      fp, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        """ Remove the checkpoint file once the copy is complete """
+        if self.exists():
+            os.unlink(self.path)
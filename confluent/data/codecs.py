@@ -0,0 +1,137 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+try:
+    import simdjson
+except ImportError:  # pragma: no cover
+    simdjson = None
+
+
+class AbstractJSONCodec:
+    """ Abstract JSON codec that decodes/encodes records from/to bytes for all codecs """
+
+    #: Name of the codec
+    NAME = None
+
+    #: Package to install to make the codec available
+    PACKAGE = None
+
+    #: Module that provides the codec
+    MODULE = None
+
+    @classmethod
+    def is_available(cls):
+        """ True if the module that provides the codec is installed """
+        return cls.MODULE is not None
+
+    def loads(self, data):
+        """
+        :param bytes|str data: Serialized JSON record
+        :return: Deserialized record
+        """
+        raise NotImplementedError('Sub-class should implement to return the deserialized record')
+
+    def dumps(self, record):
+        """
+        :param dict record: Record to serialize
+        :return: Serialized JSON record as UTF-8 bytes
+        """
+        raise NotImplementedError('Sub-class should implement to return the serialized record')
+
+
+class StdlibJSONCodec(AbstractJSONCodec):
+    """ JSON codec using the standard `json` module, which is always available """
+
+    NAME = 'json'
+    MODULE = json
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, record):
+        return json.dumps(record).encode()
+
+
+class OrjsonCodec(AbstractJSONCodec):
+    """ JSON codec using `orjson`. Falls back to `json` for what orjson doesn't support, like integers over 64 bits """
+
+    NAME = 'orjson'
+    PACKAGE = 'orjson'
+    MODULE = orjson
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+    def dumps(self, record):
+        try:
+            return orjson.dumps(record)
+        except orjson.JSONEncodeError:
+            return json.dumps(record).encode()
+
+
+class UjsonCodec(AbstractJSONCodec):
+    """ JSON codec using `ujson` """
+
+    NAME = 'ujson'
+    PACKAGE = 'ujson'
+    MODULE = ujson
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+    def dumps(self, record):
+        return ujson.dumps(record, ensure_ascii=False, escape_forward_slashes=False).encode()
+
+
+class SimdjsonCodec(AbstractJSONCodec):
+    """ JSON codec using `simdjson` for decoding. It doesn't do encoding, so `json` is used for that """
+
+    NAME = 'simdjson'
+    PACKAGE = 'pysimdjson'
+    MODULE = simdjson
+
+    def loads(self, data):
+        return simdjson.loads(data)
+
+    def dumps(self, record):
+        return json.dumps(record).encode()
+
+
+#: Codecs by name in the order of preference for auto selection
+JSON_CODECS = {codec.NAME: codec for codec in (OrjsonCodec, UjsonCodec, SimdjsonCodec, StdlibJSONCodec)}
+
+#: Name to automatically pick the fastest available codec
+AUTO_JSON_CODEC = 'auto'
+
+
+def get_json_codec(name=AUTO_JSON_CODEC):
+    """
+    Get a JSON codec by name
+
+    :param str name: Name of the codec from :data:`JSON_CODECS` or "auto" to pick the fastest one that is available.
+    :rtype: AbstractJSONCodec
+    :raises ValueError: If the codec is unknown or not available
+    """
+    if name == AUTO_JSON_CODEC:
+        return next(codec() for codec in JSON_CODECS.values() if codec.is_available())
+
+    if name not in JSON_CODECS:
+        raise ValueError(f'Unknown JSON codec: {name}')
+
+    codec = JSON_CODECS[name]
+    if not codec.is_available():
+        raise ValueError(f'JSON codec {name} is not available. Please install it: pip install {codec.PACKAGE}')
+
+    return codec()
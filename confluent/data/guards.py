@@ -0,0 +1,179 @@
+import gzip
+import json
+import os
+import resource
+import sys
+
+
+#: Reason for quarantining records that are larger than the size limit
+TOO_LARGE = 'too_large'
+
+#: Reason for quarantining records that are nested deeper than the depth limit
+TOO_DEEP = 'too_deep'
+
+#: Reason for quarantining lines that are not valid JSON
+INVALID_JSON = 'invalid_json'
+
+
+class RecordGuard:
+    """
+    Limits for pathological records (e.g. multi-MB or deeply nested ones) that send offending lines to a quarantine
+    file instead of failing the whole data file, and a memory cap for the process that transforms them.
+
+    Lines larger than the size limit are quarantined without parsing them. Lines that could be nested deeper than the
+    depth limit (i.e. they have more brackets than the limit) are measured without recursion once they are parsed.
+    Lines that the JSON codec fails to parse are parsed again with `json`, and quarantined as too deep if they are
+    nested too deeply for it or as invalid JSON if they are not JSON. The memory of the process is checked after
+    each batch of records, so a data file that exceeds the cap fails with a :class:`MemoryError` instead of the
+    process being killed by the OS.
+    """
+
+    def __init__(self, max_record_size=None, max_depth=None, max_memory=None, quarantine_file=None):
+        """
+        :param int max_record_size: Maximum size of a record (JSON line) in bytes
+        :param int max_depth: Maximum nesting depth of dicts/lists in a record, e.g. 2 for `{"metric": {"a": 1}}`
+        :param int max_memory: Maximum resident memory of the process in bytes
+        :param str quarantine_file: Gzipped file to write quarantined lines to. Defaults to adding them to
+                                    `quarantined_lines` of the metrics, e.g. for chunks that are transformed in other
+                                    processes, so the parent process writes them in order.
+        """
+        self.max_record_size = max_record_size
+        self.max_depth = max_depth
+        self.max_memory = max_memory
+        self.quarantine_file = quarantine_file
+
+        self._quarantine = QuarantineFile(quarantine_file) if quarantine_file else None
+
+    def for_file(self, quarantine_file=None):
+        """ New guard with the same limits that writes quarantined lines to the given file """
+        return RecordGuard(self.max_record_size, self.max_depth, self.max_memory, quarantine_file=quarantine_file)
+
+    def settings(self):
+        """ Limits that affect the output of the transform, e.g. to record them in the manifest """
+        return {name: value for name, value in (('max_record_size', self.max_record_size),
+                                                ('max_depth', self.max_depth)) if value}
+
+    def parse(self, lines, loads, metrics):
+        """
+        Parse lines into records and quarantine the ones that exceed the limits
+
+        :param list[bytes] lines: JSON lines to parse
+        :param callable loads: Function that parses a JSON line
+        :param TransformMetrics metrics: Metrics to count quarantined records by reason in
+        :return: List of records that are within the limits
+        """
+        max_record_size = self.max_record_size
+        max_depth = self.max_depth
+        records = []
+
+        for line in lines:
+            if max_record_size and len(line) > max_record_size:
+                self.quarantine(line, TOO_LARGE, metrics)
+                continue
+
+            try:
+                record = loads(line)
+            except (RecursionError, ValueError):  # E.g. JSON codecs have their own depth limits
+                try:
+                    record = json.loads(line)
+                except RecursionError:
+                    self.quarantine(line, TOO_DEEP, metrics)
+                    continue
+                except ValueError:
+                    self.quarantine(line, INVALID_JSON, metrics)
+                    continue
+
+            # A record can only be nested deeper than the limit if it has more brackets than that
+            if max_depth and line.count(b'{') + line.count(b'[') > max_depth and \
+                    record_depth(record, limit=max_depth) > max_depth:
+                self.quarantine(line, TOO_DEEP, metrics)
+            else:
+                records.append(record)
+
+        return records
+
+    def quarantine(self, line, reason, metrics):
+        """ Write the line to the quarantine file (or metrics) and count it by reason """
+        metrics.quarantined[reason] += 1
+
+        if self._quarantine:
+            self._quarantine.write(line)
+        else:
+            metrics.quarantined_lines.append(line)
+
+    def check_memory(self, metrics):
+        """
+        Record the peak memory of the process in the metrics
+
+        :raises MemoryError: If the memory of the process exceeds the cap
+        """
+        rss = current_rss()
+        metrics.peak_rss = max(metrics.peak_rss, rss)
+
+        if self.max_memory and rss > self.max_memory:
+            raise MemoryError(f'Process memory ({rss / 1024 / 1024:,.1f} MB) exceeded the cap of '
+                              f'{self.max_memory / 1024 / 1024:,.1f} MB')
+
+    def close(self):
+        if self._quarantine:
+            self._quarantine.close()
+
+
+class QuarantineFile:
+    """ Gzipped file of quarantined lines, which is only created when the first line is written """
+
+    def __init__(self, path):
+        """
+        :param str path: Path of the file. Parent dirs are created as needed.
+        """
+        self.path = path
+        self._fp = None
+
+    def write(self, line):
+        if self._fp is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._fp = gzip.open(self.path, 'wb')
+
+        self._fp.write(line + b'\n')
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+
+def record_depth(value, limit=None):
+    """
+    Nesting depth of dicts/lists in a value without recursion, e.g. 1 for a flat record and 0 for a string
+
+    :param value: Value to measure, e.g. a record
+    :param int limit: Stop measuring once the depth is larger than this
+    :return: Depth of the value, or a depth larger than the limit if it is exceeded
+    """
+    depth = 0
+    stack = [(value, 1)] if type(value) is dict or type(value) is list else []
+
+    while stack:
+        value, level = stack.pop()
+        if level > depth:
+            depth = level
+            if limit and depth > limit:
+                break
+
+        for child in (value.values() if type(value) is dict else value):
+            if type(child) is dict or type(child) is list:
+                stack.append((child, level + 1))
+
+    return depth
+
+
+def current_rss():
+    """
+    Resident memory of this process in bytes. Falls back to the peak memory on platforms without /proc (e.g. macOS).
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class TransformManifest:
+    """
+    Persistent record of transformed source files stored in a SQLite database, which is used to only transform new or
+    changed source files on re-runs and to tell when outputs are stale as the transform settings have changed.
+    """
+
+    #: Name of the manifest file in the sink dir
+    FILE_NAME = '.transform-manifest.sqlite'
+
+    def __init__(self, sink_dir, settings):
+        """
+        :param str sink_dir: Directory where transformed data files are written to. The manifest is stored there.
+        :param dict settings: Transform settings (e.g. select/exclude fields) that affect the output. Must be JSON
+                              serializable.
+        """
+        self.path = os.path.join(sink_dir, self.FILE_NAME)
+        self.settings = json.dumps(settings, sort_keys=True)
+
+        os.makedirs(sink_dir, exist_ok=True)
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS transforms (
+                source_file TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                transformed_at REAL NOT NULL
+            )""")
+        self._db.commit()
+
+    def entries(self):
+        """
+        :return: Dict of source file => (size, mtime_ns, content_hash, settings) for all recorded source files
+        """
+        cursor = self._db.execute('SELECT source_file, size, mtime_ns, content_hash, settings FROM transforms')
+        return {row[0]: row[1:] for row in cursor}
+
+    def stale_files(self):
+        """
+        :return: Source files whose outputs are stale as they were transformed with different settings
+        """
+        cursor = self._db.execute('SELECT source_file FROM transforms WHERE settings != ? ORDER BY source_file',
+                                  (self.settings,))
+        return [row[0] for row in cursor]
+
+    def record(self, source_file, size, mtime_ns, content_hash):
+        """
+        Record that the given source file has been transformed with the current settings
+
+        :param str source_file: Path of the source file relative to the source dir
+        :param int size: Size of the source file
+        :param int mtime_ns: Modified time of the source file in nanoseconds
+        :param str content_hash: Hash of the source file content. See :func:`content_hash`
+        """
+        self._db.execute('INSERT OR REPLACE INTO transforms VALUES (?, ?, ?, ?, ?, ?)',
+                         (source_file, size, mtime_ns, content_hash, self.settings, time.time()))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def content_hash(path, block_size=1024 * 1024):
+    """
+    :param str path: Path to file to hash
+    :param int block_size: Size of blocks to read at a time
+    :return: SHA-1 hex digest of the file content
+    """
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
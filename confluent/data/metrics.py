@@ -0,0 +1,192 @@
+from collections import Counter
+from contextlib import contextmanager
+import json
+import sys
+import time
+
+from confluent.data.schemas import KeySchema
+
+
+class TransformMetrics:
+    """ Metrics for transforming a data file (or a chunk of one) that are reported by workers to the parent process """
+
+    #: Stages of a transform that are timed
+    STAGES = ('decompress', 'parse', 'transform', 'serialize', 'compress')
+
+    def __init__(self, input_file=None):
+        """
+        :param str|None input_file: Data file that the metrics are for
+        """
+        self.input_file = input_file
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.records = 0
+        self.elapsed = 0.0
+        self.stage_seconds = dict.fromkeys(self.STAGES, 0.0)
+
+        #: Error message if the transform failed
+        self.error = None
+
+        #: True if the transform was skipped as it was done before
+        self.skipped = False
+
+        #: Content hash of the data file for the manifest
+        self.content_hash = None
+
+        #: :class:`confluent.data.schemas.KeySchema` of the transformed records if the transform learns it
+        self.key_schema = None
+
+        #: Reason => number of records that were quarantined by :class:`confluent.data.guards.RecordGuard`
+        self.quarantined = Counter()
+
+        #: Quarantined lines for the parent process to write, e.g. from chunks transformed in other processes
+        self.quarantined_lines = []
+
+        #: Peak resident memory (in bytes) of the process that did the transform if it was checked
+        self.peak_rss = 0
+
+    @contextmanager
+    def timer(self, stage):
+        """ Add the time spent in the context to the given stage """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage] += time.perf_counter() - start_time
+
+    @property
+    def records_per_sec(self):
+        return self.records / self.elapsed if self.elapsed else 0.0
+
+    def merge(self, other):
+        """
+        Add the records, stage times, quarantined records, peak memory, and key schema from other metrics, e.g. for
+        chunks of a data file. Quarantined lines are not added as they should be written out instead.
+        """
+        self.records += other.records
+        for stage, seconds in other.stage_seconds.items():
+            self.stage_seconds[stage] += seconds
+        self.quarantined.update(other.quarantined)
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+
+        if other.key_schema is not None:
+            if self.key_schema is None:
+                self.key_schema = KeySchema()
+            self.key_schema.merge(other.key_schema)
+
+    def to_dict(self):
+        return {'input_file': self.input_file, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'records': self.records, 'records_per_sec': round(self.records_per_sec, 1),
+                'elapsed': round(self.elapsed, 3),
+                'stage_seconds': {stage: round(seconds, 3) for stage, seconds in self.stage_seconds.items()},
+                'error': self.error, 'skipped': self.skipped, 'quarantined': sum(self.quarantined.values())}
+
+
+class TransformProgress:
+    """ Aggregates :class:`TransformMetrics` from workers to report progress and summary of a transform run """
+
+    #: Number of slowest files to include in the summary
+    SLOWEST_FILES = 100
+
+    def __init__(self, total_files, parallel_processes, interval=1.0, out=None):
+        """
+        :param int total_files: Number of data files to transform
+        :param int parallel_processes: Number of processes used
+        :param float interval: Minimum seconds between progress updates
+        :param out: File object to write progress to. Defaults to stdout.
+        """
+        self.total_files = total_files
+        self.parallel_processes = parallel_processes
+        self.interval = interval
+        self.out = out or sys.stdout
+
+        self.totals = TransformMetrics()
+        self.files = 0
+        self.skipped_files = 0
+        self.quarantined_files = 0
+        self.errors = []
+        self.slowest_files = []
+
+        self._start_time = time.time()
+        self._last_report_time = 0
+        self._live = hasattr(self.out, 'isatty') and self.out.isatty()
+
+    def update(self, metrics):
+        """ Add metrics for a data file and report progress if it is time """
+        self.files += 1
+        self.totals.merge(metrics)
+        self.totals.bytes_in += metrics.bytes_in
+        self.totals.bytes_out += metrics.bytes_out
+        self.totals.elapsed += metrics.elapsed
+
+        if metrics.skipped:
+            self.skipped_files += 1
+        if metrics.quarantined:
+            self.quarantined_files += 1
+        if metrics.error:
+            self.errors.append({'input_file': metrics.input_file, 'error': metrics.error})
+
+        if not metrics.skipped:
+            self.slowest_files.append(metrics)
+            if len(self.slowest_files) > 2 * self.SLOWEST_FILES:
+                self._trim_slowest_files()
+
+        now = time.time()
+        if now - self._last_report_time >= self.interval or self.files == self.total_files:
+            self._last_report_time = now
+            self.out.write(self.progress() + ('\r' if self._live else '\n'))
+            self.out.flush()
+
+    def progress(self):
+        """ A line with the current progress """
+        wall_time = time.time() - self._start_time
+        records_per_sec = self.totals.records / wall_time if wall_time else 0
+
+        return (f'[{self.files}/{self.total_files} files] {self.totals.records:,} records '
+                f'({records_per_sec:,.0f} records/sec), {_mb(self.totals.bytes_in)} in, '
+                f'{_mb(self.totals.bytes_out)} out, {len(self.errors)} error(s)')
+
+    def summary(self):
+        """
+        Summary of the run, which includes the time spent per stage and utilization of the processes to tell whether
+        the run is CPU or I/O bound, and the slowest files.
+
+        :rtype: dict
+        """
+        wall_time = time.time() - self._start_time
+        stage_seconds = sum(self.totals.stage_seconds.values())
+        utilization = self.totals.elapsed / (wall_time * self.parallel_processes) if wall_time else 0
+        self._trim_slowest_files()
+
+        return {
+            'files': self.files,
+            'skipped_files': self.skipped_files,
+            'records': self.totals.records,
+            'bytes_in': self.totals.bytes_in,
+            'bytes_out': self.totals.bytes_out,
+            'wall_seconds': round(wall_time, 3),
+            'worker_seconds': round(self.totals.elapsed, 3),
+            'records_per_sec': round(self.totals.records / wall_time, 1) if wall_time else 0,
+            'process_utilization': round(utilization, 3),
+            'stage_seconds': {stage: round(seconds, 3) for stage, seconds in self.totals.stage_seconds.items()},
+            'stage_percents': {stage: round(100 * seconds / stage_seconds, 1) if stage_seconds else 0
+                               for stage, seconds in self.totals.stage_seconds.items()},
+            'quarantined': dict(self.totals.quarantined),
+            'quarantined_files': self.quarantined_files,
+            'peak_rss': self.totals.peak_rss,
+            'errors': self.errors,
+            'slowest_files': [m.to_dict() for m in self.slowest_files],
+        }
+
+    def write_summary(self, path):
+        """ Write the summary as JSON to the given path """
+        with open(path, 'w') as fp:
+            json.dump(self.summary(), fp, indent=2)
+
+    def _trim_slowest_files(self):
+        self.slowest_files.sort(key=lambda m: m.elapsed, reverse=True)
+        del self.slowest_files[self.SLOWEST_FILES:]
+
+
+def _mb(num_bytes):
+    return f'{num_bytes / 1024 / 1024:,.1f} MB'
@@ -0,0 +1,401 @@
+from datetime import datetime
+from functools import lru_cache
+import gzip
+import io
+import json
+from pathlib import Path
+
+import pytz
+
+from confluent.data.codecs import AUTO_JSON_CODEC
+from confluent.data.metrics import TransformMetrics
+from confluent.data.sinks import DEFAULT_SINK_FORMAT, get_sink_format
+from confluent.data.transformers import (COLUMNAR_ENGINE, DEFAULT_BUFFER_SIZE, DEFAULT_COMPRESS_LEVEL,
+                                         TRANSFORM_ENGINES, RECORD_ENGINE, compile_key_plan, numpy, round_column,
+                                         transform_lines)
+
+
+#: Default timezone of fields derived from timestamps
+DEFAULT_DERIVE_TIMEZONE = 'UTC'
+
+#: Default strftime format of fields derived from timestamps
+DEFAULT_DERIVE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+@lru_cache()
+def parse_transform_spec(json_file):
+    """
+    Transform spec from a JSON file that declares how to transform records, which contains the following info::
+
+        {
+            "select": ["$field", "-$field"],
+            "drop": ["$field"],
+            "rename": {"$field": "$key"},
+            "round": {
+                "$field": $unit,
+                "$field": {"to": $unit, "min": $min}
+            },
+            "derive": {
+                "$new_field": {"from": "$timestamp_field", "timezone": "$timezone", "format": "$format"}
+            }
+        }
+
+    where:
+        select: Fields to include, or to exclude when prefixed with a negative sign ("-"). Defaults to all fields.
+        drop: Fields to remove from records, e.g. fields that are not useful
+        rename: Field => key to rename it to. The key is sanitized for BigQuery like any other key.
+        round: Field => unit to round numeric values (or numeric strings) to the nearest unit as ints, e.g. 60 to
+               round epoch seconds to the minute. Rounded values that are less than `min` are set to `min`.
+        derive: New top-level field => timestamp field (epoch seconds) to format as a localized date/time string with
+                strftime. Timezone defaults to UTC and format defaults to "%Y-%m-%d %H:%M:%S".
+        $field: Field name. Use a dot for nested fields, e.g. "metric.clusterId".
+
+    Records are rounded first, then fields are derived from the rounded values, and then fields are dropped, selected
+    and renamed while the keys are sanitized for BigQuery. Missing or null values are skipped.
+
+    :param str json_file: Path to transform spec JSON
+    :rtype: TransformSpec
+    :raises ValueError: If the spec is not valid
+    """
+    with Path(json_file).open() as fp:
+        return TransformSpec(json.load(fp))
+
+
+class TransformSpec:
+    """
+    Object representation of a transform spec (see :func:`parse_transform_spec`) that is compiled once into a function
+    that transforms one record at a time, or a batch of records at a time with NumPy.
+    """
+
+    #: Keys that a transform spec can have
+    SPEC_KEYS = ('select', 'drop', 'rename', 'round', 'derive')
+
+    def __init__(self, spec):
+        """
+        :param dict spec: Transform spec
+        :raises ValueError: If the spec is not valid
+        """
+        if not isinstance(spec, dict):
+            raise ValueError('Transform spec must be a JSON object')
+        unsupported_keys = set(spec) - set(self.SPEC_KEYS)
+        if unsupported_keys:
+            raise ValueError(f'Unsupported key(s) in transform spec: {", ".join(sorted(unsupported_keys))}')
+
+        #: Transform spec as parsed from JSON
+        self.spec = spec
+
+        select = _field_list(spec, 'select')
+        #: Fields to include
+        self.select_fields = set(f for f in select if not f.startswith('-'))
+        #: Fields to exclude, including dropped fields
+        self.exclude_fields = set(f[1:] for f in select if f.startswith('-')) | set(_field_list(spec, 'drop'))
+
+        #: Field => key to rename it to
+        self.renames = _field_dict(spec, 'rename')
+        if not all(isinstance(key, str) and key for key in self.renames.values()):
+            raise ValueError('Keys to rename fields to must be non-empty strings')
+
+        #: List of (parent keys, key, unit, min) to round
+        self.rounds = []
+        for field, rounding in _field_dict(spec, 'round').items():
+            if not isinstance(rounding, dict):
+                rounding = {'to': rounding}
+            unsupported_keys = set(rounding) - {'to', 'min'}
+            if unsupported_keys:
+                raise ValueError(f'Unsupported key(s) to round {field}: {", ".join(sorted(unsupported_keys))}')
+            unit, minimum = rounding.get('to'), rounding.get('min')
+            if not _is_number(unit) or unit <= 0:
+                raise ValueError(f'Unit to round {field} to must be a positive number: {unit}')
+            if minimum is not None and not _is_number(minimum):
+                raise ValueError(f'Minimum to round {field} to must be a number: {minimum}')
+            self.rounds.append(_split_field(field) + (unit, minimum))
+
+        #: List of (parent keys, timestamp key, timezone, formats, new fields) to derive, grouped by the timestamp
+        #: field and timezone so each timestamp is localized once
+        self.derives = []
+        derive_groups = {}
+        for new_field, derive in _field_dict(spec, 'derive').items():
+            if not isinstance(derive, dict) or not derive.get('from'):
+                raise ValueError(f'Field to derive {new_field} from is required')
+            unsupported_keys = set(derive) - {'from', 'timezone', 'format'}
+            if unsupported_keys:
+                raise ValueError(f'Unsupported key(s) to derive {new_field}: {", ".join(sorted(unsupported_keys))}')
+            timezone = derive.get('timezone', DEFAULT_DERIVE_TIMEZONE)
+            try:
+                pytz.timezone(timezone)
+            except pytz.UnknownTimeZoneError:
+                raise ValueError(f'Unknown timezone to derive {new_field} with: {timezone}')
+
+            group = derive_groups.setdefault((derive['from'], timezone), [])
+            group.append((new_field, derive.get('format', DEFAULT_DERIVE_FORMAT)))
+
+        for (field, timezone), fields in derive_groups.items():
+            new_fields, formats = zip(*fields)
+            self.derives.append(_split_field(field) + (timezone, formats, new_fields))
+
+        #: (engine, key plan) => compiled function
+        self._compiled = {}
+
+    def key_plan(self, select_fields=None, exclude_fields=None, track_types=False):
+        """
+        :param set select_fields: Set of fields to include in addition to the ones in the spec
+        :param set exclude_fields: Set of fields to exclude in addition to the ones in the spec
+        :param bool track_types: Record the types of values for :meth:`KeyPlan.key_schema`
+        :return: Cached :class:`confluent.data.transformers.KeyPlan` that drops, selects and renames the fields
+        """
+        return compile_key_plan(self.select_fields | set(select_fields or ()),
+                                self.exclude_fields | set(exclude_fields or ()), track_types=track_types,
+                                renames=self.renames)
+
+    def compile(self, engine=RECORD_ENGINE, key_plan=None):
+        """
+        Compile the spec into a function that transforms a batch of records. It is compiled once per engine and key
+        plan.
+
+        :param str engine: Transform one record at a time (record) or round the values of a batch of records as NumPy
+                           columns and derive fields once per unique timestamp (columnar)
+        :param KeyPlan key_plan: Plan to clean the keys with. Defaults to :meth:`key_plan`.
+        :return: Function that takes a list of records (which are modified in place) and returns the list of
+                 transformed records in the same order
+        :raises ImportError: If NumPy is not installed for the columnar engine
+        """
+        if engine not in TRANSFORM_ENGINES:
+            raise ValueError(f'Unsupported transform engine: {engine}')
+        if engine == COLUMNAR_ENGINE and numpy is None:
+            raise ImportError('NumPy is required for the columnar engine. Please install it: pip install numpy')
+        if key_plan is None:
+            key_plan = self.key_plan()
+
+        compile_key = (engine, key_plan)
+        if compile_key not in self._compiled:
+            if engine == COLUMNAR_ENGINE:
+                self._compiled[compile_key] = self._compile_columnar(key_plan)
+            else:
+                transform_record = self.compile_record(key_plan)
+                self._compiled[compile_key] = lambda records: [transform_record(record) for record in records]
+
+        return self._compiled[compile_key]
+
+    def compile_record(self, key_plan=None):
+        """
+        Compile the spec into a function that transforms one record at a time
+
+        :param KeyPlan key_plan: Plan to clean the keys with. Defaults to :meth:`key_plan`.
+        :return: Function that takes a record (which is modified in place) and returns the transformed record
+        """
+        if key_plan is None:
+            key_plan = self.key_plan()
+
+        rounds = self.rounds
+        derives = self.derives
+        clean = key_plan.clean_in_place
+
+        def transform_record(record):
+            for parent_keys, key, unit, minimum in rounds:
+                parent = _parent(record, parent_keys)
+                if parent is not None and parent.get(key) is not None:
+                    parent[key] = round_value(parent[key], unit, minimum)
+
+            for parent_keys, key, timezone, formats, new_fields in derives:
+                parent = _parent(record, parent_keys)
+                if parent is not None and parent.get(key) is not None:
+                    record.update(zip(new_fields, local_time_formats(parent[key], timezone, formats)))
+
+            return clean(record)
+
+        return transform_record
+
+    def _compile_columnar(self, key_plan):
+        rounds = self.rounds
+        derives = self.derives
+        clean = key_plan.clean_in_place
+
+        def transform_records(records):
+            for parent_keys, key, unit, minimum in rounds:
+                parents = [_parent(record, parent_keys) for record in records]
+                values = [parent.get(key) if parent is not None else None for parent in parents]
+                for parent, value in zip(parents, round_values(values, unit, minimum)):
+                    if value is not None:
+                        parent[key] = value
+
+            for parent_keys, key, timezone, formats, new_fields in derives:
+                timestamps = [parent.get(key) if parent is not None else None
+                              for parent in (_parent(record, parent_keys) for record in records)]
+                time_strings = {timestamp: tuple(zip(new_fields, local_time_formats(timestamp, timezone, formats)))
+                                for timestamp in set(timestamps) if timestamp is not None}
+                for record, timestamp in zip(records, timestamps):
+                    if timestamp is not None:
+                        record.update(time_strings[timestamp])
+
+            return [clean(record) for record in records]
+
+        return transform_records
+
+    def to_dict(self):
+        """ Transform spec as parsed from JSON, e.g. to record it in the manifest settings """
+        return self.spec
+
+
+def round_value(value, unit, minimum=None):
+    """
+    Round a value to the nearest unit the same way as :func:`confluent.data.transformers.round_column`
+
+    :param int|float|str value: Number or numeric string to round
+    :param int|float unit: Unit to round to, e.g. 60 seconds
+    :param int|float minimum: Minimum rounded value
+    :return: Rounded value (int for int units)
+    """
+    if isinstance(value, str):
+        value = float(value)
+
+    rounded = int(value / unit + 0.5) * unit
+
+    if minimum is not None and rounded < minimum:
+        return minimum
+    return rounded
+
+
+def round_values(values, unit, minimum=None):
+    """
+    Same as :func:`round_value`, but for a column of values that are rounded as NumPy vector operations when they are
+    all numbers (or numeric strings) that can be rounded exactly as floats.
+
+    :param list values: Numbers or numeric strings to round. None values stay None.
+    :return: List of rounded values in the same order
+    """
+    try:
+        column = round_column(numpy.array(values, dtype=numpy.float64), unit)
+    except (TypeError, ValueError):
+        column = None
+
+    # Nulls (NaN), huge ints, or values that are not numbers are rounded one at a time instead
+    if column is None:
+        return [round_value(value, unit, minimum) if value is not None else None for value in values]
+
+    rounded = column.tolist()
+
+    # Set per value like round_value, as NumPy would cast the column (or minimum) to a common type, e.g. ints to floats
+    if minimum is not None:
+        for i in numpy.flatnonzero(column < minimum):
+            rounded[i] = minimum
+
+    return rounded
+
+
+@lru_cache(maxsize=10080)
+def local_time_formats(timestamp, timezone, formats):
+    """
+    Localized date/time strings for the given timestamp. Results are cached for the last week worth of minutes as
+    timestamps are usually rounded to the minute and data files usually cover a narrow time window.
+
+    :param int timestamp: Epoch seconds
+    :param str timezone: Timezone name to localize to
+    :param tuple formats: strftime formats
+    :return: Tuple of strings for the formats
+    """
+    local_time = datetime.fromtimestamp(timestamp, pytz.timezone(timezone))
+    return tuple(local_time.strftime(f) for f in formats)
+
+
+def transform_with_spec(input_file, output_file, spec_file, select_fields=None, exclude_fields=None,
+                        json_codec=AUTO_JSON_CODEC, compress_level=DEFAULT_COMPRESS_LEVEL,
+                        buffer_size=DEFAULT_BUFFER_SIZE, engine=RECORD_ENGINE, sink_format=DEFAULT_SINK_FORMAT,
+                        sink_compression=None, router=None, key_schema=None, guard=None, metrics=None):
+    """
+    Transform a gzipped JSON file based on a transform spec. See
+    :func:`confluent.data.transformers.transform_usage_metrics` for the other params.
+
+    :param str input_file: Gzipped JSON file to read records from (one record per line)
+    :param str output_file: File to write transformed records to in the sink format
+    :param str spec_file: Path to transform spec JSON. See :func:`parse_transform_spec`
+    """
+    options = dict(spec_file=spec_file, select_fields=select_fields, exclude_fields=exclude_fields,
+                   json_codec=json_codec, compress_level=compress_level, buffer_size=buffer_size, engine=engine,
+                   sink_format=sink_format, sink_compression=sink_compression, key_schema=key_schema, guard=guard,
+                   metrics=metrics)
+
+    with gzip.open(input_file, 'rb') as input_fp:
+        if router:
+            _transform_with_spec_stream(input_fp, None, router=router, **options)
+        else:
+            with get_sink_format(sink_format).open(output_file, compress_level) as output_fp:
+                _transform_with_spec_stream(input_fp, output_fp, **options)
+
+
+def transform_with_spec_chunk(chunk, spec_file, select_fields=None, exclude_fields=None, json_codec=AUTO_JSON_CODEC,
+                              compress_level=DEFAULT_COMPRESS_LEVEL, buffer_size=DEFAULT_BUFFER_SIZE,
+                              engine=RECORD_ENGINE, sink_format=DEFAULT_SINK_FORMAT, sink_compression=None,
+                              key_schema=None, guard=None, metrics=None):
+    """
+    Same as :func:`transform_with_spec`, but for a chunk of decompressed lines from a large file that is split by
+    :class:`confluent.data.transformers.Transformer`. Only the default (json) sink format is supported.
+
+    :param bytes chunk: Decompressed JSON lines (one record per line)
+    :return: Gzip member with the transformed records that can be concatenated with others to form a gzip file
+    """
+    if sink_format != DEFAULT_SINK_FORMAT:
+        raise ValueError(f'Large files can not be split for the {sink_format} sink format')
+
+    member = io.BytesIO()
+
+    with gzip.GzipFile(fileobj=member, mode='wb', compresslevel=compress_level, mtime=0) as output_fp:
+        _transform_with_spec_stream(io.BytesIO(chunk), output_fp, spec_file, select_fields=select_fields,
+                                    exclude_fields=exclude_fields, json_codec=json_codec, buffer_size=buffer_size,
+                                    engine=engine, key_schema=key_schema, guard=guard, metrics=metrics)
+
+    return member.getvalue()
+
+
+def _transform_with_spec_stream(input_fp, output_fp, spec_file, select_fields=None, exclude_fields=None,
+                                json_codec=AUTO_JSON_CODEC, compress_level=DEFAULT_COMPRESS_LEVEL,
+                                buffer_size=DEFAULT_BUFFER_SIZE, engine=RECORD_ENGINE,
+                                sink_format=DEFAULT_SINK_FORMAT, sink_compression=None, router=None,
+                                key_schema=None, guard=None, metrics=None):
+    """ Transform records based on a transform spec from a binary file object of decompressed lines to another """
+    spec = parse_transform_spec(spec_file)
+    key_plan = spec.key_plan(select_fields, exclude_fields, track_types=key_schema is not None)
+    if key_schema is not None:
+        key_plan.preload(key_schema)
+    transform_records = spec.compile(engine, key_plan)
+    if metrics is None:
+        metrics = TransformMetrics()
+
+    transform_lines(input_fp, output_fp, transform_records, json_codec=json_codec, compress_level=compress_level,
+                    buffer_size=buffer_size, sink_format=sink_format, sink_compression=sink_compression,
+                    router=router, guard=guard, metrics=metrics)
+
+    if key_schema is not None:
+        metrics.key_schema = key_plan.key_schema()
+
+
+def _field_list(spec, spec_key):
+    fields = spec.get(spec_key) or []
+    if not isinstance(fields, list) or not all(isinstance(field, str) and field for field in fields):
+        raise ValueError(f'"{spec_key}" in transform spec must be a list of field names')
+    return fields
+
+
+def _field_dict(spec, spec_key):
+    fields = spec.get(spec_key) or {}
+    if not isinstance(fields, dict) or not all(field for field in fields):
+        raise ValueError(f'"{spec_key}" in transform spec must be an object with field names as keys')
+    return fields
+
+
+def _split_field(field):
+    """ (parent keys, key) for a dot separated field """
+    keys = tuple(field.split('.'))
+    return keys[:-1], keys[-1]
+
+
+def _parent(record, parent_keys):
+    """ Dict that has the field with the parent keys in the record, or None if it does not exist """
+    for key in parent_keys:
+        record = record.get(key)
+        if not isinstance(record, dict):
+            return None
+    return record
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
@@ -0,0 +1,165 @@
+import json
+import os
+
+
+#: BigQuery types of JSON values by their Python type
+BIGQUERY_TYPES = {str: 'STRING', int: 'INTEGER', float: 'FLOAT', bool: 'BOOLEAN', dict: 'RECORD', type(None): 'NULL'}
+
+#: Suffix of type names for arrays, e.g. STRING[] for an array of strings
+ARRAY_SUFFIX = '[]'
+
+
+def type_name(value_type):
+    """
+    Name of the BigQuery type for a value type learned by :class:`confluent.data.transformers.KeyPlan`
+
+    :param type|tuple value_type: Python type of a value, or (list, type of the first item) for arrays
+    :return: BigQuery type name, e.g. STRING, or STRING[] for arrays
+    """
+    if isinstance(value_type, tuple):
+        return type_name(value_type[1]) + ARRAY_SUFFIX
+    return BIGQUERY_TYPES.get(value_type, 'STRING')
+
+
+class KeySchema:
+    """
+    Raw key paths of transformed records with their sanitized (BigQuery-safe) names and value types. Each process
+    learns it while cleaning keys, and the parent process merges them and persists them in the sink dir, so the keys
+    are preloaded by workers on the next run and the schema covers files that were not transformed again.
+
+    It is also used to write a BigQuery JSON schema for loads and to detect raw keys that sanitize to the same name,
+    where one value overwrites the other.
+    """
+
+    def __init__(self):
+        #: Raw key path (tuple of raw keys) => (sanitized key, set of type names)
+        self.keys = {}
+
+    def add(self, raw_path, clean_key, types):
+        """
+        Add a key path or merge the types for a path that was added before
+
+        :param tuple raw_path: Raw keys from the top-level key to the key
+        :param str clean_key: Sanitized key
+        :param iter types: BigQuery type names of the values, see :func:`type_name`
+        """
+        if raw_path in self.keys:
+            self.keys[raw_path][1].update(types)
+        else:
+            self.keys[raw_path] = (clean_key, set(types))
+
+    def merge(self, other):
+        """ Add the key paths from another schema, e.g. from a worker """
+        for raw_path, (clean_key, types) in other.keys.items():
+            self.add(raw_path, clean_key, types)
+
+    def collisions(self):
+        """
+        Raw key paths that sanitize to the same path, e.g. `metric.pod-name` and `metric.pod/name`
+
+        :return: Dict of sanitized path => sorted list of raw paths (dot separated)
+        """
+        raw_paths = {}
+        for raw_path, clean_path in self._clean_paths().items():
+            raw_paths.setdefault('.'.join(clean_path), set()).add('.'.join(raw_path))
+
+        return {clean_path: sorted(paths) for clean_path, paths in sorted(raw_paths.items()) if len(paths) > 1}
+
+    def bigquery_schema(self):
+        """
+        BigQuery JSON schema for the transformed records with NULLABLE fields (or REPEATED for arrays). Keys that
+        collide have one field with the types of both. Fields with numbers are FLOAT if any value is a float, and
+        fields with other mixed types or records without known keys (e.g. in arrays) are JSON.
+
+        :return: List of fields sorted by name
+        """
+        types = {}
+        children = {}
+
+        for raw_path, clean_path in self._clean_paths().items():
+            types.setdefault(clean_path, set()).update(self.keys[raw_path][1])
+            children.setdefault(clean_path[:-1], set()).add(clean_path[-1])
+
+        def fields(parent_path):
+            return [field(parent_path + (name,)) for name in sorted(children.get(parent_path, ()))]
+
+        def field(clean_path):
+            array_types = set(t for t in types[clean_path] if t.endswith(ARRAY_SUFFIX))
+            value_types = types[clean_path] - array_types - {'NULL'}
+            mode = 'NULLABLE'
+
+            if array_types and not value_types:
+                mode = 'REPEATED'
+                value_types = set(t[:-len(ARRAY_SUFFIX)] for t in array_types) - {'NULL'}
+            else:
+                value_types |= array_types
+
+            schema_field = {'name': clean_path[-1], 'type': 'STRING', 'mode': mode}
+
+            if value_types == {'RECORD'}:
+                if clean_path in children:
+                    schema_field.update(type='RECORD', fields=fields(clean_path))
+                else:
+                    schema_field['type'] = 'JSON'
+            elif value_types == {'INTEGER', 'FLOAT'}:
+                schema_field['type'] = 'FLOAT'
+            elif len(value_types) == 1:
+                schema_field['type'] = value_types.pop()
+            elif value_types:
+                schema_field['type'] = 'JSON'
+
+            return schema_field
+
+        return fields(())
+
+    def save(self, path, settings=None):
+        """
+        Write the key paths to a JSON file
+
+        :param str path: File to write to
+        :param dict settings: Settings of the transform that the keys were learned with
+        """
+        keys = [[list(raw_path), clean_key, sorted(types)] for raw_path, (clean_key, types) in self.keys.items()]
+        with open(path, 'w') as fp:
+            json.dump({'settings': settings, 'keys': keys}, fp)
+
+    @classmethod
+    def load(cls, path, settings=None):
+        """
+        Read the key paths from a JSON file written by :meth:`save`
+
+        :param str path: File to read from
+        :param dict settings: Settings of the transform. Keys learned with other settings are not loaded.
+        :return: Schema with the key paths, which is empty if the file does not exist or the settings are different
+        """
+        schema = cls()
+        if not os.path.exists(path):
+            return schema
+
+        with open(path) as fp:
+            data = json.load(fp)
+
+        if data.get('settings') == settings:
+            for raw_path, clean_key, types in data['keys']:
+                schema.add(tuple(raw_path), clean_key, types)
+
+        return schema
+
+    def write_bigquery_schema(self, path):
+        """ Write the BigQuery JSON schema (see :meth:`bigquery_schema`) to a file, e.g. for `bq load --schema` """
+        with open(path, 'w') as fp:
+            json.dump(self.bigquery_schema(), fp, indent=2)
+
+    def _clean_paths(self):
+        """
+        :return: Dict of raw path => sanitized path for paths whose parents are known
+        """
+        clean_paths = {}
+
+        for raw_path in sorted(self.keys, key=len):
+            parent_path = clean_paths.get(raw_path[:-1], ()) if len(raw_path) > 1 else ()
+            if len(raw_path) > 1 and not parent_path:
+                continue
+            clean_paths[raw_path] = parent_path + (self.keys[raw_path][0],)
+
+        return clean_paths
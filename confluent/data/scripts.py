@@ -1,9 +1,22 @@
 import warnings
 
 import click
+import pytz
 
-from confluent.data.transformers import Transformer, transform_usage_metrics
-from confluent.data.admins import BigQueryAdmin
+from confluent.data.codecs import AUTO_JSON_CODEC, JSON_CODECS, get_json_codec
+from confluent.data.guards import RecordGuard
+from confluent.data.pipelines import parse_transform_spec, transform_with_spec, transform_with_spec_chunk
+from confluent.data.shards import DEFAULT_MAX_OPEN_FILES
+from confluent.data.sinks import DEFAULT_SINK_FORMAT, SINK_FORMATS, get_sink_format
+from confluent.data.transformers import (DEFAULT_BUFFER_SIZE, DEFAULT_COMPRESS_LEVEL, DEFAULT_TIMEZONE,
+                                         COLUMNAR_ENGINE, RECORD_ENGINE, TRANSFORM_ENGINES, Transformer, numpy,
+                                         transform_usage_metrics, transform_usage_metrics_chunk)
+from confluent.data.admins import DEFAULT_CONCURRENT_JOBS, BigQueryAdmin
+from confluent.data.async_admins import AsyncBigQueryAdmin
+
+
+#: Engine name => BigQuery admin class that runs the operations
+ADMIN_ENGINES = {'sync': BigQueryAdmin, 'async': AsyncBigQueryAdmin}
 
 
 ##############################################################################################################
@@ -20,48 +33,297 @@ def bq_admin():
     # service account credentials.
     warnings.filterwarnings('ignore', '.*authenticated using end user credential.*',)
 
+##############################################################################################################
+# Option validators
+
+
+def validate_timezone(ctx, param, value):
+    try:
+        pytz.timezone(value)
+        return value
+    except pytz.UnknownTimeZoneError:
+        raise click.BadParameter(f'Unknown timezone: {value}')
+
+
+def validate_json_codec(ctx, param, value):
+    try:
+        get_json_codec(value)
+        return value
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def validate_sink_format(ctx, param, value):
+    try:
+        get_sink_format(value)
+        return value
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def validate_transform_engine(ctx, param, value):
+    if value == COLUMNAR_ENGINE and numpy is None:
+        raise click.BadParameter('NumPy is required for the columnar engine. Please install it: pip install numpy')
+    return value
+
+
+def check_sink_options(sink_format, sink_compression, split_size):
+    """
+    Check the sink compression and split size are supported by the sink format
+
+    :return: Sink class for the format
+    """
+    sink = get_sink_format(sink_format)
+    try:
+        sink.check_compression(sink_compression)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--sink-compression')
+    if split_size and sink_format != DEFAULT_SINK_FORMAT:
+        raise click.BadParameter(f'Large files can not be split for the {sink_format} sink format',
+                                 param_hint='--split-size')
+    return sink
+
+
+def record_guard(max_record_size, max_depth, max_memory):
+    """ Record guard for the limits from the options, or None if none are set """
+    if max_record_size or max_depth or max_memory:
+        return RecordGuard(max_record_size=max_record_size, max_depth=max_depth, max_memory=max_memory)
+
+
+##############################################################################################################
+# Shared options
+
+
+#: Options of the commands that transform data files with a :class:`Transformer`
+TRANSFORMER_OPTIONS = [
+    click.option('--source-dir', default='data', help='Directory to read data files from'),
+    click.option('--sink-dir', default='transformed-data', help='Directory to write transformed data files to'),
+    click.option('--path-contains', help='Only process paths that contains the provided value'),
+    click.option('--processes', type=click.IntRange(1),
+                 help='Number of parallel processes to use. Defaults to the number of CPUs.'),
+    click.option('--split-size', type=click.IntRange(1),
+                 help='Split data files larger than this (in bytes) into chunks that are transformed in parallel'),
+    click.option('--manifest/--no-manifest', default=True, show_default=True,
+                 help='Use a manifest in the sink dir to only transform new, changed, or stale data files. Without '
+                      'it, data files are skipped if their output exists.'),
+    click.option('--json-codec', default=AUTO_JSON_CODEC, type=click.Choice([AUTO_JSON_CODEC] + list(JSON_CODECS)),
+                 callback=validate_json_codec, show_default=True,
+                 help='JSON codec to decode/encode records with. Auto picks the fastest one that is installed.'),
+    click.option('--compress-level', default=DEFAULT_COMPRESS_LEVEL, type=click.IntRange(0, 9), show_default=True,
+                 help='Gzip compression level for transformed data files (deflate level for avro)'),
+    click.option('--buffer-size', default=DEFAULT_BUFFER_SIZE, type=click.IntRange(1), show_default=True,
+                 help='Size in bytes of decompressed data blocks to read and transform at a time'),
+    click.option('--engine', default=RECORD_ENGINE, type=click.Choice(TRANSFORM_ENGINES),
+                 callback=validate_transform_engine, show_default=True,
+                 help='Transform one record at a time, or a block of records at a time as columns with NumPy'),
+    click.option('--sink-format', default=DEFAULT_SINK_FORMAT, type=click.Choice(list(SINK_FORMATS)),
+                 callback=validate_sink_format, show_default=True,
+                 help='Format to write transformed data files in: gzipped JSON lines, Parquet with a row group per '
+                      'block of records, or Avro. The schema for Parquet/Avro is inferred from the records.'),
+    click.option('--sink-compression',
+                 help='Compression codec for the sink format. Parquet supports snappy (default), zstd, gzip, and '
+                      'none. Avro supports deflate (default) and null.'),
+    click.option('--schema', is_flag=True,
+                 help='Write a BigQuery JSON schema of the transformed records to the sink dir and report raw keys '
+                      'that sanitize to the same key. Keys are cached in the sink dir and preloaded on later runs.'),
+    click.option('--max-record-size', type=click.IntRange(1),
+                 help='Quarantine records (JSON lines) larger than this (in bytes) instead of transforming them'),
+    click.option('--max-depth', type=click.IntRange(1),
+                 help='Quarantine records with dicts/lists nested deeper than this instead of transforming them'),
+    click.option('--max-memory', type=click.IntRange(1),
+                 help='Fail a data file when the memory of the process that transforms it exceeds this (in bytes), '
+                      'instead of the process being killed by the OS'),
+    click.option('--quarantine-dir',
+                 help='Directory to write quarantined records to. Defaults to the sink dir with a "-quarantine" '
+                      'suffix.'),
+]
+
+
+def transformer_options(command):
+    """ Decorator that adds :data:`TRANSFORMER_OPTIONS` to the command in the listed order """
+    for option in reversed(TRANSFORMER_OPTIONS):
+        command = option(command)
+    return command
+
+
+#: Option of the commands that make API calls with a :class:`BigQueryAdmin`
+ADMIN_ENGINE_OPTION = click.option('--engine', default='sync', type=click.Choice(list(ADMIN_ENGINES)),
+                                   show_default=True,
+                                   help='Run API calls one at a time (sync), or concurrently with rate limiting and '
+                                        'retries (async)')
+
+#: Options of the commands that copy tables with a :class:`BigQueryAdmin`
+COPY_OPTIONS = [
+    click.option('--concurrent-jobs', default=DEFAULT_CONCURRENT_JOBS, type=click.IntRange(1), show_default=True,
+                 help='Maximum number of table copy jobs to run at the same time'),
+    click.option('--resume', is_flag=True, help='Resume an interrupted copy/move from its checkpoint(s)'),
+    ADMIN_ENGINE_OPTION,
+    click.option('--batch-size', default=1, type=click.IntRange(1), show_default=True,
+                 help='Number of tables to copy per job. More than one table are copied by a script with a '
+                      '`CREATE TABLE ... COPY` statement per table to save per-job overhead and quota for small '
+                      'tables.'),
+]
+
+
+def copy_options(command):
+    """ Decorator that adds :data:`COPY_OPTIONS` to the command in the listed order """
+    for option in reversed(COPY_OPTIONS):
+        command = option(command)
+    return command
+
+
 ##############################################################################################################
 # Commands for scripts
 
 
 @transform.command(help='Replace invalid chars in keys and remove useless fields')
-@click.option('--source-dir', default='data', help='Directory to read data files from')
-@click.option('--sink-dir', default='transformed-data', help='Directory to write transformed data files to')
-@click.option('--path-contains', help='Only process paths that contains the provided value')
+@transformer_options
 @click.option('--select-fields', default='-metric.another',
               help='Comma separated list of fields to extract. Use a dot for nested fields. '
                    'To exclude a field, prefix it with a negative sign ("-").')
-def usage_metrics(source_dir, sink_dir, path_contains, select_fields):
+@click.option('--timezone', default=DEFAULT_TIMEZONE, callback=validate_timezone, show_default=True,
+              help='Timezone for the localized datetime_pt/date_pt fields')
+@click.option('--stdin', is_flag=True,
+              help='Read JSON lines (gzipped or not) from stdin instead of the source dir. Requires --stdout.')
+@click.option('--stdout', is_flag=True,
+              help='Write gzipped JSON lines to stdout instead of the sink dir. Requires --stdin.')
+@click.option('--compact-size', type=click.IntRange(1),
+              help='After the transform, pack transformed data files into shards of about this size (in bytes) in '
+                   '--compact-dir, e.g. 268435456 for 256 MB shards')
+@click.option('--compact-dir',
+              help='Directory to write shards to. Defaults to the sink dir with a "-compacted" suffix.')
+@click.option('--partition-by',
+              help='Partition shards into "<field>=<value>" sub-dirs by the value of this field, e.g. date_pt. '
+                   'Requires --compact-size.')
+@click.option('--route-by',
+              help='Write transformed records into "<field>=<value>" sub-dirs of the sink dir by the value of this '
+                   'field, e.g. date_pt, so each transformed data file has records for one partition')
+@click.option('--max-open-files', default=DEFAULT_MAX_OPEN_FILES, type=click.IntRange(1), show_default=True,
+              help='Maximum number of open files per process when routing records with --route-by')
+def usage_metrics(source_dir, sink_dir, path_contains, processes, split_size, manifest, select_fields, timezone,
+                  json_codec, compress_level, buffer_size, engine, sink_format, sink_compression, stdin, stdout,
+                  compact_size, compact_dir, partition_by, route_by, max_open_files, schema, max_record_size, max_depth,
+                  max_memory, quarantine_dir):
+    if stdin != stdout:
+        raise click.UsageError('--stdin and --stdout must be used together')
+    if partition_by and not compact_size:
+        raise click.UsageError('--partition-by requires --compact-size')
+    if compact_size and (stdin or sink_format != DEFAULT_SINK_FORMAT):
+        raise click.UsageError('--compact-size only supports gzipped JSON lines written to the sink dir')
+    if stdin and route_by:
+        raise click.UsageError('--route-by can not be used with --stdout')
+    if stdin and schema:
+        raise click.UsageError('--schema can not be used with --stdout')
+    if stdin and sink_format != DEFAULT_SINK_FORMAT:
+        raise click.BadParameter(f'Streaming to stdout is not supported for the {sink_format} sink format',
+                                 param_hint='--sink-format')
+
+    sink = check_sink_options(sink_format, sink_compression, split_size)
+
     if select_fields:
         select_fields = set(select_fields.split(','))
-    transformer = Transformer(transform_usage_metrics, source_dir, sink_dir, path_contains=path_contains,
-                              select_fields=select_fields)
+    try:
+        transformer = Transformer(transform_usage_metrics, source_dir, sink_dir, path_contains=path_contains,
+                                  select_fields=select_fields, parallel_processes=processes, split_size=split_size,
+                                  chunk_transform=transform_usage_metrics_chunk, use_manifest=manifest,
+                                  output_extension=None if sink_format == DEFAULT_SINK_FORMAT else sink.EXTENSION,
+                                  compact_size=compact_size, compact_dir=compact_dir, partition_field=partition_by,
+                                  route_field=route_by, max_open_files=max_open_files, schema=schema,
+                                  record_guard=record_guard(max_record_size, max_depth, max_memory),
+                                  quarantine_dir=quarantine_dir,
+                                  transform_options={'timezone': timezone, 'json_codec': json_codec,
+                                                     'compress_level': compress_level, 'buffer_size': buffer_size,
+                                                     'engine': engine, 'sink_format': sink_format,
+                                                     'sink_compression': sink_compression})
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if stdin:
+        transformer.transform_stream(click.get_binary_stream('stdin'), click.get_binary_stream('stdout'))
+    else:
+        transformer.transform()
+
+
+@transform.command(help='Transform data files based on a transform spec JSON file that declares the fields to drop, '
+                        'rename, round, derive, and select. See `confluent/data/pipelines.py` for the JSON schema')
+@click.option('--spec', required=True, type=click.Path(exists=True, dir_okay=False),
+              help='Path to the transform spec JSON file')
+@transformer_options
+def run(spec, source_dir, sink_dir, path_contains, processes, split_size, manifest, json_codec, compress_level,
+        buffer_size, engine, sink_format, sink_compression, schema, max_record_size, max_depth, max_memory,
+        quarantine_dir):
+    try:
+        transform_spec = parse_transform_spec(spec)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--spec')
+
+    sink = check_sink_options(sink_format, sink_compression, split_size)
+
+    try:
+        transformer = Transformer(transform_with_spec, source_dir, sink_dir, path_contains=path_contains,
+                                  parallel_processes=processes, split_size=split_size,
+                                  chunk_transform=transform_with_spec_chunk, use_manifest=manifest,
+                                  output_extension=None if sink_format == DEFAULT_SINK_FORMAT else sink.EXTENSION,
+                                  schema=schema, settings={'spec': transform_spec.to_dict()},
+                                  record_guard=record_guard(max_record_size, max_depth, max_memory),
+                                  quarantine_dir=quarantine_dir,
+                                  transform_options={'spec_file': spec, 'json_codec': json_codec,
+                                                     'compress_level': compress_level, 'buffer_size': buffer_size,
+                                                     'engine': engine, 'sink_format': sink_format,
+                                                     'sink_compression': sink_compression})
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
     transformer.transform()
 
 
 @bq_admin.command(help='Move a dataset from one project to another')
 @click.argument('from_dataset')
 @click.argument('to_project_or_dataset')
-def move_dataset(from_dataset, to_project_or_dataset):
+@copy_options
+def move_dataset(from_dataset, to_project_or_dataset, concurrent_jobs, resume, engine, batch_size):
     print(f'Moving {from_dataset} to {to_project_or_dataset}')
 
-    admin = BigQueryAdmin()
-    admin.move_dataset(from_dataset, to_project_or_dataset)
+    admin = ADMIN_ENGINES[engine]()
+    admin.move_dataset(from_dataset, to_project_or_dataset, max_concurrent_jobs=concurrent_jobs, resume=resume,
+                       batch_size=batch_size)
 
 
 @bq_admin.command(help='Copy a dataset from one project to another. This will skip/continue on unsupported tables.')
 @click.argument('from_dataset')
 @click.argument('to_project_or_dataset')
-def copy_dataset(from_dataset, to_project_or_dataset):
+@copy_options
+def copy_dataset(from_dataset, to_project_or_dataset, concurrent_jobs, resume, engine, batch_size):
     print(f'Copying {from_dataset} to {to_project_or_dataset}')
 
-    admin = BigQueryAdmin()
-    admin.copy_dataset(from_dataset, to_project_or_dataset, error_on_unsupported=False)
+    admin = ADMIN_ENGINES[engine]()
+    admin.copy_dataset(from_dataset, to_project_or_dataset, error_on_unsupported=False,
+                       max_concurrent_jobs=concurrent_jobs, resume=resume, batch_size=batch_size)
+
+
+@bq_admin.command(help='Copy all datasets (or those that match --datasets) from one project to another. All table '
+                       'copies are run by one shared job scheduler, so --concurrent-jobs applies across all datasets, '
+                       'and views are created last. '
+                       'This will skip/continue on unsupported tables.')
+@click.argument('from_project')
+@click.argument('to_project')
+@click.option('--datasets', default='*', show_default=True, help='Only copy datasets that match this glob pattern')
+@copy_options
+def copy_project(from_project, to_project, datasets, concurrent_jobs, resume, engine, batch_size):
+    print(f'Copying datasets matching {datasets} from {from_project} to {to_project}')
+
+    admin = ADMIN_ENGINES[engine]()
+    try:
+        admin.copy_project(from_project, to_project, dataset_pattern=datasets, error_on_unsupported=False,
+                           max_concurrent_jobs=concurrent_jobs, resume=resume, batch_size=batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
 
 @bq_admin.command(help='Create table views based on a view specifications JSON file. '
                        'See `confluent/data/specs.py` for the JSON schema')
 @click.argument('view_specs_json_file')
-def create_views(view_specs_json_file):
-    admin = BigQueryAdmin()
+@ADMIN_ENGINE_OPTION
+def create_views(view_specs_json_file, engine):
+    admin = ADMIN_ENGINES[engine]()
     admin.create_views(view_specs_json_file)
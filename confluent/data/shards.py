@@ -0,0 +1,373 @@
+from collections import OrderedDict
+import glob
+import gzip
+import json
+import os
+import re
+import shutil
+
+
+#: Partition name for records without a value for the partition field (same as Hive)
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+#: Default maximum number of files that a :class:`PartitionRouter` keeps open
+DEFAULT_MAX_OPEN_FILES = 64
+
+
+class ShardWriter:
+    """
+    Writes gzipped data to numbered shards of a target size in a directory. Each shard is written to a temp file and
+    renamed when it is done, so a shard is either complete or does not exist.
+    """
+
+    def __init__(self, shard_dir, target_size, extension='.json.gz', compress_level=9):
+        """
+        :param str shard_dir: Directory to write shards to
+        :param int target_size: Shards are completed once they reach this size (in bytes of compressed data)
+        :param str extension: Extension of shard files
+        :param int compress_level: Gzip compression level for data written with :meth:`write`
+        """
+        self.shard_dir = shard_dir
+        self.target_size = target_size
+        self.extension = extension
+        self.compress_level = compress_level
+
+        #: Paths of completed shards
+        self.shards = []
+
+        self._fp = None
+        self._gzip_fp = None
+        self._temp_file = None
+
+    @property
+    def size(self):
+        """ Size of the current shard so far """
+        return self._fp.tell() if self._fp else 0
+
+    def write(self, data):
+        """
+        Compress and write data to the current shard, and complete it if it reached the target size
+
+        :param bytes data: Decompressed data, e.g. JSON lines
+        """
+        if not self._fp:
+            self._open()
+        if not self._gzip_fp:
+            self._gzip_fp = gzip.GzipFile(fileobj=self._fp, mode='wb', compresslevel=self.compress_level, mtime=0)
+
+        self._gzip_fp.write(data)
+
+        if self.size >= self.target_size:
+            self.finish()
+
+    def write_file(self, path):
+        """
+        Copy a gzip file as is to the current shard as gzip members can be concatenated. A new shard is started first
+        if the file doesn't fit in the current one.
+
+        :param str path: Gzip file to copy
+        """
+        if self._fp and self.size + os.path.getsize(path) > self.target_size:
+            self.finish()
+
+        if not self._fp:
+            self._open()
+        self._close_gzip()
+
+        with open(path, 'rb') as fp:
+            shutil.copyfileobj(fp, self._fp)
+
+        if self.size >= self.target_size:
+            self.finish()
+
+    def finish(self):
+        """ Complete the current shard by renaming its temp file """
+        if not self._fp:
+            return
+
+        self._close_gzip()
+        self._fp.close()
+        self._fp = None
+
+        shard_file = os.path.join(self.shard_dir, os.path.basename(self._temp_file)[1:])
+        os.rename(self._temp_file, shard_file)
+        self.shards.append(shard_file)
+
+    def abort(self):
+        """ Remove the temp file of the current shard """
+        if not self._fp:
+            return
+
+        self._fp.close()
+        self._fp = None
+        self._gzip_fp = None
+
+        try:
+            os.unlink(self._temp_file)
+        except Exception:
+            pass
+
+    def _open(self):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        shard_name = f'part-{len(self.shards):05d}{self.extension}'
+        self._temp_file = os.path.join(self.shard_dir, '.' + shard_name)
+        self._fp = open(self._temp_file, 'wb')
+
+    def _close_gzip(self):
+        if self._gzip_fp:
+            self._gzip_fp.close()
+            self._gzip_fp = None
+
+
+class PartitionRouter:
+    """
+    Routes data for a data file to gzip files in `<field>=<value>` sub-dirs of the sink dir by the value of the
+    partition field, e.g. `sink_dir/date_pt=2019-03-10/path/to/data.json.gz`, so each output file has records for one
+    partition.
+
+    Open files are cached with a LRU limit to bound the number of open descriptors. When a file that was closed is
+    written to again, it is reopened in append mode, which adds a gzip member. Files are written to temp files that are
+    renamed by :meth:`commit`, so each output file is complete. Outputs of the data file in other partitions from a
+    previous transform are removed once the new outputs are in place, so an interrupted commit can leave stale
+    outputs (which are removed when the data file is transformed again) but never loses the records of the data file.
+    """
+
+    def __init__(self, sink_dir, relative_path, field, max_open_files=DEFAULT_MAX_OPEN_FILES, compress_level=9):
+        """
+        :param str sink_dir: Directory to write partitioned outputs to
+        :param str relative_path: Path of the output file relative to the partition sub-dir
+        :param str field: Name of the partition field
+        :param int max_open_files: Maximum number of files to keep open
+        :param int compress_level: Gzip compression level
+        """
+        self.sink_dir = sink_dir
+        self.relative_path = relative_path
+        self.field = field
+        self.max_open_files = max_open_files
+        self.compress_level = compress_level
+
+        #: Partition value => (temp file, output file) for all partitions written to
+        self.partition_files = {}
+
+        #: Number of times that a file was reopened after it was closed to stay within the LRU limit
+        self.reopens = 0
+
+        #: Partition value => open gzip file in least recently used order
+        self._open_files = OrderedDict()
+
+    def write(self, value, data):
+        """
+        Write data to the output file for the partition
+
+        :param value: Value of the partition field
+        :param bytes data: Decompressed data, e.g. JSON lines
+        """
+        fp = self._open_files.pop(value, None)
+        if fp is None:
+            fp = self._open(value)
+
+        self._open_files[value] = fp
+        fp.write(data)
+
+    def commit(self):
+        """
+        Close all files and rename temp files to the output files, and then remove outputs of the data file in other
+        partitions from a previous transform
+
+        :return: Total size of the output files
+        """
+        self._close()
+
+        size = 0
+        for temp_file, output_file in self.partition_files.values():
+            size += os.path.getsize(temp_file)
+            os.rename(temp_file, output_file)
+
+        output_files = set(output_file for _, output_file in self.partition_files.values())
+        for output_file in partitioned_files(self.sink_dir, self.field, self.relative_path):
+            if output_file not in output_files:
+                os.unlink(output_file)
+
+        return size
+
+    def abort(self):
+        """ Close all files and remove the temp files """
+        self._close()
+
+        for temp_file, _ in self.partition_files.values():
+            try:
+                os.unlink(temp_file)
+            except Exception:
+                pass
+
+    def _open(self, value):
+        if len(self._open_files) >= self.max_open_files:
+            _, fp = self._open_files.popitem(last=False)
+            fp.close()
+
+        if value in self.partition_files:
+            self.reopens += 1
+            return gzip.open(self.partition_files[value][0], 'ab', compresslevel=self.compress_level)
+
+        output_file = os.path.join(self.sink_dir, partition_name(self.field, value), self.relative_path)
+        temp_file = os.path.join(os.path.dirname(output_file), '.' + os.path.basename(output_file))
+        os.makedirs(os.path.dirname(temp_file), exist_ok=True)
+        self.partition_files[value] = (temp_file, output_file)
+
+        return gzip.open(temp_file, 'wb', compresslevel=self.compress_level)
+
+    def _close(self):
+        while self._open_files:
+            self._open_files.popitem()[1].close()
+
+
+def partitioned_files(sink_dir, field, relative_path):
+    """
+    Output files for the relative path in all `<field>=<value>` sub-dirs of the sink dir
+
+    :param str sink_dir: Directory with partition sub-dirs
+    :param str field: Name of the partition field
+    :param str relative_path: Path of the output file relative to the partition sub-dir
+    :return: List of paths of output files
+    """
+    return glob.glob(os.path.join(glob.escape(sink_dir), glob.escape(field) + '=*', glob.escape(relative_path)))
+
+
+def partition_name(field, value):
+    """
+    Name of the sub-dir for the partition in `<field>=<value>` format (Hive partitioning layout)
+
+    :param str field: Name of the partition field
+    :param value: Value of the partition field for a record
+    """
+    if value is None or value == '':
+        value = DEFAULT_PARTITION
+    return f'{field}={str(value).replace(os.sep, "_")}'
+
+
+def shard_files(compact_dir, extension='.json.gz'):
+    """
+    Shards in the compact dir and its `<field>=<value>` sub-dirs, i.e. files named like `part-NNNNN.json.gz` as
+    written by :class:`ShardWriter`. Other files are not shards, so they are never touched by compaction.
+
+    :param str compact_dir: Directory with shards
+    :param str extension: Extension of shard files
+    :return: List of paths of shards
+    """
+    shard_name_re = re.compile(r'part-\d{5,}' + re.escape(extension) + '$')
+    paths = []
+
+    for dirpath, dirnames, filenames in os.walk(compact_dir):
+        if dirpath == compact_dir:
+            dirnames[:] = [dirname for dirname in dirnames if '=' in dirname and not dirname.startswith('.')]
+        else:
+            dirnames[:] = []
+
+        paths.extend(os.path.join(dirpath, filename) for filename in filenames if shard_name_re.match(filename))
+
+    return paths
+
+
+def remove_stale_shards(compact_dir, shards, extension='.json.gz', partitions=None):
+    """
+    Remove shards in the compact dir that are not the given shards (e.g. from a previous compaction), and partition
+    dirs that are empty afterwards. Files that are not named like shards are kept.
+
+    :param str compact_dir: Directory with shards
+    :param set[str] shards: Paths of shards to keep
+    :param str extension: Extension of shard files
+    :param set[str]|None partitions: Only remove shards in these partitions, i.e. names of `<field>=<value>` sub-dirs
+                                     or an empty name for the compact dir itself. Defaults to all of them.
+    """
+    for path in shard_files(compact_dir, extension):
+        if partitions is not None and shard_partition(compact_dir, path) not in partitions:
+            continue
+
+        if path not in shards:
+            os.unlink(path)
+
+            dirpath = os.path.dirname(path)
+            if dirpath != compact_dir and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+
+def publish_shards(staging_dir, compact_dir, extension='.json.gz', partitions=None):
+    """
+    Swap the shards in the staging dir in for the shards in the compact dir once all of them are written, so a
+    compaction that fails partway leaves the previous shards as they were. Previous shards are removed before the new
+    ones are renamed into place, so an interrupted swap can leave fewer records but never duplicates them. The staging
+    dir is removed afterwards.
+
+    :param str staging_dir: Directory with the new shards, laid out like the compact dir
+    :param str compact_dir: Directory with shards
+    :param str extension: Extension of shard files
+    :param set[str]|None partitions: Only replace the shards of these partitions (see :func:`remove_stale_shards`),
+                                     e.g. when only they were compacted again. Defaults to all of them.
+    :return: List of paths of the new shards in the compact dir
+    """
+    staged_shards = sorted(shard_files(staging_dir, extension))
+    shards = [os.path.join(compact_dir, os.path.relpath(shard, staging_dir)) for shard in staged_shards]
+
+    remove_stale_shards(compact_dir, set(), extension, partitions=partitions)
+    for staged_shard, shard in zip(staged_shards, shards):
+        os.makedirs(os.path.dirname(shard), exist_ok=True)
+        os.rename(staged_shard, shard)
+
+    shutil.rmtree(staging_dir)
+
+    return shards
+
+
+def shard_partition(compact_dir, path):
+    """
+    :param str compact_dir: Directory with shards
+    :param str path: Path of a shard in the compact dir
+    :return: Name of the `<field>=<value>` sub-dir of the shard, or an empty name if it is in the compact dir itself
+    """
+    partition = os.path.relpath(os.path.dirname(path), compact_dir)
+    return '' if partition == os.curdir else partition
+
+
+class CompactionIndex:
+    """
+    Output files that were compacted with their size, modified time, and the partitions that their records went to,
+    stored as JSON in the compact dir. This is used to only compact the partitions fed by output files that changed
+    since the last compaction.
+    """
+
+    #: Name of the index file in the compact dir
+    FILE_NAME = '.compaction-index.json'
+
+    def __init__(self, compact_dir, settings):
+        """
+        :param str compact_dir: Directory with shards. The index is stored there.
+        :param dict settings: Compaction settings (e.g. shard size). Outputs compacted with other settings are not
+                              loaded. Must be JSON serializable.
+        """
+        self.path = os.path.join(compact_dir, self.FILE_NAME)
+        self.settings = settings
+
+        #: Relative path of output file => (size, mtime_ns, list of partitions) from the last compaction, or None if
+        #: there is no index for the settings
+        self.outputs = None
+
+        if os.path.exists(self.path):
+            with open(self.path) as fp:
+                data = json.load(fp)
+
+            if data.get('settings') == settings:
+                self.outputs = {path: (size, mtime_ns, partitions)
+                                for path, (size, mtime_ns, partitions) in data['outputs'].items()}
+
+    def save(self, outputs):
+        """
+        Write the index for a compaction that completed
+
+        :param dict outputs: Relative path of output file => (size, mtime_ns, list of partitions) for all outputs
+        """
+        temp_file = os.path.join(os.path.dirname(self.path), '.' + os.path.basename(self.path) + '.tmp')
+        with open(temp_file, 'w') as fp:
+            json.dump({'settings': self.settings, 'outputs': outputs}, fp)
+        os.replace(temp_file, self.path)
+
+        self.outputs = outputs
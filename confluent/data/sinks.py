@@ -0,0 +1,373 @@
+import gzip
+import shutil
+import tempfile
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+try:
+    import fastavro
+    import fastavro.write
+except ImportError:  # pragma: no cover
+    fastavro = None
+
+from confluent.data.codecs import AUTO_JSON_CODEC, get_json_codec
+
+
+class AbstractSink:
+    """
+    Abstract sink that writes batches of transformed records to a binary file object in a format for all sink formats.
+
+    Batches are written in two steps, :meth:`serialize` and :meth:`write`, so the time spent serializing records and
+    compressing/writing them can be measured separately.
+    """
+
+    #: Name of the sink format
+    NAME = None
+
+    #: Extension for output files in the format
+    EXTENSION = None
+
+    #: Packages to install to make the sink format available
+    PACKAGES = ()
+
+    #: Modules that provide the sink format
+    MODULES = ()
+
+    #: Compression codecs that are supported with the default first
+    COMPRESSIONS = ()
+
+    def __init__(self, fp, compression=None, compress_level=None, json_codec=AUTO_JSON_CODEC):
+        """
+        :param fp: Binary file object to write to, which is opened by :meth:`open`
+        :param str compression: Compression codec from :attr:`COMPRESSIONS`. Defaults to the first one.
+        :param int compress_level: Compression level for codecs that support it
+        :param str json_codec: Name of the JSON codec for formats that serialize records as JSON
+        """
+        self.fp = fp
+        self.compression = compression or self.COMPRESSIONS[0]
+        self.compress_level = compress_level
+        self.json_codec = json_codec
+
+    @classmethod
+    def is_available(cls):
+        """ True if the modules that provide the sink format are installed """
+        return all(module is not None for module in cls.MODULES)
+
+    @classmethod
+    def check_compression(cls, compression):
+        """
+        :param str|None compression: Compression codec to check
+        :raises ValueError: If the compression codec is not supported by the sink format
+        """
+        if compression and compression not in cls.COMPRESSIONS:
+            raise ValueError(f'Compression {compression} is not supported by the {cls.NAME} sink format. '
+                             f'Supported: {", ".join(cls.COMPRESSIONS)}')
+
+    @classmethod
+    def open(cls, output_file, compress_level=None):
+        """
+        Open the output file to write to
+
+        :param str output_file: Path of the output file
+        :param int compress_level: Compression level for formats that compress the whole file
+        :return: Binary file object
+        """
+        return open(output_file, 'wb')
+
+    def serialize(self, records):
+        """
+        :param list[dict] records: Batch of transformed records
+        :return: Serialized batch to pass to :meth:`write`
+        """
+        raise NotImplementedError('Sub-class should implement to return the serialized batch')
+
+    def write(self, data):
+        """
+        :param data: Serialized batch from :meth:`serialize` to write to the file object
+        """
+        raise NotImplementedError('Sub-class should implement to write the serialized batch')
+
+    def close(self):
+        """ Write any footer. The file object is not closed as it is owned by the caller. """
+
+
+class JSONSink(AbstractSink):
+    """ Sink that writes records as newline delimited JSON to a gzip file, which is always available """
+
+    NAME = 'json'
+    EXTENSION = '.json.gz'
+    COMPRESSIONS = ('gzip',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dumps = get_json_codec(self.json_codec).dumps
+
+    @classmethod
+    def open(cls, output_file, compress_level=None):
+        return gzip.open(output_file, 'wb', compresslevel=9 if compress_level is None else compress_level)
+
+    def serialize(self, records):
+        serialized_records = [self._dumps(record) for record in records]
+        serialized_records.append(b'')
+        return b'\n'.join(serialized_records)
+
+    def write(self, data):
+        self.fp.write(data)
+
+
+class ArrowSink(AbstractSink):
+    """
+    Abstract sink for columnar formats with an Arrow schema that is inferred from the records. Each batch is converted
+    to an Arrow table with its own inferred types and cast to the schema without losing data (e.g. a float is never
+    truncated to an int).
+
+    When a later batch has new fields or values that need a wider type (e.g. floats for a field that only had ints),
+    the schema evolves: batches written so far are spilled to a temp file and rewritten with the final schema by
+    :meth:`close`, so each evolution costs a copy of the output so far. Values that can not share a type (e.g. a
+    string and an int) are an error.
+    """
+
+    #: Number of records per batch to read back from spill files
+    SPILL_BATCH_SIZE = 10000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        #: Arrow schema of all records so far
+        self.schema = None
+
+        self._writer = None
+        self._writer_schema = None
+
+        #: List of (temp file, schema) with the batches that were written before the schema evolved
+        self._spills = []
+
+    @classmethod
+    def open(cls, output_file, compress_level=None):
+        # Readable to spill the batches written so far when the schema evolves
+        return open(output_file, 'w+b')
+
+    def serialize(self, records):
+        table = pyarrow.Table.from_pylist(records)
+
+        if self.schema is None:
+            self.schema = table.schema
+
+        elif not table.schema.equals(self.schema):
+            try:
+                self.schema = pyarrow.unify_schemas([self.schema, table.schema], promote_options='permissive')
+                table = conform_table(table, self.schema)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as e:
+                raise ValueError(f'Records do not match the schema of earlier records: {e}')
+
+        return self._serialize_table(table)
+
+    def write(self, data):
+        if self._writer is not None and not self._writer_schema.equals(self.schema):
+            self._spill()
+
+        if self._writer is None:
+            self._writer_schema = self.schema
+            self._open_writer(self.schema)
+
+        self._write(data)
+
+    def close(self):
+        if self._spills:
+            if self._writer is not None:
+                self._spill()
+
+            self._open_writer(self.schema)
+            for spill_fp, schema in self._spills:
+                for table in self._read_spill(spill_fp, schema):
+                    self._write(self._serialize_table(conform_table(table, self.schema)))
+                spill_fp.close()
+            self._spills = []
+
+        elif self._writer is None:
+            self._open_writer(self.schema or pyarrow.schema([]))
+
+        self._close_writer()
+
+    def _spill(self):
+        """ Move the batches written so far to a temp file to rewrite them with the final schema later """
+        self._close_writer()
+        self._writer = None
+
+        spill_fp = tempfile.TemporaryFile()
+        self.fp.seek(0)
+        shutil.copyfileobj(self.fp, spill_fp)
+        spill_fp.seek(0)
+        self.fp.seek(0)
+        self.fp.truncate()
+
+        self._spills.append((spill_fp, self._writer_schema))
+
+    def _serialize_table(self, table):
+        """ Serialized batch to pass to :meth:`_write` from a table with the schema """
+        return table
+
+    def _open_writer(self, schema):
+        """ Open a writer for the schema that writes to the file object """
+        raise NotImplementedError('Sub-class should implement to open the writer')
+
+    def _write(self, data):
+        """ Write the serialized batch with the writer """
+        raise NotImplementedError('Sub-class should implement to write the serialized batch')
+
+    def _close_writer(self):
+        """ Write any footer of the writer without closing the file object """
+        raise NotImplementedError('Sub-class should implement to close the writer')
+
+    def _read_spill(self, fp, schema):
+        """ Iterate over the batches in a spill file as tables with the given schema """
+        raise NotImplementedError('Sub-class should implement to read spill files')
+
+
+class ParquetSink(ArrowSink):
+    """ Sink that writes each batch of records as a row group to a Parquet file using `pyarrow` """
+
+    NAME = 'parquet'
+    EXTENSION = '.parquet'
+    PACKAGES = ('pyarrow',)
+    MODULES = (pyarrow,)
+    COMPRESSIONS = ('snappy', 'zstd', 'gzip', 'none')
+
+    def _open_writer(self, schema):
+        self._writer = pyarrow.parquet.ParquetWriter(self.fp, schema, compression=self.compression)
+
+    def _write(self, table):
+        self._writer.write_table(table)
+
+    def _close_writer(self):
+        self._writer.close()
+
+    def _read_spill(self, fp, schema):
+        parquet_file = pyarrow.parquet.ParquetFile(fp)
+        for row_group in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(row_group)
+
+
+class AvroSink(ArrowSink):
+    """
+    Sink that writes each batch of records as a block to an Avro file using `fastavro`. The Avro schema is converted
+    from the Arrow schema with all fields nullable.
+    """
+
+    NAME = 'avro'
+    EXTENSION = '.avro'
+    PACKAGES = ('pyarrow', 'fastavro')
+    MODULES = (pyarrow, fastavro)
+    COMPRESSIONS = ('deflate', 'null')
+
+    def _serialize_table(self, table):
+        # Records are normalized by the Arrow table so missing fields are written as nulls
+        return table.to_pylist()
+
+    def _open_writer(self, schema):
+        self._writer = fastavro.write.Writer(self.fp, fastavro.parse_schema(avro_schema(schema)),
+                                             codec=self.compression, compression_level=self.compress_level)
+
+    def _write(self, records):
+        for record in records:
+            self._writer.write(record)
+        self._writer.flush()
+
+    def _close_writer(self):
+        self._writer.flush()
+
+    def _read_spill(self, fp, schema):
+        records = []
+        for record in fastavro.reader(fp):
+            records.append(record)
+            if len(records) >= self.SPILL_BATCH_SIZE:
+                yield pyarrow.Table.from_pylist(records, schema=schema)
+                records = []
+
+        if records:
+            yield pyarrow.Table.from_pylist(records, schema=schema)
+
+
+def conform_table(table, schema):
+    """
+    Cast an Arrow table to a schema that has all of its fields (e.g. a schema unified with the table's schema) without
+    losing data. Fields that the table does not have are null.
+
+    :param pyarrow.Table table: Table to cast
+    :param pyarrow.Schema schema: Schema to cast to
+    :return: Table with the schema
+    :raises pyarrow.ArrowInvalid: If values can not be cast safely
+    """
+    columns = [table.column(field.name).cast(field.type, safe=True) if field.name in table.column_names
+               else pyarrow.nulls(len(table), field.type)
+               for field in schema]
+    return pyarrow.Table.from_arrays(columns, schema=schema)
+
+
+def avro_schema(schema, name='Record'):
+    """
+    Convert an Arrow schema to an Avro record schema with all fields nullable
+
+    :param pyarrow.Schema|pyarrow.StructType schema: Arrow schema (or struct type for nested records) to convert
+    :param str name: Name of the record, which is also used as the prefix of the names of nested records
+    :return: Avro schema as a dict
+    """
+    return {'type': 'record', 'name': name,
+            'fields': [{'name': field.name, 'type': _avro_type(field.type, f'{name}_{field.name}'), 'default': None}
+                       for field in schema]}
+
+
+def _avro_type(arrow_type, name):
+    """ Nullable Avro type for the given Arrow type. Nested records are named after their path to be unique. """
+    types = pyarrow.types
+
+    if types.is_null(arrow_type):
+        return 'null'
+    elif types.is_boolean(arrow_type):
+        avro_type = 'boolean'
+    elif types.is_integer(arrow_type):
+        avro_type = 'long'
+    elif types.is_floating(arrow_type):
+        avro_type = 'double'
+    elif types.is_string(arrow_type) or types.is_large_string(arrow_type):
+        avro_type = 'string'
+    elif types.is_binary(arrow_type) or types.is_large_binary(arrow_type):
+        avro_type = 'bytes'
+    elif types.is_struct(arrow_type):
+        avro_type = avro_schema(arrow_type, name)
+    elif types.is_list(arrow_type) or types.is_large_list(arrow_type):
+        avro_type = {'type': 'array', 'items': _avro_type(arrow_type.value_type, name)}
+    else:
+        raise ValueError(f'Arrow type {arrow_type} of {name} is not supported by the avro sink format')
+
+    return ['null', avro_type]
+
+
+#: Sink formats by name
+SINK_FORMATS = {sink.NAME: sink for sink in (JSONSink, ParquetSink, AvroSink)}
+
+#: Name of the default sink format
+DEFAULT_SINK_FORMAT = JSONSink.NAME
+
+
+def get_sink_format(name=DEFAULT_SINK_FORMAT):
+    """
+    Get a sink format by name
+
+    :param str name: Name of the sink format from :data:`SINK_FORMATS`
+    :return: Sink class for the format
+    :raises ValueError: If the sink format is unknown or not available
+    """
+    if name not in SINK_FORMATS:
+        raise ValueError(f'Unknown sink format: {name}')
+
+    sink = SINK_FORMATS[name]
+    if not sink.is_available():
+        raise ValueError(f'Sink format {name} is not available. Please install it: pip install '
+                         f'{" ".join(sink.PACKAGES)}')
+
+    return sink
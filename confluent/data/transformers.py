@@ -1,37 +1,192 @@
+from collections import deque
 from datetime import datetime
+from functools import lru_cache
 import gzip
-import json
+import inspect
+import io
+from itertools import islice
 import multiprocessing
+from operator import itemgetter
 import os
 import re
+import shutil
+import sys
+import time
 
 import pytz
 
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from confluent.data.codecs import AUTO_JSON_CODEC, get_json_codec
+from confluent.data.guards import QuarantineFile
+from confluent.data.manifests import TransformManifest, content_hash
+from confluent.data.metrics import TransformMetrics, TransformProgress
+from confluent.data.schemas import KeySchema, type_name
+from confluent.data.shards import (DEFAULT_MAX_OPEN_FILES, CompactionIndex, PartitionRouter, ShardWriter,
+                                   partition_name, partitioned_files, publish_shards, remove_stale_shards,
+                                   shard_files)
+from confluent.data.sinks import DEFAULT_SINK_FORMAT, get_sink_format
 
 INVALID_KEY_CHARS_RE = re.compile('[^a-zA-Z0-9_]')
 
+#: First bytes of gzip data
+GZIP_MAGIC = b'\x1f\x8b'
+
+#: Engine that transforms one record at a time
+RECORD_ENGINE = 'record'
+
+#: Engine that transforms a batch of records at a time as columns (requires NumPy)
+COLUMNAR_ENGINE = 'columnar'
+
+#: Engines to transform usage metrics with
+TRANSFORM_ENGINES = (RECORD_ENGINE, COLUMNAR_ENGINE)
+
+#: Default timezone for the localized date[time] fields added to records
+DEFAULT_TIMEZONE = 'US/Pacific'
+
+#: Default gzip compression level for output files (same as the `gzip` module's default)
+DEFAULT_COMPRESS_LEVEL = 9
+
+#: Default size of decompressed data blocks to read and transform at a time
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+
 
 class Transformer:
     """ Manager for transforming data files in parallel """
 
-    def __init__(self, transform, source_dir, sink_dir, path_contains=None, select_fields=None, parallel_processes=5):
+    #: Files smaller than this (in bytes) are batched together into one task for the process pool
+    SMALL_FILE_SIZE = 1024 * 1024
+
+    #: Maximum total size (in bytes) of small files to batch together into one task
+    SMALL_FILES_BATCH_SIZE = 16 * 1024 * 1024
+
+    #: Maximum number of small files to batch together into one task
+    SMALL_FILES_BATCH_COUNT = 100
+
+    #: Size (in bytes) of decompressed data chunks that files larger than `split_size` are split into
+    SPLIT_CHUNK_SIZE = 32 * 1024 * 1024
+
+    #: Size (in bytes) of decompressed data chunks that streams are split into by :meth:`transform_stream`
+    STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+    #: Name of the JSON file in the sink dir with the summary of the last run
+    SUMMARY_FILE = '.transform-summary.json'
+
+    #: Extensions of data files that are replaced by `output_extension`
+    DATA_FILE_EXTENSIONS = ('.gz', '.json', '.ndjson')
+
+    #: Name of the JSON file in the sink dir with the raw key paths, sanitized keys, and value types seen so far
+    KEY_CACHE_FILE = '.transform-keys.json'
+
+    #: Name of the BigQuery JSON schema file for the transformed records in the sink dir
+    SCHEMA_FILE = '.transform-schema.json'
+
+    #: Name of the file in the quarantine dir with the quarantined lines of a stream
+    STREAM_QUARANTINE_FILE = 'stream.json.gz'
+
+    #: Name of the dir in the compact dir that shards are written to before they are swapped in
+    COMPACT_STAGING_DIR = '.staging'
+
+    #: Transform options that affect the output, which are recorded in the manifest
+    OUTPUT_OPTIONS = ('timezone', 'json_codec', 'compress_level', 'sink_format', 'sink_compression')
+
+    def __init__(self, transform, source_dir, sink_dir, path_contains=None, select_fields=None,
+                 parallel_processes=None, transform_options=None, split_size=None, chunk_transform=None,
+                 use_manifest=True, output_extension=None, compact_size=None, compact_dir=None, partition_field=None,
+                 route_field=None, max_open_files=DEFAULT_MAX_OPEN_FILES, schema=False, settings=None,
+                 record_guard=None, quarantine_dir=None):
         """
         Run transforms in parallel in multiple processes
 
         :param callable transform: A callable that accepts an input file and output file and transforms the input to
-                                   output.
+                                   output. If it accepts a `metrics` keyword argument (or `**kwargs`), it is also
+                                   passed a :class:`confluent.data.metrics.TransformMetrics` to add records and time
+                                   spent per stage to.
         :param str source_dir: Directory to read data files from
         :param str sink_dir: Directory to write data files to
         :param str|None path_contains: Only process paths that contains the given value
         :param set|None select_fields: A set of fields to extract from data files. Use a dot for nested fields.
                                        To exclude a field, prefix it with a negative sign ("-").
-        :param int parallel_processes: Number of processes to use
+        :param int|None parallel_processes: Number of processes to use. Defaults to the number of CPUs.
+        :param dict|None transform_options: Additional keyword arguments to pass to the transform callable
+        :param int|None split_size: Gzipped files larger than this (in bytes) are split into line-aligned chunks that
+                                    are transformed by all processes and written back in order as independently
+                                    compressed gzip members of the output file. Requires `chunk_transform`.
+        :param callable chunk_transform: A callable that accepts a chunk of decompressed lines (bytes) and returns a
+                                         gzip member (bytes) with the transformed lines. It is called with the same
+                                         keyword arguments as the transform callable, including `metrics` if it
+                                         accepts it.
+        :param bool use_manifest: Record transformed files in a manifest in the sink dir (see
+                                  :class:`confluent.data.manifests.TransformManifest`) to only transform new, changed,
+                                  or stale files on re-runs. Otherwise, files are skipped if their output exists.
+        :param str|None output_extension: Replace the extensions of data files (e.g. ".json.gz") with this one for
+                                          output files, e.g. ".parquet" when the transform writes another format.
+                                          Otherwise, output files have the same name as data files.
+        :param int|None compact_size: Pack output files into shards of about this size (in bytes) in `compact_dir`
+                                      after the transform, e.g. to load fewer and larger files into BigQuery. Output
+                                      files must be gzipped JSON lines. See :meth:`compact`.
+        :param str|None compact_dir: Directory to write shards to. Defaults to the sink dir with a "-compacted" suffix.
+        :param str|None partition_field: Partition records into `<field>=<value>` sub-dirs of the compact dir by the
+                                         value of this top-level field, e.g. date_pt
+        :param str|None route_field: Route transformed records into `<field>=<value>` sub-dirs of the sink dir by the
+                                     value of this top-level field, e.g. `sink_dir/date_pt=2019-03-10/data.json.gz`.
+                                     The transform callable is passed a :class:`confluent.data.shards.PartitionRouter`
+                                     (`router` keyword argument) to write to instead of an output file (None).
+        :param int max_open_files: Maximum number of open files per process when routing records
+        :param bool schema: Learn the sanitized keys and value types of the transformed records, which are cached in
+                            the sink dir to preload them in each process on later runs, and write them as a BigQuery
+                            JSON schema to the sink dir. Raw keys that sanitize to the same key are reported. The
+                            transform callable is passed a :class:`confluent.data.schemas.KeySchema` (`key_schema`
+                            keyword argument) to preload and is expected to set `key_schema` of the metrics.
+        :param dict|None settings: Other settings that affect the output of the transform (e.g. a transform spec),
+                                   which are recorded in the manifest, so files are transformed again when they change
+        :param RecordGuard|None record_guard: Limits for the size/depth of records and the memory of each process. The
+                                              transform callable is passed a
+                                              :class:`confluent.data.guards.RecordGuard` (`guard` keyword argument)
+                                              with the same limits that quarantines offending lines of each data file
+                                              into a file with the same relative path in `quarantine_dir`.
+        :param str|None quarantine_dir: Directory to write quarantined lines to. Defaults to the sink dir with a
+                                        "-quarantine" suffix.
         """
+        if split_size and not chunk_transform:
+            raise ValueError('chunk_transform is required to split large files')
+        if compact_size and output_extension:
+            raise ValueError('Output files must be gzipped JSON lines to compact them')
+        if partition_field and not compact_size:
+            raise ValueError('compact_size is required to partition output files')
+        if route_field and (split_size or output_extension):
+            raise ValueError('Records can only be routed for gzipped JSON lines output without splitting large files')
+
         self._transform = transform
         self.source_dir = source_dir
         self.sink_dir = sink_dir
         self.path_contains = path_contains
-        self.parallel_processes = parallel_processes
+        self.parallel_processes = parallel_processes or multiprocessing.cpu_count()
+        self.transform_options = transform_options or {}
+        self.split_size = split_size
+        self._chunk_transform = chunk_transform
+        self.use_manifest = use_manifest
+        self.output_extension = output_extension
+        self.compact_size = compact_size
+        self.compact_dir = compact_dir or sink_dir.rstrip(os.sep) + '-compacted'
+        self.partition_field = partition_field
+        self.route_field = route_field
+        self.max_open_files = max_open_files
+        self.schema = schema
+        self.settings = settings
+        self.record_guard = record_guard
+        self.quarantine_dir = quarantine_dir or sink_dir.rstrip(os.sep) + '-quarantine'
+
+        #: :class:`KeySchema` from the key cache that is passed to the transform if `schema` is set
+        self._key_schema = None
+
+        if compact_size:
+            for name, path in (('sink', sink_dir), ('source', source_dir)):
+                if _overlaps(self.compact_dir, path):
+                    raise ValueError(f'Compact dir can not be the {name} dir, contain it, or be inside it')
 
         # Split select vs exclude fields
         self.select_fields = select_fields
@@ -50,66 +205,895 @@ class Transformer:
         if self.exclude_fields:
             print('Excluding these fields:', ', '.join(sorted(self.exclude_fields)))
 
-        data_files = []
-        for (dirpath, dirnames, filenames) in os.walk(self.source_dir):
-            if not self.path_contains or self.path_contains in dirpath:
-                data_files.extend([os.path.join(dirpath, name) for name in filenames])
+        data_files = self._find_data_files()
 
         if data_files:
             print('-' * 80)
+            manifest = None
+            stats = {path: (size, mtime_ns) for path, size, mtime_ns in data_files}
+            if self.use_manifest:
+                manifest = TransformManifest(self.sink_dir, self._settings())
+                data_files = self._changed_files(data_files, manifest)
+            else:
+                data_files = [(path, size, mtime_ns, False, None) for path, size, mtime_ns in data_files]
+
+            large_files = []
+            small_files = []
+            for path, size, mtime_ns, overwrite, known_hash in data_files:
+                if self.split_size and size > self.split_size:
+                    large_files.append((path, overwrite, known_hash))
+                else:
+                    small_files.append((size, (path, overwrite, known_hash)))
+
+            progress = TransformProgress(len(data_files), self.parallel_processes)
+
+            if self.schema:
+                self._key_schema = KeySchema.load(os.path.join(self.sink_dir, self.KEY_CACHE_FILE), self._settings())
+
+            def record(metrics):
+                progress.update(metrics)
+                if manifest and not metrics.error:
+                    manifest.record(self._relative_path(metrics.input_file), *stats[metrics.input_file],
+                                    metrics.content_hash)
+
             try:
                 process_pool = multiprocessing.Pool(self.parallel_processes)
-                process_pool.map(self._transform_file, data_files)
+
+                # Large files first as they are split across all processes
+                for input_file, overwrite, known_hash in large_files:
+                    record(self._split_transform_file(process_pool, input_file, overwrite, known_hash))
+
+                for results in process_pool.imap_unordered(self._transform_files, self._schedule(small_files)):
+                    for metrics in results:
+                        record(metrics)
 
                 process_pool.close()
                 process_pool.join()
 
-                print('Transformed', len(data_files), 'data file(s)')
+                print('Transformed', len(data_files) - len(progress.errors), 'data file(s)')
+                self._report(progress)
+
+                if self.schema:
+                    self._write_schema(progress.totals.key_schema)
+
+                if self.compact_size:
+                    self.compact()
 
             except KeyboardInterrupt:
                 process_pool.terminate()
                 process_pool.join()
                 raise
 
+            finally:
+                if manifest:
+                    manifest.close()
+
         else:
             match_criteria = f'matching "{self.path_contains}"' if self.path_contains else ''
             print(f'No data files found in "{self.source_dir}" dir {match_criteria}')
 
-    def _transform_file(self, input_file):
-        """ Wraps self._transform callable to do exception/output file handling """
-        output_file = os.path.join(self.sink_dir, input_file[len(self.source_dir)+1:])
-        if os.path.exists(output_file):
-            print(f'Skipping transform as output file already exists: {output_file}')
-            return
+    def compact(self):
+        """
+        Pack the output files in the sink dir into shards of about `compact_size` in the compact dir, optionally
+        partitioned by `partition_field`. Without partitioning, output files are copied as is into shards as gzip
+        members can be concatenated. With partitioning, records are routed by the value of the partition field.
 
-        print('Transforming', input_file)
+        Output files that were compacted are recorded in an index in the compact dir (see
+        :class:`confluent.data.shards.CompactionIndex`), so shards are only rebuilt when output files were added,
+        changed, or removed since the last compaction. With partitioning, only the partitions that those output files
+        feed (now or before) are rebuilt from the output files that feed them, and other partitions are kept as they
+        were. Shards are written to a staging dir in the compact dir and swapped in for the shards of the previous
+        compaction once all of them are done (see :func:`confluent.data.shards.publish_shards`), so a failed compaction
+        leaves the previous shards as they were. Only files named like shards are replaced.
+
+        :return: List of paths of shards
+        """
+        outputs = {}
+        for dirpath, _, filenames in os.walk(self.sink_dir):
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    outputs[os.path.relpath(os.path.join(dirpath, filename), self.sink_dir)] = (stat.st_size,
+                                                                                                stat.st_mtime_ns)
+
+        compress_level = self.transform_options.get('compress_level', DEFAULT_COMPRESS_LEVEL)
+        index = CompactionIndex(self.compact_dir, {'compact_size': self.compact_size,
+                                                   'partition_field': self.partition_field,
+                                                   'compress_level': compress_level})
+        indexed = index.outputs or {}
+        changed_files = sorted(path for path, stat in outputs.items() if tuple(indexed.get(path, ())[:2]) != stat)
+        removed_files = [path for path in indexed if path not in outputs]
+
+        if index.outputs is not None and not changed_files and not removed_files:
+            print(f'Shards in "{self.compact_dir}" are up to date with {len(outputs)} output file(s)')
+            return sorted(shard_files(self.compact_dir))
+
+        # Partitions to rebuild, or None to rebuild all of them
+        partitions = None
+        if index.outputs is not None and self.partition_field:
+            partitions = set()
+            for path in changed_files + removed_files:
+                partitions.update(indexed.get(path, (0, 0, []))[2])
+
+        loads = get_json_codec(self.transform_options.get('json_codec', AUTO_JSON_CODEC)).loads
+        buffer_size = self.transform_options.get('buffer_size', DEFAULT_BUFFER_SIZE)
+        staging_dir = os.path.join(self.compact_dir, self.COMPACT_STAGING_DIR)
+        output_partitions = {path: indexed[path][2] for path in outputs if path not in changed_files}
+        compacted_files = []
+        writers = {}
+
+        if os.path.exists(staging_dir):  # Left from a compaction that was killed
+            shutil.rmtree(staging_dir)
+
+        def writer(shard_dir):
+            if shard_dir not in writers:
+                writers[shard_dir] = ShardWriter(shard_dir, self.compact_size, compress_level=compress_level)
+            return writers[shard_dir]
+
+        try:
+            # Changed files first as all partitions that they feed are rebuilt, and then other files that feed them
+            for path in changed_files + sorted(output_partitions):
+                unchanged = path in output_partitions
+                if partitions is not None and unchanged and not partitions.intersection(output_partitions[path]):
+                    continue
+
+                output_file = os.path.join(self.sink_dir, path)
+                compacted_files.append(output_file)
+
+                if not self.partition_field:
+                    writer(staging_dir).write_file(output_file)
+                    output_partitions[path] = ['']
+                    continue
+
+                file_partitions = set()
+                with gzip.open(output_file, 'rb') as fp:
+                    for lines in iter_line_batches(fp, buffer_size):
+                        line_partitions = {}
+                        for line in lines:
+                            if line:
+                                name = partition_name(self.partition_field, loads(line).get(self.partition_field))
+                                line_partitions.setdefault(name, []).append(line)
+
+                        for name, partition_lines in line_partitions.items():
+                            file_partitions.add(name)
+                            if partitions is not None and unchanged and name not in partitions:
+                                continue
+
+                            if partitions is not None:
+                                partitions.add(name)
+                            partition_lines.append(b'')
+                            writer(os.path.join(staging_dir, name)).write(b'\n'.join(partition_lines))
+
+                output_partitions[path] = sorted(file_partitions)
+
+            for shard_writer in writers.values():
+                shard_writer.finish()
+
+        except BaseException:
+            for shard_writer in writers.values():
+                shard_writer.abort()
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        if writers:
+            shards = publish_shards(staging_dir, self.compact_dir, partitions=partitions)
+        else:  # No records left, e.g. all output files were removed
+            shards = []
+            remove_stale_shards(self.compact_dir, set(), partitions=partitions)
+        index.save({path: stat + (output_partitions[path],) for path, stat in outputs.items()})
+
+        partition_counts = f' and {len(writers)} partition(s)' if self.partition_field else ''
+        print(f'Compacted {len(compacted_files)} output file(s) into {len(shards)} shard(s){partition_counts} '
+              f'in "{self.compact_dir}"')
+
+        return sorted(shard_files(self.compact_dir))
+
+    def _report(self, progress):
+        """ Print a summary of the run and write it as JSON to the sink dir """
+        summary = progress.summary()
+        if summary['errors']:
+            print(f'Failed to transform {len(summary["errors"])} data file(s):')
+            for error in summary['errors']:
+                print(f'  - {error["input_file"]}: {error["error"]}')
+
+        if summary['records']:
+            print(f'Processed {summary["records"]:,} records in {summary["wall_seconds"]:,.1f} seconds '
+                  f'({summary["records_per_sec"]:,.0f} records/sec) with '
+                  f'{summary["process_utilization"]:.0%} process utilization')
+            stage_percents = ', '.join(f'{stage} {percent}%' for stage, percent in summary['stage_percents'].items())
+            print('Time spent per stage:', stage_percents)
+
+        if summary['quarantined']:
+            print(f'Quarantined {sum(summary["quarantined"].values()):,} record(s) '
+                  f'({_quarantine_reasons(summary["quarantined"])}) from {summary["quarantined_files"]} data file(s) '
+                  f'to "{self.quarantine_dir}"')
+        if summary['peak_rss']:
+            print(f'Peak memory per process: {summary["peak_rss"] / 1024 / 1024:,.1f} MB')
+
+        os.makedirs(self.sink_dir, exist_ok=True)
+        progress.write_summary(os.path.join(self.sink_dir, self.SUMMARY_FILE))
+
+    def _write_schema(self, key_schema):
+        """
+        Merge the key schema learned by the workers into the cached one, save it, write it as a BigQuery JSON schema,
+        and report raw keys that sanitize to the same key
+
+        :param KeySchema|None key_schema: Key schema learned by the workers
+        """
+        if key_schema is not None:
+            self._key_schema.merge(key_schema)
+
+        self._key_schema.save(os.path.join(self.sink_dir, self.KEY_CACHE_FILE), self._settings())
+        schema_file = os.path.join(self.sink_dir, self.SCHEMA_FILE)
+        self._key_schema.write_bigquery_schema(schema_file)
+        print(f'Wrote BigQuery schema for {len(self._key_schema.keys)} key(s) to "{schema_file}"')
+
+        collisions = self._key_schema.collisions()
+        if collisions:
+            print(f'Found {len(collisions)} key(s) that multiple raw keys sanitize to, so their values overwrite '
+                  f'each other:')
+            for clean_path, raw_paths in collisions.items():
+                print(f'  - {clean_path}: {", ".join(raw_paths)}')
+
+    def _find_data_files(self):
+        """
+        Find data files in the source dir with a single stat call per file
+
+        :return: List of (path, size, mtime_ns) for data files that match `self.path_contains`
+        """
+        data_files = []
+        dirs = [self.source_dir] if os.path.isdir(self.source_dir) else []
+
+        while dirs:
+            dirpath = dirs.pop()
+            include_files = not self.path_contains or self.path_contains in dirpath
+
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif include_files:
+                        stat = entry.stat()
+                        data_files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+
+        return data_files
+
+    def _settings(self):
+        """ Settings that affect the output of the transform, which are recorded in the manifest """
+        settings = {'transform': getattr(self._transform, '__name__', str(self._transform)),
+                    'select_fields': sorted(self.select_fields or []),
+                    'exclude_fields': sorted(self.exclude_fields or [])}
+
+        # Only added when set, so manifests from before output extensions were supported are not stale
+        if self.output_extension:
+            settings['output_extension'] = self.output_extension
+        if self.route_field:
+            settings['route_field'] = self.route_field
+        if self.settings:
+            settings.update(self.settings)
+
+        # Options that are the defaults of the transform callable are left out, so manifests from before options were
+        # recorded are not stale
+        defaults = _keyword_defaults(self._transform)
+        output_options = {name: value for name, value in self.transform_options.items()
+                          if name in self.OUTPUT_OPTIONS and (name not in defaults or value != defaults[name])}
+        if output_options:
+            settings['transform_options'] = output_options
+        if self.record_guard and self.record_guard.settings():
+            settings['record_limits'] = self.record_guard.settings()
+
+        return settings
+
+    def _changed_files(self, data_files, manifest):
+        """
+        Filter out data files that were transformed before based on the manifest
+
+        :param list data_files: List of (path, size, mtime_ns) for data files
+        :param TransformManifest manifest: Manifest of transformed data files
+        :return: List of (path, size, mtime_ns, overwrite, known_hash) for new, changed, or stale data files, where
+                 overwrite indicates to overwrite existing output and known_hash is the content hash from the manifest
+                 to skip the transform if the content hasn't changed.
+        """
+        entries = manifest.entries()
+        changed_files = []
+        stale_count = 0
+
+        for path, size, mtime_ns in data_files:
+            entry = entries.get(self._relative_path(path))
+
+            if not entry:
+                changed_files.append((path, size, mtime_ns, False, None))
+
+            elif entry[3] != manifest.settings:
+                changed_files.append((path, size, mtime_ns, True, None))
+                stale_count += 1
+
+            elif entry[:2] != (size, mtime_ns):
+                changed_files.append((path, size, mtime_ns, True, entry[2]))
+
+        unchanged_count = len(data_files) - len(changed_files)
+        if unchanged_count:
+            print(f'Skipping {unchanged_count} data file(s) that are unchanged since the last transform')
+        if stale_count:
+            print(f'Re-transforming {stale_count} data file(s) with stale output as the settings have changed')
+
+        return changed_files
+
+    def _relative_path(self, input_file):
+        """ Path of the input file relative to the source dir """
+        return input_file[len(self.source_dir)+1:]
+
+    def _output_file(self, input_file):
+        """ Path of the output file for the given input file """
+        output_file = os.path.join(self.sink_dir, self._relative_path(input_file))
+
+        if self.output_extension:
+            for extension in self.DATA_FILE_EXTENSIONS:
+                if output_file.endswith(extension):
+                    output_file = output_file[:-len(extension)]
+            output_file += self.output_extension
+
+        return output_file
+
+    def _schedule(self, data_files):
+        """
+        Group data files into tasks for the process pool with the largest files first (longest-processing-time first),
+        so a big file that happens to be processed last doesn't hold up the whole run while other processes sit idle.
+        Small files are batched together to reduce the per-task overhead.
+
+        :param list[tuple] data_files: List of (size, data file) to schedule
+        :return: List of tasks, where each is a list of data files to transform
+        """
+        sized_files = sorted(data_files, key=itemgetter(0), reverse=True)
+
+        tasks = []
+        small_files = []
+        small_files_size = 0
+
+        for size, data_file in sized_files:
+            if size >= self.SMALL_FILE_SIZE:
+                tasks.append([data_file])
+                continue
+
+            if small_files and (small_files_size + size > self.SMALL_FILES_BATCH_SIZE
+                                or len(small_files) >= self.SMALL_FILES_BATCH_COUNT):
+                tasks.append(small_files)
+                small_files = []
+                small_files_size = 0
+
+            small_files.append(data_file)
+            small_files_size += size
+
+        if small_files:
+            tasks.append(small_files)
+
+        return tasks
+
+    def _transform_files(self, data_files):
+        """
+        Transform the given files one after another using :meth:`_transform_file`
+
+        :param list[tuple] data_files: List of (input_file, overwrite, known_hash)
+        :return: List of :class:`TransformMetrics` from :meth:`_transform_file`
+        """
+        return [self._transform_file(*data_file) for data_file in data_files]
+
+    def _split_transform_file(self, process_pool, input_file, overwrite=False, known_hash=None):
+        """
+        Transform a large file by splitting it into chunks that are transformed by the processes in the given pool and
+        written back in order. At most twice the number of processes of chunks are in flight to bound memory usage.
+
+        See :meth:`_transform_file` for params and return value.
+        """
+        output_file = self._output_file(input_file)
+        metrics = self._skip_transform(input_file, output_file, overwrite, known_hash)
+        if metrics.skipped:
+            return metrics
+
+        print('Transforming', input_file, 'in chunks')
+        start_time = time.perf_counter()
+        quarantine = QuarantineFile(self._quarantine_file(input_file)) if self.record_guard else None
 
         try:
             temp_file = os.path.join(os.path.dirname(output_file), '.' + os.path.basename(output_file))
             os.makedirs(os.path.dirname(temp_file), exist_ok=True)
 
-            self._transform(input_file, temp_file, select_fields=self.select_fields, exclude_fields=self.exclude_fields)
+            with gzip.open(input_file, 'rb') as input_fp, open(temp_file, 'wb') as output_fp:
+                self._transform_chunks(process_pool, iter_line_chunks(input_fp, self.SPLIT_CHUNK_SIZE), output_fp,
+                                       metrics, quarantine=quarantine)
 
+            metrics.bytes_in = os.path.getsize(input_file)
+            metrics.bytes_out = os.path.getsize(temp_file)
             os.rename(temp_file, output_file)
 
-        except (KeyboardInterrupt, Exception) as e:
-            if isinstance(e, KeyboardInterrupt):
-                print(f'ERROR: Could not transform {input_file}: {e}')
+        except Exception as e:
+            metrics.error = str(e) or type(e).__name__
+            print(f'ERROR: Could not transform {input_file}: {metrics.error}')
 
             try:
                 os.unlink(temp_file)
-                os.unlink(output_file)
             except Exception:
                 pass
 
+        finally:
+            if quarantine:
+                quarantine.close()
+
+        metrics.elapsed = time.perf_counter() - start_time
+        return metrics
+
+    def _transform_chunks(self, process_pool, chunks, output_fp, metrics, quarantine=None):
+        """
+        Transform chunks of lines in the given process pool (or this process if it is None) and write them in order.
+        At most twice the number of processes of chunks are in flight to bound memory usage.
+
+        :param multiprocessing.Pool|None process_pool: Pool to transform the chunks in
+        :param iter chunks: Iterator of chunks of decompressed lines
+        :param output_fp: Binary file object to write the transformed chunks to
+        :param TransformMetrics metrics: Metrics to add the chunk metrics to
+        :param QuarantineFile quarantine: File to write the quarantined lines of the chunks to
+        """
+        pending_chunks = deque()
+
+        def write_chunk(member, chunk_metrics):
+            output_fp.write(member)
+            if quarantine:
+                for line in chunk_metrics.quarantined_lines:
+                    quarantine.write(line)
+            metrics.merge(chunk_metrics)
+
+        while True:
+            with metrics.timer('decompress'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+
+            if process_pool:
+                if len(pending_chunks) >= 2 * self.parallel_processes:
+                    write_chunk(*pending_chunks.popleft().get())
+                pending_chunks.append(process_pool.apply_async(self._transform_chunk, (chunk,)))
+            else:
+                write_chunk(*self._transform_chunk(chunk))
+
+        while pending_chunks:
+            write_chunk(*pending_chunks.popleft().get())
+
+    def transform_stream(self, input_fp, output_fp):
+        """
+        Transform a stream of records (e.g. stdin) to another stream (e.g. stdout) without staging files on disk. The
+        input is read in chunks of lines that are transformed by the chunk transform in parallel processes and written
+        in order, so memory is bounded by the number of chunks in flight. Progress is reported to stderr as stdout may
+        be the output.
+
+        :param input_fp: Binary file object to read JSON lines from, which may be gzipped (or concatenated gzip files)
+        :param output_fp: Binary file object to write transformed chunks to (gzip members for usage metrics)
+        :return: :class:`TransformMetrics` for the stream
+        """
+        if not self._chunk_transform:
+            raise ValueError('chunk_transform is required to transform a stream')
+
+        if not hasattr(input_fp, 'peek'):
+            input_fp = io.BufferedReader(input_fp)
+        if input_fp.peek(2)[:2] == GZIP_MAGIC:
+            input_fp = gzip.GzipFile(fileobj=input_fp, mode='rb')
+
+        metrics = TransformMetrics('<stream>')
+        start_time = time.perf_counter()
+        process_pool = None
+        quarantine = None
+        if self.record_guard:
+            quarantine = QuarantineFile(os.path.join(self.quarantine_dir, self.STREAM_QUARANTINE_FILE))
+
+        try:
+            if self.parallel_processes > 1:
+                process_pool = multiprocessing.Pool(self.parallel_processes)
+
+            self._transform_chunks(process_pool, iter_line_chunks(input_fp, self.STREAM_CHUNK_SIZE), output_fp,
+                                   metrics, quarantine=quarantine)
+            output_fp.flush()
+
+        finally:
+            if process_pool:
+                process_pool.terminate()
+                process_pool.join()
+            if quarantine:
+                quarantine.close()
+
+        metrics.elapsed = time.perf_counter() - start_time
+        print(f'Transformed {metrics.records:,} records in {metrics.elapsed:,.1f} seconds '
+              f'({metrics.records_per_sec:,.0f} records/sec) using {self.parallel_processes} parallel processes',
+              file=sys.stderr, flush=True)
+        if metrics.quarantined:
+            print(f'Quarantined {sum(metrics.quarantined.values()):,} record(s) '
+                  f'({_quarantine_reasons(metrics.quarantined)}) to "{quarantine.path}"', file=sys.stderr, flush=True)
+
+        return metrics
+
+    def _transform_chunk(self, chunk):
+        """
+        Wraps self._chunk_transform callable to pass the transform options
+
+        :return: Tuple of (transformed chunk, :class:`TransformMetrics`)
+        """
+        metrics = TransformMetrics()
+        member = self._chunk_transform(chunk, select_fields=self.select_fields, exclude_fields=self.exclude_fields,
+                                       **self._metrics_option(self._chunk_transform, metrics),
+                                       **self._transform_options())
+        return member, metrics
+
+    @staticmethod
+    def _metrics_option(func, metrics):
+        """
+        `metrics` keyword argument for the transform callable if it accepts it, so custom callables from before
+        metrics were reported still work
+        """
+        return {'metrics': metrics} if _accepts_keyword(func, 'metrics') else {}
+
+    def _transform_options(self, quarantine_file=None):
+        """
+        Transform options with the key schema to preload if the schema is learned, and a record guard if it is set
+
+        :param str quarantine_file: File for the record guard to write quarantined lines to. Defaults to adding them
+                                    to the metrics.
+        """
+        options = self.transform_options
+        if self._key_schema is not None:
+            options = dict(options, key_schema=self._key_schema)
+        if self.record_guard:
+            options = dict(options, guard=self.record_guard.for_file(quarantine_file))
+        return options
+
+    def _quarantine_file(self, input_file):
+        """
+        Path of the quarantine file for the given input file. A quarantine file from a previous transform is removed.
+        """
+        quarantine_file = os.path.join(self.quarantine_dir, self._relative_path(input_file))
+        if os.path.exists(quarantine_file):
+            os.unlink(quarantine_file)
+        return quarantine_file
+
+    def _skip_transform(self, input_file, output_file, overwrite, known_hash):
+        """
+        Check if the transform should be skipped as the output file already exists or the content hasn't changed.
+
+        :return: :class:`TransformMetrics` for the input file with `skipped` set and the content hash if the manifest
+                 is used.
+        """
+        metrics = TransformMetrics(input_file)
+
+        if not overwrite and self._output_exists(input_file, output_file):
+            print(f'Skipping transform as output file already exists: {output_file}')
+            metrics.skipped = True
 
-def transform_usage_metrics(input_file, output_file, select_fields=None, exclude_fields=None):
-    with gzip.open(output_file, 'wt') as fp:
-        for line in gzip.open(input_file, 'rt'):
-            record = json.loads(line)
-            clean_record = transform_usage_metrics_record(record, select_fields=select_fields,
-                                                          exclude_fields=exclude_fields)
-            fp.write(json.dumps(clean_record) + '\n')
+        if self.use_manifest:
+            metrics.content_hash = content_hash(input_file)
+
+            if known_hash and metrics.content_hash == known_hash and not metrics.skipped:
+                print(f'Skipping transform as content is unchanged: {input_file}')
+                metrics.skipped = True
+
+        return metrics
+
+    def _output_exists(self, input_file, output_file):
+        """ True if the output file (or any of the routed output files) for the input file exists """
+        if self.route_field:
+            return bool(partitioned_files(self.sink_dir, self.route_field, self._relative_path(input_file)))
+        return os.path.exists(output_file)
+
+    def _transform_file(self, input_file, overwrite=False, known_hash=None):
+        """
+        Wraps self._transform callable to do exception/output file handling
+
+        :param str input_file: Data file to transform
+        :param bool overwrite: Overwrite the output file if it already exists
+        :param str known_hash: Content hash of the input file from the last transform. If it matches the current
+                               hash, the transform is skipped.
+        :return: :class:`TransformMetrics` for the input file, which has `error` set if the transform failed.
+        """
+        output_file = self._output_file(input_file)
+        metrics = self._skip_transform(input_file, output_file, overwrite, known_hash)
+        if metrics.skipped:
+            return metrics
+
+        print('Transforming', input_file)
+        start_time = time.perf_counter()
+        router = None
+        options = dict(self._transform_options(self._quarantine_file(input_file) if self.record_guard else None),
+                       **self._metrics_option(self._transform, metrics))
+
+        try:
+            if self.route_field:
+                router = PartitionRouter(self.sink_dir, self._relative_path(input_file), self.route_field,
+                                         max_open_files=self.max_open_files,
+                                         compress_level=self.transform_options.get('compress_level',
+                                                                                   DEFAULT_COMPRESS_LEVEL))
+                self._transform(input_file, None, select_fields=self.select_fields,
+                                exclude_fields=self.exclude_fields, router=router, **options)
+
+                metrics.bytes_in = os.path.getsize(input_file)
+                metrics.bytes_out = router.commit()
+
+            else:
+                temp_file = os.path.join(os.path.dirname(output_file), '.' + os.path.basename(output_file))
+                os.makedirs(os.path.dirname(temp_file), exist_ok=True)
+
+                self._transform(input_file, temp_file, select_fields=self.select_fields,
+                                exclude_fields=self.exclude_fields, **options)
+
+                metrics.bytes_in = os.path.getsize(input_file)
+                metrics.bytes_out = os.path.getsize(temp_file)
+                os.rename(temp_file, output_file)
+
+        except (KeyboardInterrupt, Exception) as e:
+            metrics.error = str(e) or type(e).__name__
+            print(f'ERROR: Could not transform {input_file}: {metrics.error}')
+
+            if router:
+                router.abort()
+            else:
+                try:
+                    os.unlink(temp_file)
+                    os.unlink(output_file)
+                except Exception:
+                    pass
+
+        finally:
+            if 'guard' in options:
+                options['guard'].close()
+
+        metrics.elapsed = time.perf_counter() - start_time
+        return metrics
+
+
+def transform_usage_metrics(input_file, output_file, select_fields=None, exclude_fields=None,
+                            timezone=DEFAULT_TIMEZONE, json_codec=AUTO_JSON_CODEC,
+                            compress_level=DEFAULT_COMPRESS_LEVEL, buffer_size=DEFAULT_BUFFER_SIZE,
+                            engine=RECORD_ENGINE, sink_format=DEFAULT_SINK_FORMAT, sink_compression=None,
+                            router=None, key_schema=None, guard=None, metrics=None):
+    """
+    Transform a gzipped usage metrics JSON file using :func:`transform_usage_metrics_record`.
+
+    The input is read in blocks of decompressed data that are split into lines and transformed as a batch, and each
+    batch is written as a single buffer (or row group/block for Parquet/Avro) to reduce the number of small
+    reads/writes and compressor calls.
+
+    :param str input_file: Gzipped JSON file to read records from (one record per line)
+    :param str output_file: File to write transformed records to in the sink format
+    :param set select_fields: Set of fields to include
+    :param set exclude_fields: Set of fields to exclude
+    :param str timezone: Timezone for datetime_pt and date_pt fields
+    :param str json_codec: Name of the JSON codec to use. See :func:`confluent.data.codecs.get_json_codec`
+    :param int compress_level: Gzip compression level (0-9) for the output file, or deflate level for Avro
+    :param int buffer_size: Size of decompressed data blocks to read and transform at a time
+    :param str engine: Transform one record at a time with :func:`transform_usage_metrics_record` (record) or a batch
+                       of records at a time with :func:`transform_usage_metrics_columnar` (columnar)
+    :param str sink_format: Name of the format to write records in. See :func:`confluent.data.sinks.get_sink_format`
+    :param str sink_compression: Compression codec for the sink format. Defaults to the one of the format.
+    :param PartitionRouter router: Route records to partitioned output files with this instead of writing them to the
+                                   output file, which is ignored. Only the json sink format is supported.
+    :param KeySchema key_schema: Preload the key paths of this schema and learn the key schema of the transformed
+                                 records, which is set to the metrics
+    :param RecordGuard guard: Quarantine records that exceed its size/depth limits and cap the memory of the process.
+                              See :class:`confluent.data.guards.RecordGuard`
+    :param TransformMetrics metrics: Metrics to add the number of records and time spent per stage to
+    """
+    options = dict(select_fields=select_fields, exclude_fields=exclude_fields, timezone=timezone, json_codec=json_codec,
+                   compress_level=compress_level, buffer_size=buffer_size, engine=engine, sink_format=sink_format,
+                   sink_compression=sink_compression, key_schema=key_schema, guard=guard, metrics=metrics)
+
+    with gzip.open(input_file, 'rb') as input_fp:
+        if router:
+            _transform_usage_metrics_stream(input_fp, None, router=router, **options)
+        else:
+            with get_sink_format(sink_format).open(output_file, compress_level) as output_fp:
+                _transform_usage_metrics_stream(input_fp, output_fp, **options)
+
+
+def transform_usage_metrics_chunk(chunk, select_fields=None, exclude_fields=None, timezone=DEFAULT_TIMEZONE,
+                                  json_codec=AUTO_JSON_CODEC, compress_level=DEFAULT_COMPRESS_LEVEL,
+                                  buffer_size=DEFAULT_BUFFER_SIZE, engine=RECORD_ENGINE,
+                                  sink_format=DEFAULT_SINK_FORMAT, sink_compression=None, key_schema=None,
+                                  guard=None, metrics=None):
+    """
+    Same as :func:`transform_usage_metrics`, but for a chunk of decompressed lines from a large file that is split
+    by :class:`Transformer`. See :func:`transform_usage_metrics` for the params. Only the default (json) sink format
+    is supported as gzip members are the only output that can be concatenated.
+
+    :param bytes chunk: Decompressed JSON lines (one record per line)
+    :return: Gzip member with the transformed records that can be concatenated with others to form a gzip file
+    """
+    if sink_format != DEFAULT_SINK_FORMAT:
+        raise ValueError(f'Large files can not be split for the {sink_format} sink format')
+
+    member = io.BytesIO()
+
+    with gzip.GzipFile(fileobj=member, mode='wb', compresslevel=compress_level, mtime=0) as output_fp:
+        _transform_usage_metrics_stream(io.BytesIO(chunk), output_fp, select_fields=select_fields,
+                                        exclude_fields=exclude_fields, timezone=timezone, json_codec=json_codec,
+                                        buffer_size=buffer_size, engine=engine, key_schema=key_schema,
+                                        guard=guard, metrics=metrics)
+
+    return member.getvalue()
+
+
+def _transform_usage_metrics_stream(input_fp, output_fp, select_fields=None, exclude_fields=None,
+                                    timezone=DEFAULT_TIMEZONE, json_codec=AUTO_JSON_CODEC,
+                                    compress_level=DEFAULT_COMPRESS_LEVEL, buffer_size=DEFAULT_BUFFER_SIZE,
+                                    engine=RECORD_ENGINE, sink_format=DEFAULT_SINK_FORMAT, sink_compression=None,
+                                    router=None, key_schema=None, guard=None, metrics=None):
+    """
+    Transform usage metrics from a binary file object of decompressed lines to another in the sink format, or to the
+    partitioned output files of the router
+    """
+    key_plan = compile_key_plan(select_fields, exclude_fields, track_types=key_schema is not None)
+    if key_schema is not None:
+        key_plan.preload(key_schema)
+    if metrics is None:
+        metrics = TransformMetrics()
+
+    if engine == COLUMNAR_ENGINE:
+        def transform_records(records):
+            return transform_usage_metrics_columnar(records, key_plan=key_plan, timezone=timezone)
+    else:
+        def transform_records(records):
+            return [transform_usage_metrics_record(record, key_plan=key_plan, timezone=timezone) for record in records]
+
+    transform_lines(input_fp, output_fp, transform_records, json_codec=json_codec, compress_level=compress_level,
+                    buffer_size=buffer_size, sink_format=sink_format, sink_compression=sink_compression,
+                    router=router, guard=guard, metrics=metrics)
+
+    if key_schema is not None:
+        metrics.key_schema = key_plan.key_schema()
+
+
+def transform_lines(input_fp, output_fp, transform_records, json_codec=AUTO_JSON_CODEC,
+                    compress_level=DEFAULT_COMPRESS_LEVEL, buffer_size=DEFAULT_BUFFER_SIZE,
+                    sink_format=DEFAULT_SINK_FORMAT, sink_compression=None, router=None, guard=None, metrics=None):
+    """
+    Transform JSON lines from a binary file object of decompressed lines to another in the sink format, or to the
+    partitioned output files of the router, a batch of records at a time
+
+    :param input_fp: Binary file object to read decompressed JSON lines from
+    :param output_fp: Binary file object to write to in the sink format. Ignored if router is set.
+    :param callable transform_records: Called with a list of records and returns the list of transformed records
+    :param PartitionRouter router: Route records to partitioned output files with this instead of writing them to the
+                                   output file. Only the json sink format is supported.
+    :param RecordGuard guard: Quarantine lines that exceed its limits instead of transforming them, and check the
+                              memory of the process after each batch
+    :param TransformMetrics metrics: Metrics to add the number of records and time spent per stage to
+
+    See :func:`transform_usage_metrics` for the other params.
+    """
+    if router and sink_format != DEFAULT_SINK_FORMAT:
+        raise ValueError(f'Records can not be routed for the {sink_format} sink format')
+
+    loads = get_json_codec(json_codec).loads
+    sink = get_sink_format(sink_format)(output_fp, compression=sink_compression, compress_level=compress_level,
+                                        json_codec=json_codec)
+    if metrics is None:
+        metrics = TransformMetrics()
+
+    batches = iter_line_batches(input_fp, buffer_size)
+    while True:
+        with metrics.timer('decompress'):
+            lines = next(batches, None)
+        if lines is None:
+            break
+
+        with metrics.timer('parse'):
+            if guard:
+                records = guard.parse(lines, loads, metrics)
+            else:
+                records = [loads(line) for line in lines]
+
+        with metrics.timer('transform'):
+            records = transform_records(records)
+
+        if router:
+            with metrics.timer('serialize'):
+                partitions = {}
+                for record in records:
+                    partitions.setdefault(record.get(router.field), []).append(record)
+                partitions = [(value, sink.serialize(partition)) for value, partition in partitions.items()]
+
+            with metrics.timer('compress'):
+                for value, data in partitions:
+                    router.write(value, data)
+
+        else:
+            with metrics.timer('serialize'):
+                data = sink.serialize(records)
+
+            with metrics.timer('compress'):
+                sink.write(data)
+
+        metrics.records += len(records)
+        if guard:
+            guard.check_memory(metrics)
+
+    if not router:
+        with metrics.timer('compress'):
+            sink.close()
+
+
+def _quarantine_reasons(quarantined):
+    """ Number of quarantined records per reason, e.g. "2 too large, 1 too deep" """
+    return ', '.join(f'{count:,} {reason.replace("_", " ")}' for reason, count in sorted(quarantined.items()))
+
+
+def _keyword_defaults(func):
+    """ Keyword argument => default value for the arguments of the callable that have defaults """
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):  # Some builtins do not have a signature
+        return {}
+    return {parameter.name: parameter.default for parameter in parameters if parameter.default is not parameter.empty}
+
+
+def _accepts_keyword(func, name):
+    """ Whether the callable accepts the keyword argument, by name or with `**kwargs` """
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):  # Some builtins do not have a signature
+        return False
+    return any(parameter.name == name and parameter.kind != parameter.POSITIONAL_ONLY
+               or parameter.kind == parameter.VAR_KEYWORD for parameter in parameters)
+
+
+def _overlaps(path, other_path):
+    """ Whether the paths are the same, or one of them is inside the other """
+    path, other_path = os.path.abspath(path), os.path.abspath(other_path)
+    return path == other_path or other_path.startswith(path + os.sep) or path.startswith(other_path + os.sep)
+
+
+def iter_line_batches(fp, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Read blocks of data from the given file and split them into lines
+
+    :param fp: Binary file object to read from
+    :param int buffer_size: Size of the blocks to read
+    :return: Iterator of lines (without line endings) for each block
+    """
+    remainder = b''
+
+    while True:
+        block = fp.read(buffer_size)
+        if not block:
+            break
+
+        lines = (remainder + block).split(b'\n')
+        remainder = lines.pop()
+        if lines:
+            yield lines
+
+    if remainder:
+        yield [remainder]
+
+
+def iter_line_chunks(fp, chunk_size):
+    """
+    Read chunks of data from the given file that end at a line boundary
+
+    :param fp: Binary file object to read from
+    :param int chunk_size: Size of the blocks to read. Chunks are smaller or larger depending on the line boundary.
+    :return: Iterator of chunks of lines (with line endings)
+    """
+    remainder = b''
+
+    while True:
+        block = fp.read(chunk_size)
+        if not block:
+            break
+
+        end = block.rfind(b'\n') + 1
+        if end:
+            yield remainder + block[:end]
+            remainder = block[end:]
+        else:
+            remainder += block
+
+    if remainder:
+        yield remainder
 
 
 def _clean_bigquery_keys(record, select_fields=None, exclude_fields=None, _parent_key=None):
@@ -141,10 +1125,257 @@ def _clean_bigquery_keys(record, select_fields=None, exclude_fields=None, _paren
     return clean_data
 
 
-def transform_usage_metrics_record(record, select_fields=None, exclude_fields=None):
+class KeyPlan:
     """
-    Transform usage metrics by removing @timestamp, add datetime_pt for Pacific Time formatted datetime, and
-    clean the keys using :func:`_clean_bigquery_keys`
+    Compiled plan that does the same as :func:`_clean_bigquery_keys`, but learns the clean key and
+    include/exclude/recurse decision for each key path on first sight and reuses them for subsequent records.
+
+    Each plan is a node in a trie of key paths, so nested records are cleaned by their own child plan. Subtrees where
+    nothing is selected are pruned without looking at their keys. The types of the values of each key can also be
+    recorded for :meth:`key_schema`.
+    """
+
+    #: Maximum number of keys to learn per plan to keep memory bounded for records with dynamic keys
+    MAX_KEYS = 1024
+
+    def __init__(self, select_fields=None, exclude_fields=None, track_types=False, renames=None, _parent_key=None):
+        """
+        :param set select_fields: Set of fields to include
+        :param set exclude_fields: Set of fields to exclude
+        :param bool track_types: Record the types of values for :meth:`key_schema`, which makes cleaning slower
+        :param dict renames: Field => new key for fields to rename instead of just replacing invalid characters,
+                             e.g. {'metric.clusterId': 'cluster_id'}. Use a dot for nested fields like select fields.
+        :param str _parent_key: Parent key for the plan. This is used internally to create plans for nested records.
+        """
+        self.select_fields = select_fields
+        self.exclude_fields = exclude_fields
+        self.track_types = track_types
+        self.renames = renames or {}
+        self._parent_key = _parent_key
+
+        #: Raw key => (clean key, child plan, set of value types) or None if the key should be skipped
+        self._keys = {}
+
+        #: True if nothing under the parent key is selected, so nested records are always empty
+        self.prune = bool(select_fields and _parent_key
+                          and not any(f.startswith(_parent_key + '.') for f in select_fields))
+
+    def clean(self, record):
+        """
+        Replace invalid characters (based on BigQuery) in keys with underscore and optionally select or exclude fields.
+
+        :param dict record: Dirty record to clean
+        :return: New record with clean keys
+        """
+        if self.prune:
+            return {}
+        if self.track_types:
+            return self._clean_and_track_types(record)
+
+        clean_data = {}
+        keys = self._keys
+
+        for key, value in record.items():
+            try:
+                plan = keys[key]
+            except KeyError:
+                plan = self._learn(key)
+
+            if plan is None:
+                continue
+
+            clean_key, child_plan, _ = plan
+            if type(value) is dict:
+                value = child_plan.clean(value)
+
+            clean_data[clean_key] = value
+
+        return clean_data
+
+    def _clean_and_track_types(self, record):
+        """ Same as :meth:`clean`, but also records the types of the values of each key """
+        clean_data = {}
+        keys = self._keys
+
+        for key, value in record.items():
+            try:
+                plan = keys[key]
+            except KeyError:
+                plan = self._learn(key)
+
+            if plan is None:
+                continue
+
+            clean_key, child_plan, value_types = plan
+            value_type = type(value)
+            if value_type is dict:
+                value = child_plan.clean(value)
+            elif value_type is list:
+                value_type = (list, type(value[0]) if value else type(None))
+
+            value_types.add(value_type)
+            clean_data[clean_key] = value
+
+        return clean_data
+
+    def clean_in_place(self, record):
+        """
+        Same as :meth:`clean`, but changes the keys of the record and its nested records in place with a stack instead
+        of recursion, so deeply nested records don't hit the recursion limit and large records are not copied. Nested
+        records whose keys are all clean and selected are left as is.
+
+        :param dict record: Dirty record to clean. It is modified in place.
+        :return: The record with clean keys
+        """
+        stack = [(self, record)]
+
+        while stack:
+            plan, data = stack.pop()
+            if plan.prune:
+                data.clear()
+                continue
+
+            keys = plan._keys
+            track_types = plan.track_types
+            clean_data = {}
+            changed = False
+
+            for key, value in data.items():
+                try:
+                    entry = keys[key]
+                except KeyError:
+                    entry = plan._learn(key)
+
+                if entry is None:
+                    changed = True
+                    continue
+
+                clean_key = entry[0]
+                if clean_key != key:
+                    changed = True
+
+                if type(value) is dict:
+                    stack.append((entry[1], value))
+                if track_types:
+                    value_type = type(value)
+                    if value_type is list:
+                        value_type = (list, type(value[0]) if value else type(None))
+                    entry[2].add(value_type)
+
+                clean_data[clean_key] = value
+
+            # Replace the keys (in the same order) only if any of them changed
+            if changed:
+                data.clear()
+                data.update(clean_data)
+
+        return record
+
+    def _learn(self, key):
+        """ Create and cache the plan for the given key """
+        full_key = f'{self._parent_key}.{key}' if self._parent_key else key
+
+        if (self.select_fields and full_key not in self.select_fields
+                or self.exclude_fields and full_key in self.exclude_fields):
+            plan = None
+        else:
+            plan = (INVALID_KEY_CHARS_RE.sub('_', self.renames.get(full_key, key)),
+                    KeyPlan(self.select_fields, self.exclude_fields, track_types=self.track_types,
+                            renames=self.renames, _parent_key=full_key), set())
+
+        if len(self._keys) < self.MAX_KEYS:
+            self._keys[key] = plan
+
+        return plan
+
+    def preload(self, key_schema):
+        """
+        Learn the key paths from a schema, e.g. that other processes learned, before cleaning any records
+
+        :param KeySchema key_schema: Schema with the raw key paths to learn
+        """
+        for raw_path in key_schema.keys:
+            plan = self
+            for key in raw_path:
+                entry = plan._keys.get(key) or plan._learn(key)
+                if entry is None:
+                    break
+                plan = entry[1]
+
+    def key_schema(self, key_schema=None, _parent_path=()):
+        """
+        Add the key paths that were learned, with their clean keys and value types, to a schema. Keys that were not
+        cached due to `MAX_KEYS` are not included.
+
+        :param KeySchema key_schema: Schema to add to. Defaults to a new one.
+        :rtype: KeySchema
+        """
+        if key_schema is None:
+            key_schema = KeySchema()
+
+        for key, plan in list(self._keys.items()):
+            if plan is None:
+                continue
+
+            clean_key, child_plan, value_types = plan
+            raw_path = _parent_path + (key,)
+            key_schema.add(raw_path, clean_key, set(type_name(value_type) for value_type in list(value_types)))
+            child_plan.key_schema(key_schema, _parent_path=raw_path)
+
+        return key_schema
+
+
+def compile_key_plan(select_fields=None, exclude_fields=None, track_types=False, renames=None):
+    """
+    Get a :class:`KeyPlan` for the given fields. Plans are cached, so the same plan (and what it has learned) is
+    reused for the same fields.
+
+    :param set select_fields: Set of fields to include
+    :param set exclude_fields: Set of fields to exclude
+    :param bool track_types: Record the types of values for :meth:`KeyPlan.key_schema`
+    :param dict renames: Field => new key for fields to rename
+    :rtype: KeyPlan
+    """
+    return _compile_key_plan(frozenset(select_fields or ()), frozenset(exclude_fields or ()), track_types,
+                             frozenset((renames or {}).items()))
+
+
+@lru_cache(maxsize=32)
+def _compile_key_plan(select_fields, exclude_fields, track_types, renames):
+    return KeyPlan(select_fields, exclude_fields, track_types=track_types, renames=dict(renames))
+
+
+@lru_cache(maxsize=10080)
+def local_time_strings(timestamp, timezone=DEFAULT_TIMEZONE):
+    """
+    Localized datetime and date strings for the given timestamp. Results are cached for the last week worth of minutes
+    as timestamps are rounded to the minute and data files usually cover a narrow time window.
+
+    :param int timestamp: Epoch seconds, ideally rounded to the minute
+    :param str timezone: Timezone name to localize to
+    :return: Tuple of datetime (YYYY-MM-DD HH:MM:SS) and date (YYYY-MM-DD) strings
+    """
+    local_time = datetime.fromtimestamp(timestamp, pytz.timezone(timezone))
+    return local_time.strftime('%Y-%m-%d %H:%M:%S'), local_time.strftime('%Y-%m-%d')
+
+
+def local_time_strings_batch(timestamps, timezone=DEFAULT_TIMEZONE):
+    """
+    Same as :func:`local_time_strings`, but for a batch of timestamps. Each unique timestamp is only converted once.
+
+    :param list[int] timestamps: Epoch seconds, ideally rounded to the minute
+    :param str timezone: Timezone name to localize to
+    :return: List of datetime and date string tuples in the same order as the timestamps
+    """
+    time_strings = {timestamp: local_time_strings(timestamp, timezone) for timestamp in set(timestamps)}
+    return [time_strings[timestamp] for timestamp in timestamps]
+
+
+def transform_usage_metrics_record(record, select_fields=None, exclude_fields=None, key_plan=None,
+                                   timezone=DEFAULT_TIMEZONE):
+    """
+    Transform usage metrics by removing @timestamp, add datetime_pt for Pacific Time (or the given timezone)
+    formatted datetime, and clean the keys using :func:`_clean_bigquery_keys`
 
     For example:
         Input record:
@@ -191,6 +1422,12 @@ def transform_usage_metrics_record(record, select_fields=None, exclude_fields=No
                  "instance":"",
                  "pscVersion":""},
              "timestamp":1234560}                                   <-- rounded to nearest minute
+
+    :param dict record: Usage metrics record to transform
+    :param set select_fields: Set of fields to include
+    :param set exclude_fields: Set of fields to exclude
+    :param KeyPlan key_plan: Plan to clean the keys with. Defaults to :func:`compile_key_plan` for the given fields.
+    :param str timezone: Timezone for datetime_pt and date_pt fields
     """
     # remove @timestamp as it is not as accurate as timestamp field and therefore not useful
     record.pop('@timestamp', None)
@@ -202,8 +1439,110 @@ def transform_usage_metrics_record(record, select_fields=None, exclude_fields=No
                                             delta_unit)
 
     # Add a localized Pacific date[time] for partitioning/filtering
-    pacific_time = datetime.fromtimestamp(record['timestamp'], pytz.timezone('US/Pacific'))
-    record['datetime_pt'] = pacific_time.strftime('%Y-%m-%d %H:%M:%S')
-    record['date_pt'] = pacific_time.strftime('%Y-%m-%d')
+    record['datetime_pt'], record['date_pt'] = local_time_strings(record['timestamp'], timezone)
+
+    if key_plan is None:
+        key_plan = compile_key_plan(select_fields, exclude_fields)
+
+    return key_plan.clean_in_place(record)
+
+
+def transform_usage_metrics_columnar(records, select_fields=None, exclude_fields=None, key_plan=None,
+                                     timezone=DEFAULT_TIMEZONE):
+    """
+    Same as :func:`transform_usage_metrics_record`, but for a batch of records at once. The timestamp and
+    _deltaSeconds columns are rounded as NumPy vector operations and the localized date[time] strings are derived once
+    per unique timestamp. The keys are cleaned by the key plan, which learns the clean keys once per key path.
+
+    :param list[dict] records: Usage metrics records to transform. They are modified in place.
+    :param set select_fields: Set of fields to include
+    :param set exclude_fields: Set of fields to exclude
+    :param KeyPlan key_plan: Plan to clean the keys with. Defaults to :func:`compile_key_plan` for the given fields.
+    :param str timezone: Timezone for datetime_pt and date_pt fields
+    :return: List of transformed records in the same order
+    :raises ImportError: If NumPy is not installed
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required for the columnar engine. Please install it: pip install numpy')
+
+    if key_plan is None:
+        key_plan = compile_key_plan(select_fields, exclude_fields)
+
+    metrics = [record['metric'] for record in records]
+    timestamps = round_column([record['timestamp'] for record in records])
+    delta_seconds = round_column([int(metric['_deltaSeconds']) for metric in metrics])
+
+    # Values that can not be rounded exactly as floats (e.g. huge ints) are rounded one record at a time instead
+    if timestamps is None or delta_seconds is None:
+        return [transform_usage_metrics_record(record, key_plan=key_plan, timezone=timezone) for record in records]
+
+    unique_timestamps, timestamp_indexes = numpy.unique(timestamps, return_inverse=True)
+    time_strings = [local_time_strings(timestamp, timezone) for timestamp in unique_timestamps.tolist()]
+    delta_seconds = numpy.maximum(delta_seconds, 60)
+
+    clean = key_plan.clean_in_place
+    transformed_records = []
+
+    for record, metric, timestamp, delta, timestamp_index in zip(records, metrics, timestamps.tolist(),
+                                                                 delta_seconds.tolist(), timestamp_indexes.tolist()):
+        record.pop('@timestamp', None)
+        record['timestamp'] = timestamp
+        metric['_deltaSeconds'] = delta
+        record['datetime_pt'], record['date_pt'] = time_strings[timestamp_index]
+        transformed_records.append(clean(record))
+
+    return transformed_records
+
+
+def round_column(values, unit=60):
+    """
+    Round the values to the nearest unit (e.g. minute) as a NumPy column the same way as
+    :func:`transform_usage_metrics_record`
+
+    :param list values: Numbers to round
+    :param int|float unit: Unit to round to, e.g. 60 seconds
+    :return: Column of rounded values (ints for int units) or None if the values are not numbers that can be rounded
+             exactly as floats
+    """
+    column = numpy.array(values)
+
+    if column.dtype.kind not in 'iuf' or not len(column) or not numpy.abs(column).max() < 2 ** 53:
+        return None
+
+    return numpy.trunc(column / unit + 0.5).astype(numpy.int64) * unit
+
+
+def iter_transform(records, select_fields=None, exclude_fields=None, timezone=DEFAULT_TIMEZONE, engine=RECORD_ENGINE,
+                   batch_size=1000):
+    """
+    Transform usage metrics records lazily, e.g. to chain the transform with other generators in a pipeline without
+    reading all records into memory or writing them to files.
+
+    For example::
+
+        with gzip.open('data.json.gz') as fp:
+            for record in iter_transform(json.loads(line) for line in fp):
+                ...
+
+    :param iter records: Iterable of usage metrics records to transform. They are modified in place.
+    :param set select_fields: Set of fields to include
+    :param set exclude_fields: Set of fields to exclude
+    :param str timezone: Timezone for datetime_pt and date_pt fields
+    :param str engine: Transform one record at a time with :func:`transform_usage_metrics_record` (record) or a batch
+                       of records at a time with :func:`transform_usage_metrics_columnar` (columnar)
+    :param int batch_size: Number of records to transform at a time for the columnar engine
+    :return: Iterator of transformed records in the same order
+    """
+    key_plan = compile_key_plan(select_fields, exclude_fields)
+
+    if engine == COLUMNAR_ENGINE:
+        records = iter(records)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            yield from transform_usage_metrics_columnar(batch, key_plan=key_plan, timezone=timezone)
 
-    return _clean_bigquery_keys(record, select_fields=select_fields, exclude_fields=exclude_fields)
+    else:
+        for record in records:
+            yield transform_usage_metrics_record(record, key_plan=key_plan, timezone=timezone)
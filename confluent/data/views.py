@@ -0,0 +1,156 @@
+import re
+
+
+#: Comments and string literals that should not be searched for table references
+IGNORED_SQL_RE = re.compile(r"--[^\n]*|#[^\n]*|/\*.*?\*/|'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", re.DOTALL)
+
+#: Table references in standard SQL (`project.dataset.table`), legacy SQL ([project:dataset.table]), or unquoted after
+#: FROM/JOIN (project.dataset.table)
+TABLE_REFERENCE_RE = re.compile(r'`(?P<quoted>[^`]+(?:`\.`[^`]+)*)`|\[(?P<legacy>[^\]]+)\]|'
+                                r'\b(?:FROM|JOIN)\s+(?P<unquoted>[\w-]+(?:\.[\w-]+){1,2})', re.IGNORECASE)
+
+#: Comments/string literals to keep as is or table references to rewrite in the SQL of a view
+SQL_TOKEN_RE = re.compile(rf'(?P<ignored>{IGNORED_SQL_RE.pattern})|{TABLE_REFERENCE_RE.pattern}',
+                          re.DOTALL | re.IGNORECASE)
+
+
+def table_references(sql, default_project):
+    """
+    Tables/views referenced by the SQL of a view. This only needs to find references to tables that are known, so
+    anything that looks like a table reference is returned.
+
+    :param str sql: SQL of the view
+    :param str default_project: Project for references without one, which is usually the project of the view
+    :return: Set of (project, dataset, table) tuples
+    """
+    sql = IGNORED_SQL_RE.sub(' ', sql)
+    references = set()
+
+    for match in TABLE_REFERENCE_RE.finditer(sql):
+        parts = _reference_parts(match)
+        if len(parts) == 2:
+            references.add((default_project, parts[0], parts[1]))
+        elif len(parts) == 3:
+            references.add(tuple(parts))
+
+    return references
+
+
+def rewrite_table_references(sql, default_project, datasets, target_project=None):
+    """
+    Rewrite references to tables in the given datasets to reference the same tables in other datasets, e.g. to point
+    a copied view at the copied tables. Only references whose project and dataset match exactly are rewritten, and
+    comments/string literals are left as is.
+
+    :param str sql: SQL of the view
+    :param str default_project: Project for references without one, which is usually the project of the view
+    :param dict datasets: (project, dataset) of referenced datasets => (project, dataset) to reference instead
+    :param str|None target_project: Project of the view with the rewritten SQL, which references without a project
+                                    are relative to. Defaults to the default project.
+    :return: Rewritten SQL
+    """
+    target_project = target_project or default_project
+
+    def rewrite(match):
+        if match.group('ignored'):
+            return match.group(0)
+
+        parts = _reference_parts(match)
+        relative = len(parts) == 2
+        dataset_key = (default_project, parts[0]) if relative else tuple(parts[:2])
+        if len(parts) < 2 or dataset_key not in datasets:
+            return match.group(0)
+
+        project, dataset = datasets[dataset_key]
+        table = parts[-1]
+        name_group = 'quoted' if match.group('quoted') else 'legacy' if match.group('legacy') else 'unquoted'
+        name = match.group(name_group)
+
+        if relative and project == target_project:  # Keep references without a project relative to the view
+            new_name = f'{dataset}.{table}'
+        elif name_group == 'legacy':
+            new_name = f'{project}:{dataset}.{table}'
+        else:
+            new_name = f'{project}.{dataset}.{table}'
+
+        if name_group == 'legacy':  # Keep the whitespace around the name in brackets
+            new_name = name[:len(name) - len(name.lstrip())] + new_name + name[len(name.rstrip()):]
+
+        start, end = match.span(name_group)
+        return match.group(0)[:start - match.start()] + new_name + match.group(0)[end - match.start():]
+
+    return SQL_TOKEN_RE.sub(rewrite, sql)
+
+
+def _reference_parts(match):
+    """
+    :param re.Match match: Match of :data:`TABLE_REFERENCE_RE`
+    :return: List of [project, dataset, table] or [dataset, table] for a table reference, or another number of parts
+             if it is not one
+    """
+    name = (match.group('quoted') or match.group('legacy') or match.group('unquoted')).replace('`.`', '.')
+    if match.group('legacy') and ':' in name:
+        project, name = name.rsplit(':', 1)
+        name = f'{project}.{name}'
+
+    return name.strip().rsplit('.', 2)
+
+
+class ViewGraph:
+    """
+    Dependency graph of views based on the tables/views referenced by their SQL, which is used to create views after
+    the views they reference and to skip views that reference tables that are not available.
+    """
+
+    def __init__(self):
+        #: View key => set of keys of the tables/views it references
+        self._references = {}
+
+    def add(self, key, sql):
+        """
+        Add a view to the graph
+
+        :param tuple key: Key of the view as (project, dataset, table)
+        :param str sql: SQL of the view
+        """
+        self._references[key] = table_references(sql, default_project=key[0])
+
+    def levels(self):
+        """
+        Group the views into levels where views in a level only reference views in prior levels, so views in a level
+        can be created at the same time. Views with circular references (which BigQuery does not allow, so the
+        references are likely false positives) are in the last level.
+
+        :return: List of levels with a list of view keys for each level in the order they were added
+        """
+        levels = []
+        remaining = list(self._references)
+        created = set()
+
+        while remaining:
+            remaining_keys = set(remaining)
+            level = [key for key in remaining if not (self._references[key] - {key} - created) & remaining_keys]
+            if not level:
+                level = remaining
+
+            levels.append(level)
+            created.update(level)
+            remaining = [key for key in remaining if key not in created]
+
+        return levels
+
+    def skipped(self, skipped_tables):
+        """
+        Views that should be skipped as they reference the skipped tables directly or through other views
+
+        :param set[tuple] skipped_tables: Keys of tables that were skipped
+        :return: Set of view keys to skip
+        """
+        skipped = set(skipped_tables)
+
+        for level in self.levels():
+            for key in level:
+                if self._references[key] & skipped:
+                    skipped.add(key)
+
+        return skipped - set(skipped_tables)
@@ -0,0 +1,342 @@
+from collections import Counter, deque
+import re
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import BadRequest, Conflict, Forbidden, GoogleAPICallError, NotFound
+from google.cloud.bigquery import DatasetReference, Table
+from google.cloud.bigquery.dataset import DatasetListItem
+from google.cloud.bigquery.table import TableListItem
+
+
+#: Dataset in the `__TABLES__` meta table query from :meth:`confluent.data.admins.BigQueryAdmin._table_stats_query`
+TABLES_QUERY_RE = re.compile(r'FROM `([^`.]+)\.([^`.]+)\.__TABLES__`')
+
+#: Replace clause, target and source tables of a statement in :func:`confluent.data.admins.copy_script`
+COPY_STATEMENT_RE = re.compile(r'CREATE (OR REPLACE )?TABLE `([^`]+)` COPY `([^`]+)`;')
+
+
+def quota_error(message='Quota exceeded'):
+    """ Error that BigQuery raises when a quota is exceeded, which can be retried """
+    return Forbidden(message, errors=[{'reason': 'quotaExceeded'}])
+
+
+class FakeJob:
+    """ Copy/query job of :class:`FakeBigQueryClient` that is done after the given number of seconds """
+
+    def __init__(self, seconds, project, on_done=None, rows=None, job_id=None):
+        """
+        :param float seconds: Seconds that the job takes to complete
+        :param str project: Project that runs the job
+        :param callable on_done: Called once when the job is done, e.g. to copy the table. The job fails with the API
+                                 error that it raises.
+        :param list rows: Rows that :meth:`result` returns
+        :param str job_id: ID of the job. Defaults to a random one.
+        """
+        self.job_id = job_id or uuid.uuid4().hex
+        self.project = project
+        self.location = 'US'
+        self.error_result = None
+
+        self._done_time = time.time() + seconds
+        self._on_done = on_done
+        self._rows = rows or []
+        self._error = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return 'DONE' if self.done() else 'RUNNING'
+
+    @property
+    def running(self):
+        """ True if the job is still running, without completing it like :meth:`done` """
+        return time.time() < self._done_time
+
+    def done(self):
+        if time.time() < self._done_time:
+            return False
+
+        with self._lock:
+            if self._on_done:
+                on_done, self._on_done = self._on_done, None
+                try:
+                    on_done()
+                except GoogleAPICallError as e:
+                    self._error = e
+                    reason = 'duplicate' if isinstance(e, Conflict) else 'invalid'
+                    self.error_result = {'reason': reason, 'message': e.message}
+
+        return True
+
+    def result(self):
+        """ Wait for the job to complete and return the rows """
+        while not self.done():
+            time.sleep(min(0.01, max(self._done_time - time.time(), 0)))
+
+        if self._error:
+            raise self._error
+
+        return self._rows
+
+
+class FakeBigQueryClient:
+    """
+    In-memory stand-in for :class:`google.cloud.bigquery.Client` with the methods that the admins use, so they can be
+    tested and benchmarked without a GCP project. Projects, datasets, tables, views and copy jobs are kept in memory,
+    and API calls are counted, take the given latency, and can be set to fail with quota errors.
+
+    Copy jobs (and scripts from :func:`confluent.data.admins.copy_script`) copy the table when they are done, and
+    queries on the `__TABLES__` meta table return the number of rows and bytes of the tables. Other queries are not
+    supported. Like BigQuery, a copy job (or `CREATE TABLE ... COPY` statement) fails with a conflict when the target
+    table exists, and so does starting a job with the ID of an existing job.
+    """
+
+    def __init__(self, project='fake-project', latency=0.0, job_seconds=0.0, max_running_jobs=None):
+        """
+        :param str project: Default project for dataset references and jobs
+        :param float|dict latency: Seconds that each API call takes, or a dict of method name => seconds
+        :param float job_seconds: Seconds that each copy/query job takes to complete
+        :param int|None max_running_jobs: Maximum number of jobs that can run at the same time. Starting more jobs
+                                          fails with a quota error like the concurrent job quota of BigQuery.
+        """
+        self.project = project
+        self.latency = latency
+        self.job_seconds = job_seconds
+        self.max_running_jobs = max_running_jobs
+
+        #: API method name => number of calls
+        self.api_calls = Counter()
+
+        #: Maximum number of jobs that were running at the same time
+        self.peak_running_jobs = 0
+
+        #: (project, dataset_id) => table ID => table resource
+        self._datasets = {}
+
+        #: Job ID => job
+        self._jobs = {}
+
+        #: API method name => queue of errors to raise for the next calls
+        self._errors = {}
+
+        self._lock = threading.RLock()
+
+    def add_dataset(self, project, dataset_id):
+        """ Add an empty dataset without making an API call """
+        with self._lock:
+            self._datasets.setdefault((project, dataset_id), {})
+
+    def add_table(self, project, dataset_id, table_id, num_rows=1000, num_bytes=1024 * 1024, view_query=None,
+                  table_type=None, fields=('id', 'loaded_at')):
+        """
+        Add a table to the dataset (which is added if it doesn't exist) without making an API call
+
+        :param int num_rows: Number of rows of the table
+        :param int num_bytes: Size of the table in bytes
+        :param str view_query: SQL of the view to add a view instead
+        :param str table_type: Type of table, e.g. EXTERNAL. Defaults to TABLE or VIEW based on `view_query`.
+        :param tuple fields: Names of the fields in the schema
+        """
+        resource = {'tableReference': {'projectId': project, 'datasetId': dataset_id, 'tableId': table_id},
+                    'type': table_type or ('VIEW' if view_query else 'TABLE'),
+                    'schema': {'fields': [{'name': field, 'type': 'STRING'} for field in fields]},
+                    'numRows': str(num_rows), 'numBytes': str(num_bytes)}
+        if view_query:
+            resource['view'] = {'query': view_query, 'useLegacySql': False}
+
+        with self._lock:
+            self._datasets.setdefault((project, dataset_id), {})[table_id] = resource
+
+    def tables(self, project, dataset_id):
+        """
+        :return: Dict of table ID => table resource for the dataset without making an API call
+        :raises KeyError: If the dataset does not exist
+        """
+        with self._lock:
+            return dict(self._datasets[(project, dataset_id)])
+
+    def fail(self, method, error=None, times=1):
+        """
+        Fail the next calls of the API method with the error
+
+        :param str method: Name of the API method, e.g. get_table
+        :param Exception error: Error to raise. Defaults to a quota error.
+        :param int times: Number of calls to fail
+        """
+        with self._lock:
+            self._errors.setdefault(method, deque()).extend([error or quota_error()] * times)
+
+    @property
+    def running_jobs(self):
+        """ Number of jobs that are not done """
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.running)
+
+    def dataset(self, dataset_id, project=None):
+        return DatasetReference(project or self.project, dataset_id)
+
+    def list_datasets(self, project=None):
+        self._call('list_datasets')
+        project = project or self.project
+        with self._lock:
+            return [DatasetListItem({'datasetReference': {'projectId': p, 'datasetId': dataset_id}})
+                    for p, dataset_id in sorted(self._datasets) if p == project]
+
+    def list_tables(self, dataset):
+        self._call('list_tables')
+        with self._lock:
+            return [TableListItem(resource) for resource in self._dataset(dataset).values()]
+
+    def get_table(self, table_ref):
+        self._call('get_table')
+        with self._lock:
+            return Table.from_api_repr(self._table(table_ref))
+
+    def create_table(self, table, exists_ok=False):
+        self._call('create_table')
+        resource = dict(table.to_api_repr(), type='VIEW' if table.view_query else 'TABLE', numRows='0', numBytes='0')
+
+        with self._lock:
+            tables = self._dataset(table)
+            if table.table_id in tables:
+                if not exists_ok:
+                    raise Conflict(f'Already Exists: Table {table.project}:{table.dataset_id}.{table.table_id}')
+                return Table.from_api_repr(tables[table.table_id])
+
+            tables[table.table_id] = resource
+
+        return Table.from_api_repr(resource)
+
+    def create_dataset(self, dataset_ref, exists_ok=False):
+        self._call('create_dataset')
+        dataset_key = (dataset_ref.project, dataset_ref.dataset_id)
+
+        with self._lock:
+            if dataset_key in self._datasets and not exists_ok:
+                raise Conflict(f'Already Exists: Dataset {dataset_ref.project}:{dataset_ref.dataset_id}')
+            self._datasets.setdefault(dataset_key, {})
+
+    def delete_dataset(self, dataset_ref, delete_contents=False, not_found_ok=False):
+        self._call('delete_dataset')
+        dataset_key = (dataset_ref.project, dataset_ref.dataset_id)
+
+        with self._lock:
+            if dataset_key not in self._datasets:
+                if not_found_ok:
+                    return
+                raise NotFound(f'Not found: Dataset {dataset_ref.project}:{dataset_ref.dataset_id}')
+
+            if self._datasets[dataset_key] and not delete_contents:
+                raise BadRequest(f'Dataset {dataset_ref.project}:{dataset_ref.dataset_id} is still in use')
+
+            del self._datasets[dataset_key]
+
+    def copy_table(self, source_table_ref, target_table_ref, job_id=None):
+        self._call('copy_table')
+        copy = (_table_key(source_table_ref), _table_key(target_table_ref))
+
+        with self._lock:
+            self._table(source_table_ref)
+            self._dataset(target_table_ref)
+            return self._start_job(lambda: self._copy(*copy), job_id=job_id)
+
+    def query(self, query, job_id=None):
+        self._call('query')
+
+        match = TABLES_QUERY_RE.search(query)
+        if match:
+            with self._lock:
+                if match.groups() not in self._datasets:
+                    raise NotFound(f'Not found: Dataset {match.group(1)}:{match.group(2)}')
+                rows = [_TableStats(resource) for resource in self._datasets[match.groups()].values()
+                        if resource['type'] == 'TABLE']
+            return FakeJob(0, self.project, rows=rows, job_id=job_id)
+
+        copies = [(tuple(source.split('.')), tuple(target.split('.')), bool(replace))
+                  for replace, target, source in COPY_STATEMENT_RE.findall(query)]
+        if not copies:
+            raise BadRequest(f'Query is not supported by the fake client: {query}')
+
+        with self._lock:
+            for source, target, _ in copies:
+                self._table(source)
+                self._dataset(target)
+            return self._start_job(lambda: [self._copy(*copy) for copy in copies], job_id=job_id)
+
+    def get_job(self, job_id, project=None, location=None):
+        self._call('get_job')
+        with self._lock:
+            if job_id not in self._jobs:
+                raise NotFound(f'Not found: Job {project or self.project}:{location or "US"}.{job_id}')
+            return self._jobs[job_id]
+
+    def _call(self, method):
+        """ Count the API call, wait for the latency, and raise an error if the method was set to fail """
+        with self._lock:
+            self.api_calls[method] += 1
+            errors = self._errors.get(method)
+            error = errors.popleft() if errors else None
+
+        latency = self.latency.get(method, 0) if isinstance(self.latency, dict) else self.latency
+        if latency:
+            time.sleep(latency)
+
+        if error:
+            raise error
+
+    def _start_job(self, on_done, job_id=None):
+        if job_id in self._jobs:
+            raise Conflict(f'Already Exists: Job {self.project}:US.{job_id}')
+
+        running_jobs = self.running_jobs
+        if self.max_running_jobs is not None and running_jobs >= self.max_running_jobs:
+            raise quota_error(f'Quota exceeded: Your project exceeded quota for concurrent jobs '
+                              f'({self.max_running_jobs})')
+
+        job = FakeJob(self.job_seconds, self.project, on_done=on_done, job_id=job_id)
+        self._jobs[job.job_id] = job
+        self.peak_running_jobs = max(self.peak_running_jobs, running_jobs + 1)
+        return job
+
+    def _dataset(self, ref):
+        """ Tables of the dataset for a dataset/table ref or (project, dataset_id, ...) tuple """
+        dataset_key = _table_key(ref)[:2]
+        if dataset_key not in self._datasets:
+            raise NotFound(f'Not found: Dataset {dataset_key[0]}:{dataset_key[1]}')
+        return self._datasets[dataset_key]
+
+    def _table(self, ref):
+        table_key = _table_key(ref)
+        tables = self._dataset(table_key)
+        if table_key[2] not in tables:
+            raise NotFound(f'Not found: Table {table_key[0]}:{table_key[1]}.{table_key[2]}')
+        return tables[table_key[2]]
+
+    def _copy(self, source_key, target_key, replace=False):
+        """ Copy the table, which fails if the target table exists unless it is replaced """
+        with self._lock:
+            if not replace and target_key[2] in self._dataset(target_key):
+                raise Conflict(f'Already Exists: Table {target_key[0]}:{target_key[1]}.{target_key[2]}')
+
+            resource = dict(self._table(source_key))
+            resource['tableReference'] = {'projectId': target_key[0], 'datasetId': target_key[1],
+                                          'tableId': target_key[2]}
+            self._dataset(target_key)[target_key[2]] = resource
+
+
+class _TableStats:
+    """ Row of the `__TABLES__` meta table """
+
+    def __init__(self, resource):
+        self.table_id = resource['tableReference']['tableId']
+        self.row_count = int(resource['numRows'])
+        self.size_bytes = int(resource['numBytes'])
+
+
+def _table_key(ref):
+    """ (project, dataset_id[, table_id]) for a dataset/table ref, or the ref if it is a tuple already """
+    if isinstance(ref, tuple):
+        return ref
+    return (ref.project, ref.dataset_id) + ((ref.table_id,) if hasattr(ref, 'table_id') else ())
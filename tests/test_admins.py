@@ -1,73 +1,501 @@
-from google.api_core.exceptions import NotFound
+import asyncio
+from contextlib import closing
+import json
+import os
+import threading
+
+from google.api_core.exceptions import BadRequest, Conflict, Forbidden, InternalServerError, TooManyRequests
 from mock import Mock
 import pytest
+from utils.fs import in_temp_dir
 
+from confluent.data.admins import BigQueryAdmin, CopyJobScheduler
+from confluent.data.async_admins import AsyncBigQueryAdmin, AsyncBigQueryClient, RateLimiter, is_retryable
+from confluent.data.checkpoints import CopyCheckpoint
 from confluent.data.scripts import bq_admin
+from fakes import FakeBigQueryClient
+
+
+def _copy_job(job_id, state='DONE', error_result=None):
+    return Mock(job_id=job_id, project='project-2', location='US', state=state, error_result=error_result)
+
+
+def _table_item(table_id, table_type='TABLE'):
+    return Mock(table_type=table_type, reference=Mock(project='project', dataset_id='dataset', table_id=table_id))
+
+
+def _dataset_ref(dataset_id, project):
+    return Mock(project=project, dataset_id=dataset_id,
+                table=lambda table_id: Mock(project=project, dataset_id=dataset_id, table_id=table_id))
 
 
 @pytest.fixture
 def bq_client(monkeypatch):
     client = Mock()
-    client().dataset.return_value = Mock(table=Mock(side_effect=[
-        Mock(table_id='table1'),
-        Mock(table_id='table2'),
-        Mock(table_id='table3'),
-        Mock(table_id='table4'),
-        Mock(table_id='table5'),
-        Mock(table_id='table6'),
-        ]))
-    client().list_tables.return_value = [
-        Mock(reference=Mock(table_id='table1')),
-        Mock(reference=Mock(table_id='table2'))]
+    client().dataset.side_effect = _dataset_ref
+    client().list_tables.return_value = [_table_item('table1'), _table_item('table2')]
     monkeypatch.setattr('google.cloud.bigquery.Client', client)
-    return client
+
+    with in_temp_dir():
+        yield client
 
 
 def test_create_views(bq_client, cli_runner, test_data):
     name_mock = Mock()
     name_mock.name = 'id'
+    bq_client().list_tables.side_effect = [
+        [_table_item('table1'), _table_item('table2'), _table_item('table2_view', 'VIEW'), _table_item('_table')],
+        [_table_item('table3'), _table_item('table4'), _table_item('table5', 'EXTERNAL')],
+    ]
     bq_client().get_table.side_effect = [
         Mock(table_type='TABLE', table_id='table1', schema=[name_mock, Mock()]),
-        NotFound('table1 was not found'),
-        Mock(table_type='TABLE', table_id='table2', schema=[name_mock, Mock()]),
-        Mock(table_type='TABLE', table_id='table2', schema=[name_mock, Mock()]),
         Mock(table_type='TABLE', table_id='table3', schema=[name_mock, Mock()]),
-        NotFound('table3 was not found'),
         Mock(table_type='TABLE', table_id='table4', schema=[name_mock, Mock()]),
-        NotFound('table4 was not found'),
-        Mock(table_type='TABLE', table_id='table5', schema=[name_mock, Mock()]),
-        NotFound('table5 was not found'),
-        Mock(table_type='TABLE', table_id='table6', schema=[name_mock, Mock()]),
-        NotFound('table6 was not found'),
     ]
     result = cli_runner.invoke_and_assert_exit(
         0, bq_admin, ['create-views', str(test_data.path('bigquery-view-specs.json'))])
     assert result.stdout == """\
 Creating views for project-12345.marketo
-  - table1
-  - table2 (already exists)
+  - table1_view
+  - table2_view (already exists)
 Creating views for project-12345.salesforce
-  - table3
-  - table4
+  - table3_view
+  - table4_view
+Made 5 metadata API call(s) and saved 11 using cached metadata
 """
+    assert bq_client().create_table.call_count == 3
+    assert bq_client().get_table.call_count == 3
 
 
 def test_move_dataset(bq_client, cli_runner):
-    bq_client().copy_table.side_effect = [
-        Mock(state='DONE'),
-        Mock(state='DONE')
-    ]
-    bq_client().get_table.side_effect = [
-        Mock(table_type='TABLE', table_id='table1', num_rows=10),
-        Mock(table_type='TABLE', table_id='table1', num_rows=10),
-        Mock(table_type='TABLE', table_id='table1', num_rows=10),
-        Mock(table_type='TABLE', table_id='table2', num_rows=20),
-        Mock(table_type='TABLE', table_id='table2', num_rows=20),
-        Mock(table_type='TABLE', table_id='table2', num_rows=20),
+    bq_client().copy_table.side_effect = [_copy_job('job1'), _copy_job('job2')]
+    bq_client().list_tables.return_value = [_table_item('table1'), _table_item('table2')]
+    bq_client().query.return_value.result.return_value = [
+        Mock(table_id='table1', row_count=10, size_bytes=100),
+        Mock(table_id='table2', row_count=20, size_bytes=200),
     ]
     result = cli_runner.invoke_and_assert_exit(0, bq_admin, ['move-dataset', 'project-1:dataset', 'project-2'])
     assert result.stdout == """\
 Moving project-1:dataset to project-2
   - table1
   - table2
+Made 2 metadata API call(s) and saved 3 using cached metadata
+"""
+    assert not bq_client().get_table.called
+    assert not os.listdir('.'), 'Checkpoint should be removed when done'
+
+
+def test_copy_dataset_resume(bq_client, cli_runner):
+    bq_client().copy_table.side_effect = [_copy_job('job1'), _copy_job('job2'), Exception('Interrupted')]
+    bq_client().list_tables.return_value = [_table_item('table1'), _table_item('table2'), _table_item('table3'),
+                                            _table_item('table4'), _table_item('view1', 'VIEW')]
+    bq_client().get_table.return_value = Mock(view_query='SELECT * FROM table1', view_use_legacy_sql=False)
+
+    with pytest.raises(Exception, match='Interrupted'):
+        BigQueryAdmin().copy_dataset('project-1:dataset', 'project-2')
+
+    checkpoint_file = '.bq-admin-checkpoint-project-1.dataset-project-2.dataset.json'
+    with open(checkpoint_file) as fp:
+        assert json.load(fp)['tables'] == {
+            'table1': {'state': 'copying', 'job_id': 'job1', 'project': 'project-2', 'location': 'US'},
+            'table2': {'state': 'copying', 'job_id': 'job2', 'project': 'project-2', 'location': 'US'}}
+
+    # Pretend table1 was verified and job2 failed
+    checkpoint = CopyCheckpoint('project-1.dataset', 'project-2.dataset')
+    checkpoint.load()
+    checkpoint.set('table1', CopyCheckpoint.VERIFIED)
+    checkpoint.set('table3', CopyCheckpoint.COPYING, job=_copy_job('job3'))
+
+    bq_client().copy_table.reset_mock()
+    bq_client().copy_table.side_effect = [_copy_job('job2-retry'), _copy_job('job4')]
+    bq_client().get_job.side_effect = lambda job_id, **kwargs: _copy_job(
+        job_id, error_result={'reason': 'stopped'} if job_id == 'job2' else None)
+    bq_client().query.return_value.result.return_value = [
+        Mock(table_id=f'table{i}', row_count=i, size_bytes=i) for i in range(1, 5)]
+    bq_client().list_tables.side_effect = [
+        [_table_item('table1'), _table_item('table2'), _table_item('table3'), _table_item('table4'),
+         _table_item('view1', 'VIEW')]] * 2
+
+    result = cli_runner.invoke_and_assert_exit(0, bq_admin, ['copy-dataset', '--resume', 'project-1:dataset',
+                                                             'project-2'])
+    assert result.stdout.startswith("""\
+Copying project-1:dataset to project-2
+Resuming from checkpoint .bq-admin-checkpoint-project-1.dataset-project-2.dataset.json
+  - table1 (already copied)
+  - table2
+  - table3
+    Reattached to copy job job3
+  - table4
+  - view1 (view)
+""")
+    assert [c[0][0].table_id for c in bq_client().copy_table.call_args_list] == ['table2', 'table4']
+    bq_client().create_dataset.assert_called_with(bq_client().create_dataset.call_args[0][0], exists_ok=True)
+    assert not os.path.exists(checkpoint_file)
+
+
+def test_copy_dataset_row_count_mismatch(bq_client):
+    bq_client().copy_table.side_effect = [_copy_job('job1'), _copy_job('job2')]
+    bq_client().list_tables.return_value = [_table_item('table1'), _table_item('table2')]
+    bq_client().query.return_value.result.side_effect = [
+        [Mock(table_id='table1', row_count=10, size_bytes=100), Mock(table_id='table2', row_count=20)],
+        [Mock(table_id='table1', row_count=10, size_bytes=100), Mock(table_id='table2', row_count=2)],
+    ]
+
+    with pytest.raises(AssertionError, match='Number of rows does not match for table table2'):
+        BigQueryAdmin().copy_dataset('project-1:dataset', 'project-2')
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_copy_project(bq_client, cli_runner, engine):
+    bq_client().list_datasets.return_value = [Mock(dataset_id='sales'), Mock(dataset_id='logs'),
+                                              Mock(dataset_id='marketing')]
+    bq_client().copy_table.side_effect = [_copy_job(f'job{i}') for i in range(4)]
+    bq_client().list_tables.side_effect = lambda dataset: [
+        Mock(table_type=table_type, reference=dataset.table(table_id))
+        for table_id, table_type in [('table1', 'TABLE'), ('view2', 'VIEW'), ('view1', 'VIEW'), ('table2', 'TABLE')]]
+    bq_client().get_table.side_effect = lambda table_ref: Mock(
+        view_use_legacy_sql=False,
+        view_query=('SELECT * FROM `project-1.logs.view1`' if table_ref.table_id == 'view2'
+                    else f'SELECT * FROM {table_ref.dataset_id}.table1'))
+    bq_client().query.return_value.result.return_value = [
+        Mock(table_id='table1', row_count=10, size_bytes=1024 * 1024),
+        Mock(table_id='table2', row_count=20, size_bytes=1024 * 1024),
+    ]
+
+    result = cli_runner.invoke_and_assert_exit(0, bq_admin, ['copy-project', '--datasets', '*s', '--engine', engine,
+                                                             'project-1', 'project-2'])
+    assert result.stdout.startswith("""\
+Copying datasets matching *s from project-1 to project-2
+project-1.logs
+  - logs.table1
+  - logs.table2
+project-1.sales
+  - sales.table1
+  - sales.table2
+  - logs.view1 (view)
+  - sales.view1 (view)
+  - logs.view2 (view)
+  - sales.view2 (view)
+Throughput:
+  - project-1.logs: 2 table(s) and 2.0 MB in """)
+    assert '  - Overall: 4 table(s) and 4.0 MB in ' in result.stdout
+    assert [(c[0][0].project, c[0][0].dataset_id) for c in bq_client().create_dataset.call_args_list] == [
+        ('project-2', 'logs'), ('project-2', 'sales')]
+    assert bq_client().copy_table.call_count == 4
+    # Views of both datasets reference logs.view1, which is pointed at the copy in project-2
+    assert [c[0][0].view_query for c in bq_client().create_table.call_args_list][2:] == [
+        'SELECT * FROM `project-2.logs.view1`', 'SELECT * FROM `project-2.logs.view1`']
+    assert not os.listdir('.'), 'Checkpoints should be removed when done'
+
+    cli_runner.invoke_and_assert_exit(1, bq_admin, ['copy-project', 'project-1', 'project-1'])
+    result = cli_runner.invoke_and_assert_exit(1, bq_admin, ['copy-project', '--datasets', 'x*', 'project-1',
+                                                             'project-2'])
+    assert 'No datasets in project project-1 matches x*' in result.output
+
+
+def test_copy_dataset_view_dependencies(bq_client, cli_runner):
+    view_queries = {
+        'view_c': 'SELECT * FROM `project-1.dataset.view_b` JOIN dataset.view_a USING (id)',
+        'view_b': 'SELECT * FROM project-1.dataset.view_a',
+        'view_a': 'SELECT * FROM [project-1:dataset.table1]',
+        'ext_view': 'SELECT * FROM `project-1.dataset.ext`',
+        'ext_view2': 'SELECT * FROM `project-1.dataset.ext_view` -- Not FROM dataset.view_a',
+        'ext2_view': 'SELECT * FROM `project-1.dataset.ext2`',
+    }
+    bq_client().list_tables.side_effect = lambda dataset: [
+        Mock(table_type=table_type, reference=dataset.table(table_id))
+        for table_id, table_type in [('view_c', 'VIEW'), ('ext2_view', 'VIEW'), ('ext_view2', 'VIEW'),
+                                     ('view_b', 'VIEW'), ('ext_view', 'VIEW'), ('view_a', 'VIEW'),
+                                     ('ext', 'EXTERNAL'), ('table1', 'TABLE'), ('ext2', 'TABLE')]
+        if dataset.project == 'project-1' or table_id not in ('ext', 'ext_view', 'ext_view2')]
+    bq_client().get_table.side_effect = lambda table_ref: Mock(view_use_legacy_sql=False,
+                                                               view_query=view_queries[table_ref.table_id])
+    bq_client().copy_table.side_effect = [_copy_job('job1'), _copy_job('job2')]
+    bq_client().query.return_value.result.return_value = [
+        Mock(table_id='table1', row_count=1, size_bytes=1), Mock(table_id='ext2', row_count=2, size_bytes=2)]
+
+    result = cli_runner.invoke_and_assert_exit(0, bq_admin, ['copy-dataset', 'project-1:dataset', 'project-2'])
+    assert result.stdout == """\
+Copying project-1:dataset to project-2
+  - ext
+    Skipped due to unsupported table type: EXTERNAL
+  - table1
+  - ext2
+  - ext2_view (view)
+  - ext_view (view)
+    Skipped as view references an unsupported table that was not copied
+  - view_a (view)
+  - ext_view2 (view)
+    Skipped as view references an unsupported table that was not copied
+  - view_b (view)
+  - view_c (view)
+Made 8 metadata API call(s) and saved 10 using cached metadata
 """
+    view_queries = [c[0][0].view_query for c in bq_client().create_table.call_args_list]
+    assert sorted(view_queries[:2]) == ['SELECT * FROM [project-2:dataset.table1]',
+                                        'SELECT * FROM `project-2.dataset.ext2`']
+    assert view_queries[2:] == [
+        'SELECT * FROM project-2.dataset.view_a',
+        'SELECT * FROM `project-2.dataset.view_b` JOIN dataset.view_a USING (id)']
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_copy_dataset_batched(bq_client, cli_runner, engine):
+    scripts = []
+
+    def query(sql, **kwargs):
+        if sql.startswith('SELECT'):
+            return Mock(result=Mock(return_value=[Mock(table_id=f'table{i}', row_count=i, size_bytes=i)
+                                                  for i in range(1, 4)]))
+        scripts.append(sql)
+        return _copy_job('script-job')
+
+    bq_client().query.side_effect = query
+    bq_client().copy_table.return_value = _copy_job('copy-job')
+    bq_client().list_tables.side_effect = lambda dataset: [Mock(table_type='TABLE', reference=dataset.table(table_id))
+                                                           for table_id in ['table1', 'table2', 'table3']]
+
+    cli_runner.invoke_and_assert_exit(0, bq_admin, ['copy-dataset', '--batch-size', '2', '--engine', engine,
+                                                    'project-1:dataset', 'project-2'])
+    assert scripts == ['CREATE TABLE `project-2.dataset.table1` COPY `project-1.dataset.table1`;\n'
+                       'CREATE TABLE `project-2.dataset.table2` COPY `project-1.dataset.table2`;']
+    assert bq_client().copy_table.call_args[0][0].table_id == 'table3'
+
+    # Batched tables share the job that is reattached once
+    checkpoint = CopyCheckpoint('project-1.dataset', 'project-2.dataset')
+
+    def interrupt_copy():
+        for table_id in ['table1', 'table2', 'table3']:
+            checkpoint.set(table_id, CopyCheckpoint.COPYING, job=_copy_job('script-job'))
+
+    interrupt_copy()
+    bq_client().get_job.side_effect = lambda job_id, **kwargs: _copy_job(job_id)
+    bq_client().copy_table.reset_mock()
+    scripts.clear()
+
+    result = cli_runner.invoke_and_assert_exit(0, bq_admin, ['copy-dataset', '--batch-size', '2', '--engine', engine,
+                                                             '--resume', 'project-1:dataset', 'project-2'])
+    assert result.stdout.count('Reattached to copy job script-job') == 3
+    assert bq_client().get_job.call_count == 1
+    assert not scripts and not bq_client().copy_table.called
+
+    # Tables of a script that failed are copied again by a script that replaces the tables it may have copied
+    interrupt_copy()
+    bq_client().get_job.side_effect = lambda job_id, **kwargs: _copy_job(job_id, error_result={'reason': 'stopped'})
+
+    cli_runner.invoke_and_assert_exit(0, bq_admin, ['copy-dataset', '--batch-size', '2', '--engine', engine,
+                                                    '--resume', 'project-1:dataset', 'project-2'])
+    assert scripts == ['CREATE OR REPLACE TABLE `project-2.dataset.table1` COPY `project-1.dataset.table1`;\n'
+                       'CREATE OR REPLACE TABLE `project-2.dataset.table2` COPY `project-1.dataset.table2`;']
+
+
+def test_copy_job_scheduler():
+    client = Mock()
+    jobs = [Mock(state='DONE', done=Mock(side_effect=[False, True])),
+            Mock(state='DONE', done=Mock(side_effect=[True])),
+            Mock(state='DONE', done=Mock(side_effect=[False, False, True]))]
+    client.copy_table.side_effect = jobs
+
+    scheduler = CopyJobScheduler(client, max_concurrent_jobs=2, poll_interval=0)
+    scheduler.submit('source1', 'target1')
+    scheduler.submit('source2', 'target2')
+    assert client.copy_table.call_count == 2
+
+    # Waits for a job to complete before starting the 3rd one
+    scheduler.submit('source3', 'target3')
+    assert client.copy_table.call_count == 3
+    assert jobs[1].result.called
+
+    assert scheduler.wait() == [('source2', 'target2'), ('source1', 'target1'), ('source3', 'target3')]
+
+
+def test_copy_job_scheduler_error():
+    client = Mock()
+    client.copy_table.return_value.result.side_effect = Exception('Copy failed')
+
+    scheduler = CopyJobScheduler(client)
+    scheduler.submit('source1', 'target1')
+
+    with pytest.raises(Exception, match='Copy failed'):
+        scheduler.wait()
+
+
+def test_create_views_async(bq_client, cli_runner, test_data):
+    name_mock = Mock()
+    name_mock.name = 'id'
+    bq_client().list_tables.side_effect = lambda dataset: {
+        'marketo': [_table_item('table1'), _table_item('table2'), _table_item('table2_view', 'VIEW')],
+        'salesforce': [_table_item('table3'), _table_item('table4'), _table_item('table5', 'EXTERNAL')],
+    }[dataset.dataset_id]
+    bq_client().get_table.side_effect = lambda table_ref: Mock(table_type='TABLE', table_id=table_ref.table_id,
+                                                               schema=[name_mock, Mock()])
+
+    # Each view is only created once all 3 are being created at the same time
+    barrier = threading.Barrier(3, timeout=5)
+    bq_client().create_table.side_effect = lambda table, exists_ok=False: barrier.wait()
+
+    result = cli_runner.invoke_and_assert_exit(
+        0, bq_admin, ['create-views', '--engine', 'async', str(test_data.path('bigquery-view-specs.json'))])
+    assert result.stdout == """\
+Creating views for project-12345.marketo
+  - table1_view
+  - table2_view (already exists)
+Creating views for project-12345.salesforce
+  - table3_view
+  - table4_view
+Made 5 metadata API call(s) and saved 15 using cached metadata
+"""
+    assert sorted(c[0][0].view_query.split('`')[1] for c in bq_client().create_table.call_args_list) == [
+        'project-12345.marketo.table1', 'project-12345.salesforce.table3', 'project-12345.salesforce.table4']
+
+
+def test_copy_dataset_async(bq_client, cli_runner):
+    bq_client().copy_table.side_effect = [_copy_job('job1'), _copy_job('job2')]
+    bq_client().list_tables.return_value = [_table_item('table1'), _table_item('table2'),
+                                            _table_item('view1', 'VIEW')]
+    bq_client().get_table.return_value = Mock(view_query='SELECT * FROM `project-1.dataset.table1`',
+                                              view_use_legacy_sql=False)
+    bq_client().query.return_value.result.return_value = [
+        Mock(table_id='table1', row_count=10, size_bytes=100),
+        Mock(table_id='table2', row_count=20, size_bytes=200),
+    ]
+
+    result = cli_runner.invoke_and_assert_exit(0, bq_admin, ['copy-dataset', '--engine', 'async',
+                                                             'project-1:dataset', 'project-2'])
+    assert result.stdout == """\
+Copying project-1:dataset to project-2
+  - table1
+  - table2
+  - view1 (view)
+Made 3 metadata API call(s) and saved 6 using cached metadata
+"""
+    assert bq_client().copy_table.call_count == 2
+    assert len({c[1]['job_id'] for c in bq_client().copy_table.call_args_list}) == 2
+    assert bq_client().create_table.call_args[0][0].view_query == 'SELECT * FROM `project-2.dataset.table1`'
+    assert not os.listdir('.'), 'Checkpoint should be removed when done'
+
+
+def test_copy_dataset_async_row_count_mismatch(bq_client):
+    bq_client().copy_table.side_effect = [_copy_job('job1'), _copy_job('job2')]
+    bq_client().query.side_effect = lambda query, **kwargs: Mock(result=Mock(return_value=[
+        Mock(table_id='table1', row_count=10, size_bytes=100),
+        Mock(table_id='table2', row_count=2 if 'project-2' in query else 20)]))
+
+    with pytest.raises(AssertionError, match='Number of rows does not match for table table2'):
+        AsyncBigQueryAdmin(poll_interval=0).copy_dataset('project-1:dataset', 'project-2')
+
+
+def test_async_client_retries():
+    client = Mock()
+    client.get_table.side_effect = [TooManyRequests('Slow down'),
+                                    Forbidden('Rate limited', errors=[{'reason': 'rateLimitExceeded'}]),
+                                    Mock(table_id='table1')]
+    async_client = AsyncBigQueryClient(client, max_calls_per_sec=None, initial_backoff=0)
+
+    with closing(async_client):
+        assert asyncio.run(async_client.get_table('table1')).table_id == 'table1'
+        assert async_client.retries == 2
+
+        async_client.max_retries = 1
+        client.get_table.side_effect = TooManyRequests('Slow down')
+        with pytest.raises(TooManyRequests):
+            asyncio.run(async_client.get_table('table1'))
+
+        client.get_table.side_effect = BadRequest('Bad table')
+        with pytest.raises(BadRequest):
+            asyncio.run(async_client.get_table('table1'))
+        assert async_client.retries == 3
+
+    assert async_client.executor is None
+
+
+def test_async_client_create_job():
+    client = Mock()
+    client.copy_table.side_effect = [InternalServerError('Backend error'), Conflict('Already Exists: Job')]
+    client.get_job.side_effect = lambda job_id, **kwargs: _copy_job(job_id)
+    async_client = AsyncBigQueryClient(client, max_calls_per_sec=None, initial_backoff=0)
+
+    with closing(async_client):
+        job = asyncio.run(async_client.copy_table('source', 'target'))
+
+    # The retry has the same job ID, so the job that was created by the failed call is returned instead of a duplicate
+    job_ids = [c[1]['job_id'] for c in client.copy_table.call_args_list]
+    assert len(job_ids) == 2 and job_ids[0] == job_ids[1] == job.job_id
+    assert client.get_job.call_count == 1
+
+
+def test_is_retryable():
+    assert is_retryable(TooManyRequests('Slow down'))
+    assert is_retryable(Forbidden('Quota', errors=[{'reason': 'quotaExceeded'}]))
+    assert not is_retryable(Forbidden('Access denied', errors=[{'reason': 'accessDenied'}]))
+    assert not is_retryable(BadRequest('Bad table'))
+
+
+def test_rate_limiter(monkeypatch):
+    # Rate with exact binary fractions so the fake clock advances by exactly the time that is waited
+    clock = Mock()
+    clock.monotonic.return_value = 100.0
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        clock.monotonic.return_value += seconds
+
+    monkeypatch.setattr('confluent.data.async_admins.time', clock)
+    monkeypatch.setattr('asyncio.sleep', sleep)
+    limiter = RateLimiter(4, burst=2)
+
+    async def acquire(times):
+        for _ in range(times):
+            await limiter.acquire()
+
+    asyncio.run(acquire(2))
+    assert not sleeps, 'Burst should not wait'
+
+    asyncio.run(acquire(5))
+    assert sum(sleeps) == 1.25
+
+
+def test_copy_dataset_prefixed_sibling_dataset():
+    client = FakeBigQueryClient(project='project-1')
+    client.add_table('project-1', 'sales', 'table1')
+    client.add_table('project-1', 'sales_eu', 'table1')
+    client.add_table('project-1', 'sales', 'view1', view_query='SELECT * FROM `project-1.sales.table1` '
+                                                               'UNION ALL SELECT * FROM `project-1.sales_eu.table1`')
+
+    with in_temp_dir():
+        BigQueryAdmin(client).copy_dataset('project-1.sales', 'project-2.sales_copy')
+
+    assert client.tables('project-2', 'sales_copy')['view1']['view']['query'] == (
+        'SELECT * FROM `project-2.sales_copy.table1` UNION ALL SELECT * FROM `project-1.sales_eu.table1`')
+
+
+@pytest.mark.parametrize('engine', ['sync', 'async'])
+def test_copy_dataset_fake_client(engine):
+    client = FakeBigQueryClient(project='project-1', job_seconds=0.01 if engine == 'async' else 0)
+    for i in range(7):
+        client.add_table('project-1', 'dataset', f'table{i}', num_rows=i)
+    client.add_table('project-1', 'dataset', 'view1', view_query='SELECT * FROM `project-1.dataset.table1`')
+
+    if engine == 'async':
+        admin = AsyncBigQueryAdmin(client, max_calls_per_sec=None, poll_interval=0.01)
+        admin.async_client.initial_backoff = 0
+        client.fail('list_tables')
+        client.fail('copy_table')
+    else:
+        admin = BigQueryAdmin(client)
+
+    with in_temp_dir():
+        admin.copy_dataset('project-1.dataset', 'project-2', max_concurrent_jobs=2, batch_size=3)
+
+    target_tables = client.tables('project-2', 'dataset')
+    assert sorted(target_tables) == sorted(client.tables('project-1', 'dataset'))
+    assert target_tables['view1']['view']['query'] == 'SELECT * FROM `project-2.dataset.table1`'
+    assert client.peak_running_jobs <= 2
+
+    # 2 scripts and 1 copy job for 7 tables, and 2 queries to verify the row counts
+    assert client.api_calls['query'] == 4
+    assert client.api_calls['copy_table'] == (2 if engine == 'async' else 1)
+
+    if engine == 'async':
+        assert admin.async_client.executor is None, 'Thread pool should be shut down when done'
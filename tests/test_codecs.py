@@ -0,0 +1,46 @@
+import gzip
+import json
+
+import pytest
+from utils.fs import in_temp_dir
+
+from confluent.data.codecs import JSON_CODECS, StdlibJSONCodec, get_json_codec
+from confluent.data.transformers import transform_usage_metrics
+
+
+RECORDS = [
+    {"value": 1.5, "@timestamp": "b", "id": "c", "source": "d/é", "@version": None, "tags": ["x", {"y.z": True}],
+     "metric": {"statefulset.kubernetes.io/pod-name": "i", "_deltaSeconds": "50", "pod-name": "☃",
+                "big": 2 ** 70},
+     "timestamp": 1234567},
+    {"value": "a", "id": 12, "metric": {"_deltaSeconds": 130, "nested": {"a-b": {"c d": False}}},
+     "timestamp": 1552208399},
+]
+
+
+@pytest.mark.parametrize('name', list(JSON_CODECS))
+def test_json_codecs_golden_output(name):
+    if not JSON_CODECS[name].is_available():
+        pytest.skip(f'{name} is not installed')
+
+    with in_temp_dir():
+        with gzip.open('input.json.gz', 'wt') as fp:
+            for record in RECORDS:
+                fp.write(json.dumps(record) + '\n')
+
+        transform_usage_metrics('input.json.gz', 'golden.json.gz', json_codec=StdlibJSONCodec.NAME)
+        transform_usage_metrics('input.json.gz', 'output.json.gz', json_codec=name)
+
+        golden = [json.loads(line) for line in gzip.open('golden.json.gz')]
+        output = [json.loads(line) for line in gzip.open('output.json.gz')]
+
+    assert len(golden) == len(RECORDS)
+    assert output == golden
+
+
+def test_get_json_codec():
+    assert get_json_codec('json').NAME == 'json'
+    assert get_json_codec().is_available()
+
+    with pytest.raises(ValueError):
+        get_json_codec('yaml')
@@ -0,0 +1,124 @@
+import time
+
+from google.api_core.exceptions import BadRequest, Conflict, Forbidden, NotFound
+from google.cloud import bigquery
+import pytest
+
+from confluent.data.admins import copy_script
+from fakes import FakeBigQueryClient
+
+
+def test_fake_client_tables():
+    client = FakeBigQueryClient(project='project-1')
+    client.add_table('project-1', 'dataset', 'table1', num_rows=10)
+    client.add_table('project-1', 'dataset', 'view1', view_query='SELECT * FROM `project-1.dataset.table1`')
+    dataset_ref = client.dataset('dataset')
+
+    assert [(t.table_id, t.table_type) for t in client.list_tables(dataset_ref)] == [('table1', 'TABLE'),
+                                                                                     ('view1', 'VIEW')]
+    assert client.get_table(dataset_ref.table('view1')).view_query == 'SELECT * FROM `project-1.dataset.table1`'
+    assert [d.dataset_id for d in client.list_datasets()] == ['dataset']
+
+    with pytest.raises(NotFound):
+        client.get_table(dataset_ref.table('table2'))
+
+    view = bigquery.Table(dataset_ref.table('view2'))
+    view.view_query = 'SELECT 1'
+    client.create_table(view)
+    assert client.get_table(dataset_ref.table('view2')).table_type == 'VIEW'
+
+    with pytest.raises(Conflict):
+        client.create_table(view)
+    client.create_table(view, exists_ok=True)
+
+    with pytest.raises(Conflict):
+        client.create_dataset(dataset_ref)
+    with pytest.raises(BadRequest):
+        client.delete_dataset(dataset_ref)
+    client.delete_dataset(dataset_ref, delete_contents=True)
+
+    with pytest.raises(NotFound):
+        client.list_tables(dataset_ref)
+    client.delete_dataset(dataset_ref, not_found_ok=True)
+
+    assert client.api_calls == {'list_tables': 2, 'get_table': 3, 'list_datasets': 1, 'create_table': 3,
+                                'create_dataset': 1, 'delete_dataset': 3}
+
+
+def test_fake_client_copy_jobs():
+    client = FakeBigQueryClient(job_seconds=0.05, max_running_jobs=2)
+    for i in range(3):
+        client.add_table('project-1', 'dataset', f'table{i}', num_rows=i, num_bytes=i * 10)
+    client.add_dataset('project-2', 'dataset')
+    source_ref = client.dataset('dataset', project='project-1')
+    target_ref = client.dataset('dataset', project='project-2')
+
+    job = client.copy_table(source_ref.table('table0'), target_ref.table('table0'))
+    script_job = client.query(copy_script([(source_ref.table('table1'), target_ref.table('table1')),
+                                           (source_ref.table('table2'), target_ref.table('table2'))]))
+    assert not job.done() and job.state == 'RUNNING'
+    assert client.running_jobs == 2
+
+    with pytest.raises(Forbidden, match='concurrent jobs'):
+        client.copy_table(source_ref.table('table0'), target_ref.table('table0'))
+
+    assert not client.tables('project-2', 'dataset')
+    job.result()
+    script_job.result()
+    assert client.get_job(job.job_id) is job
+    assert client.peak_running_jobs == 2
+
+    stats = client.query('SELECT table_id, row_count, size_bytes FROM `project-2.dataset.__TABLES__`').result()
+    assert sorted((row.table_id, row.row_count, row.size_bytes) for row in stats) == [
+        ('table0', 0, 0), ('table1', 1, 10), ('table2', 2, 20)]
+
+    with pytest.raises(NotFound):
+        client.get_job('unknown')
+    with pytest.raises(NotFound):
+        client.copy_table(source_ref.table('table3'), target_ref.table('table3'))
+    with pytest.raises(BadRequest):
+        client.query('SELECT 1')
+
+
+def test_fake_client_copy_conflicts():
+    client = FakeBigQueryClient()
+    for project in ('project-1', 'project-2'):
+        client.add_table(project, 'dataset', 'table1', num_rows=1 if project == 'project-1' else 2)
+    source_ref = client.dataset('dataset', project='project-1').table('table1')
+    target_ref = client.dataset('dataset', project='project-2').table('table1')
+
+    job = client.copy_table(source_ref, target_ref)
+    with pytest.raises(Conflict):
+        job.result()
+    assert job.state == 'DONE' and job.error_result['reason'] == 'duplicate'
+
+    with pytest.raises(Conflict):
+        client.query(copy_script([(source_ref, target_ref)])).result()
+    assert client.tables('project-2', 'dataset')['table1']['numRows'] == '2', 'Target table should not be replaced'
+
+    client.query(copy_script([(source_ref, target_ref)], replace=True)).result()
+    assert client.tables('project-2', 'dataset')['table1']['numRows'] == '1'
+
+    with pytest.raises(Conflict):
+        client.copy_table(source_ref, client.dataset('dataset', project='project-2').table('table2'), job_id=job.job_id)
+
+
+def test_fake_client_latency_and_errors():
+    client = FakeBigQueryClient(latency={'list_tables': 0.05})
+    client.add_dataset('fake-project', 'dataset')
+    client.fail('list_tables', times=2)
+    client.fail('create_dataset', error=BadRequest('Invalid dataset'))
+
+    for _ in range(2):
+        with pytest.raises(Forbidden) as e:
+            client.list_tables(client.dataset('dataset'))
+        assert e.value.errors == [{'reason': 'quotaExceeded'}]
+
+    start = time.time()
+    assert client.list_tables(client.dataset('dataset')) == []
+    assert time.time() - start >= 0.05
+
+    with pytest.raises(BadRequest):
+        client.create_dataset(client.dataset('dataset2'))
+    client.create_dataset(client.dataset('dataset2'))
+    assert client.api_calls == {'list_tables': 3, 'create_dataset': 2}
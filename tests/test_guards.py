@@ -0,0 +1,69 @@
+import gzip
+import json
+import os
+
+import pytest
+from utils.fs import in_temp_dir
+
+from confluent.data.guards import (INVALID_JSON, TOO_DEEP, TOO_LARGE, QuarantineFile, RecordGuard, current_rss,
+                                   record_depth)
+from confluent.data.metrics import TransformMetrics
+
+
+def nested(depth):
+    line = '{"a": ' * depth + '1' + '}' * depth
+    return line.encode()
+
+
+def test_record_depth():
+    assert record_depth('a') == 0
+    assert record_depth({'a': 1}) == 1
+    assert record_depth({'a': [{'b': {}}], 'c': {}}) == 4
+    assert record_depth(json.loads(nested(100)), limit=10) == 11
+
+
+def test_record_guard_parse():
+    guard = RecordGuard(max_record_size=100, max_depth=3)
+    metrics = TransformMetrics()
+    lines = [b'{"a": {"b": [1]}}', b'{"a": "' + b'x' * 100 + b'"}', nested(4), b'{"a": "{{{{"}']
+
+    assert guard.parse(lines, json.loads, metrics) == [{'a': {'b': [1]}}, {'a': '{{{{'}]
+    assert metrics.quarantined == {TOO_LARGE: 1, TOO_DEEP: 1}
+    assert metrics.quarantined_lines == [lines[1], lines[2]]
+    assert guard.settings() == {'max_record_size': 100, 'max_depth': 3}
+
+    # Records that are too deep for the JSON codec to parse are quarantined too
+    assert RecordGuard(max_depth=1000).parse([nested(100000)], json.loads, metrics) == []
+    assert metrics.quarantined[TOO_DEEP] == 2
+
+    # Lines that are not JSON are quarantined whether or not they could be too deep
+    assert guard.parse([b'{"a": 1', b'{"a": [[[1, 2', b'{"a": 1}'], json.loads, metrics) == [{'a': 1}]
+    assert metrics.quarantined == {TOO_LARGE: 1, TOO_DEEP: 2, INVALID_JSON: 2}
+
+
+def test_record_guard_quarantine_file():
+    with in_temp_dir():
+        guard = RecordGuard(max_depth=1).for_file('quarantine/data.json.gz')
+        metrics = TransformMetrics()
+
+        guard.parse([b'{"a": 1}'], json.loads, metrics)
+        guard.close()
+        assert not os.path.exists('quarantine')
+
+        guard.parse([b'{"a": {}}', b'{"a": 1}', b'[[]]'], json.loads, metrics)
+        guard.close()
+        assert gzip.open('quarantine/data.json.gz').read() == b'{"a": {}}\n[[]]\n'
+        assert not metrics.quarantined_lines
+
+        quarantine = QuarantineFile('quarantine/empty.json.gz')
+        quarantine.close()
+        assert not os.path.exists('quarantine/empty.json.gz')
+
+
+def test_record_guard_check_memory():
+    metrics = TransformMetrics()
+    RecordGuard().check_memory(metrics)
+    assert 0 < metrics.peak_rss <= current_rss() * 2
+
+    with pytest.raises(MemoryError, match='exceeded the cap of 0.0 MB'):
+        RecordGuard(max_memory=1).check_memory(metrics)
@@ -0,0 +1,117 @@
+import gzip
+import json
+import os
+
+import pytest
+from utils.fs import in_temp_dir
+
+from confluent.data.pipelines import (TransformSpec, parse_transform_spec, round_value, round_values,
+                                      transform_with_spec)
+from confluent.data.scripts import transform
+from confluent.data.transformers import transform_usage_metrics, transform_usage_metrics_record
+
+
+def records():
+    return [
+        {'id': 'a', '@timestamp': 'x', 'metric': {'_deltaSeconds': '50', 'a.b': 1}, 'timestamp': 1234567},
+        {'id': 'b', 'metric': {'a.b': 2, '_deltaSeconds': 10}, 'timestamp': 1552208399.7},
+        {'metric': {'_deltaSeconds': 95.5, 'nested': {'c-d': {}}, 'a_b': 3}, 'timestamp': 89, 'id': 'c'},
+        {'id': 'd', '@timestamp': 'x', 'metric': {'_deltaSeconds': '50', 'a.b': 1}, 'timestamp': 1234567},
+        {'id': 'e', 'metric': {'_deltaSeconds': 0}, 'timestamp': 1572771600, 'date_pt': 'old'},
+    ]
+
+
+@pytest.mark.parametrize('engine', ['record', 'columnar'])
+def test_transform_spec_usage_metrics(test_data, engine):
+    if engine == 'columnar':
+        pytest.importorskip('numpy')
+
+    spec = parse_transform_spec(str(test_data.path('usage-metrics-transform-spec.json')))
+    expected = [transform_usage_metrics_record(record, exclude_fields={'metric.another'}) for record in records()]
+
+    assert json.dumps(spec.compile(engine)(records())) == json.dumps(expected)
+    assert spec.compile(engine) is spec.compile(engine)
+
+
+@pytest.mark.parametrize('engine', ['record', 'columnar'])
+def test_transform_spec_operations(engine):
+    if engine == 'columnar':
+        pytest.importorskip('numpy')
+
+    spec = TransformSpec({'select': ['id', 'metric', 'metric.cluster-id', 'metric.delta', 'time', 'day', '-id'],
+                          'rename': {'metric.cluster-id': 'cluster.id', 'time': 'minute'},
+                          'round': {'time': 60, 'metric.delta': {'to': 10, 'min': 10}},
+                          'derive': {'day': {'from': 'time', 'format': '%Y-%m-%d'}}})
+
+    transformed = spec.compile(engine)([{'id': 'a', 'time': 90, 'metric': {'cluster-id': 'x', 'delta': '2'}},
+                                        {'id': 'b', 'time': None, 'metric': {'delta': 26, 'other': 1}},
+                                        {'metric': None, 'extra': 1}])
+    assert transformed == [{'minute': 120, 'metric': {'cluster_id': 'x', 'delta': 10}, 'day': '1970-01-01'},
+                           {'minute': None, 'metric': {'delta': 30}},
+                           {'metric': None}]
+
+
+def test_round_values():
+    pytest.importorskip('numpy')
+
+    assert round_values([29, '31', 89.9, -31], 60) == [0, 60, 60, 0]
+    assert round_values([29, None, '95'], 60, minimum=60) == [60, None, 120]
+
+    # A float minimum only applies to the values below it, so the others stay ints like the record engine
+    values = [29, 95, 150]
+    rounded = round_values(values, 60, minimum=60.5)
+    assert rounded == [round_value(value, 60, minimum=60.5) for value in values] == [60.5, 120, 180]
+    assert [type(value) for value in rounded] == [float, int, int]
+
+
+@pytest.mark.parametrize('spec,error', [
+    ([], 'must be a JSON object'),
+    ({'filter': []}, 'Unsupported key\\(s\\) in transform spec: filter'),
+    ({'drop': 'a'}, '"drop" in transform spec must be a list of field names'),
+    ({'round': {'a': 0}}, 'Unit to round a to must be a positive number: 0'),
+    ({'round': {'a': {'to': 60, 'max': 1}}}, 'Unsupported key\\(s\\) to round a: max'),
+    ({'derive': {'a': {'timezone': 'UTC'}}}, 'Field to derive a from is required'),
+    ({'derive': {'a': {'from': 'b', 'timezone': 'Mars'}}}, 'Unknown timezone to derive a with: Mars'),
+    ({'rename': {'a': ''}}, 'Keys to rename fields to must be non-empty strings'),
+])
+def test_transform_spec_errors(spec, error):
+    with pytest.raises(ValueError, match=error):
+        TransformSpec(spec)
+
+
+def test_transform_with_spec(test_data):
+    spec_file = str(test_data.path('usage-metrics-transform-spec.json'))
+
+    with in_temp_dir():
+        with gzip.open('data.json.gz', 'wt') as fp:
+            for record in records():
+                fp.write(json.dumps(record) + '\n')
+
+        transform_usage_metrics('data.json.gz', 'usage-metrics.json.gz', exclude_fields={'metric.another'})
+        transform_with_spec('data.json.gz', 'spec.json.gz', spec_file)
+
+        assert gzip.open('spec.json.gz').read() == gzip.open('usage-metrics.json.gz').read()
+
+
+def test_transform_run(cli_runner, test_data):
+    spec_file = str(test_data.path('usage-metrics-transform-spec.json'))
+
+    with in_temp_dir():
+        os.mkdir('data')
+        with gzip.open('data/test.json.gz', 'wt') as fp:
+            for record in records():
+                fp.write(json.dumps(record) + '\n')
+
+        cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--sink-dir', 'usage-metrics-data'])
+        result = cli_runner.invoke_and_assert_exit(0, transform, ['run', '--spec', spec_file, '--split-size', '1'])
+        assert 'Transformed 1 data file(s)' in result.output
+
+        assert gzip.open('transformed-data/test.json.gz').read() == gzip.open('usage-metrics-data/test.json.gz').read()
+
+        result = cli_runner.invoke_and_assert_exit(0, transform, ['run', '--spec', spec_file])
+        assert 'Transformed 0 data file(s)' in result.output
+
+        with open('spec.json', 'w') as fp:
+            json.dump({'round': {'timestamp': -1}}, fp)
+        result = cli_runner.invoke_and_assert_exit(2, transform, ['run', '--spec', 'spec.json'])
+        assert 'Invalid value for --spec: Unit to round timestamp to must be a positive number: -1' in result.output
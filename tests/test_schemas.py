@@ -0,0 +1,61 @@
+from utils.fs import in_temp_dir
+
+from confluent.data.schemas import KeySchema, type_name
+from confluent.data.transformers import KeyPlan
+
+
+def test_type_name():
+    assert type_name(str) == 'STRING'
+    assert type_name(bool) == 'BOOLEAN'
+    assert type_name((list, int)) == 'INTEGER[]'
+    assert type_name((list, type(None))) == 'NULL[]'
+
+
+def test_key_plan_key_schema():
+    key_plan = KeyPlan(exclude_fields={'b.x'}, track_types=True)
+    for record in [{'a': 1, 'b': {'c-d': 'x', 'x': 1}, 'e': [1, 2], 'f': None},
+                   {'a': 1.5, 'b': {'c/d': 'y'}, 'e': [], 'g': [{'h': 1}]}]:
+        key_plan.clean(record)
+
+    key_schema = key_plan.key_schema()
+    assert key_schema.keys == {('a',): ('a', {'INTEGER', 'FLOAT'}), ('b',): ('b', {'RECORD'}),
+                               ('b', 'c-d'): ('c_d', {'STRING'}), ('b', 'c/d'): ('c_d', {'STRING'}),
+                               ('e',): ('e', {'INTEGER[]', 'NULL[]'}), ('f',): ('f', {'NULL'}),
+                               ('g',): ('g', {'RECORD[]'})}
+    assert key_schema.collisions() == {'b.c_d': ['b.c-d', 'b.c/d']}
+    assert key_schema.bigquery_schema() == [
+        {'name': 'a', 'type': 'FLOAT', 'mode': 'NULLABLE'},
+        {'name': 'b', 'type': 'RECORD', 'mode': 'NULLABLE', 'fields': [
+            {'name': 'c_d', 'type': 'STRING', 'mode': 'NULLABLE'}]},
+        {'name': 'e', 'type': 'INTEGER', 'mode': 'REPEATED'},
+        {'name': 'f', 'type': 'STRING', 'mode': 'NULLABLE'},
+        {'name': 'g', 'type': 'JSON', 'mode': 'REPEATED'}]
+
+    # Types are only tracked when asked for
+    untracked_plan = KeyPlan()
+    untracked_plan.clean({'a': 1})
+    assert untracked_plan.key_schema().keys == {('a',): ('a', set())}
+
+
+def test_key_plan_preload():
+    key_schema = KeySchema()
+    key_schema.add(('metric',), 'metric', {'RECORD'})
+    key_schema.add(('metric', 'pod-name'), 'pod_name', {'STRING'})
+    key_schema.add(('metric', 'another'), 'another', {'STRING'})
+
+    key_plan = KeyPlan(exclude_fields={'metric.another'}, track_types=True)
+    key_plan.preload(key_schema)
+    assert set(key_plan.key_schema().keys) == {('metric',), ('metric', 'pod-name')}
+
+
+def test_key_schema_save_and_load():
+    key_schema = KeySchema()
+    key_schema.add(('a',), 'a', {'STRING'})
+    key_schema.add(('a',), 'a', {'NULL'})
+
+    with in_temp_dir():
+        key_schema.save('keys.json', settings={'select_fields': []})
+
+        assert KeySchema.load('keys.json', settings={'select_fields': []}).keys == {('a',): ('a', {'STRING', 'NULL'})}
+        assert KeySchema.load('keys.json', settings={'select_fields': ['a']}).keys == {}
+        assert KeySchema.load('missing.json').keys == {}
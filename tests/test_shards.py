@@ -0,0 +1,110 @@
+import gzip
+import os
+
+from mock import patch
+import pytest
+from utils.fs import in_temp_dir
+
+from confluent.data.shards import (PartitionRouter, ShardWriter, partition_name, partitioned_files, publish_shards,
+                                   remove_stale_shards, shard_files)
+
+
+def test_shard_writer():
+    with in_temp_dir():
+        for i in range(3):
+            with gzip.open(f'file{i}.json.gz', 'wb') as fp:
+                fp.write(f'{{"file": {i}}}\n'.encode() * 10)
+
+        writer = ShardWriter('shards', target_size=2 * os.path.getsize('file0.json.gz'))
+        for i in range(3):
+            writer.write_file(f'file{i}.json.gz')
+        writer.write(b'{"file": 3}\n')
+        assert sorted(os.listdir('shards')) == ['.part-00001.json.gz', 'part-00000.json.gz']
+
+        writer.finish()
+        assert writer.shards == ['shards/part-00000.json.gz', 'shards/part-00001.json.gz']
+        assert gzip.open('shards/part-00000.json.gz').read() == b'{"file": 0}\n' * 10 + b'{"file": 1}\n' * 10
+        assert gzip.open('shards/part-00001.json.gz').read() == b'{"file": 2}\n' * 10 + b'{"file": 3}\n'
+
+        writer = ShardWriter('shards', target_size=100)
+        writer.write(b'{"file": 4}\n')
+        writer.abort()
+        assert sorted(os.listdir('shards')) == ['part-00000.json.gz', 'part-00001.json.gz']
+
+        os.makedirs('shards/date_pt=2019-03-10')
+        open('shards/date_pt=2019-03-10/part-00000.json.gz', 'w').close()
+        open('shards/important.txt', 'w').close()
+        remove_stale_shards('shards', {'shards/part-00000.json.gz'})
+        assert sorted(os.listdir('shards')) == ['important.txt', 'part-00000.json.gz']
+
+
+def test_publish_shards():
+    with in_temp_dir():
+        os.makedirs('shards/date_pt=2019-03-10')
+        os.makedirs('shards/other')
+        for path in ('shards/part-00000.json.gz', 'shards/part-00001.json.gz', 'shards/part-00000.json.gz.bak',
+                     'shards/date_pt=2019-03-10/part-00000.json.gz', 'shards/other/part-00000.json.gz'):
+            with open(path, 'w') as fp:
+                fp.write('old')
+        assert sorted(shard_files('shards')) == ['shards/date_pt=2019-03-10/part-00000.json.gz',
+                                                 'shards/part-00000.json.gz', 'shards/part-00001.json.gz']
+
+        writer = ShardWriter('shards/.staging', target_size=100)
+        writer.write(b'{"new": 1}\n')
+        writer.finish()
+        assert os.listdir('shards/.staging') == ['part-00000.json.gz']
+
+        assert publish_shards('shards/.staging', 'shards') == ['shards/part-00000.json.gz']
+        assert sorted(os.listdir('shards')) == ['other', 'part-00000.json.gz', 'part-00000.json.gz.bak']
+        assert gzip.open('shards/part-00000.json.gz').read() == b'{"new": 1}\n'
+        assert os.listdir('shards/other') == ['part-00000.json.gz'], 'Only shards in partition dirs are replaced'
+
+        for partition in ('date_pt=2019-03-10', 'date_pt=2019-03-11'):
+            os.makedirs(f'shards/{partition}', exist_ok=True)
+            with open(f'shards/{partition}/part-00000.json.gz', 'w') as fp:
+                fp.write('old')
+        writer = ShardWriter('shards/.staging/date_pt=2019-03-12', target_size=100)
+        writer.write(b'{"new": 2}\n')
+        writer.finish()
+
+        assert publish_shards('shards/.staging', 'shards', partitions={'date_pt=2019-03-11', 'date_pt=2019-03-12'}) == [
+            'shards/date_pt=2019-03-12/part-00000.json.gz']
+        assert sorted(shard_files('shards')) == ['shards/date_pt=2019-03-10/part-00000.json.gz',
+                                                 'shards/date_pt=2019-03-12/part-00000.json.gz',
+                                                 'shards/part-00000.json.gz'], 'Only the given partitions are replaced'
+
+
+def test_partition_name():
+    assert partition_name('date_pt', '2019-03-10') == 'date_pt=2019-03-10'
+    assert partition_name('date_pt', None) == 'date_pt=__HIVE_DEFAULT_PARTITION__'
+    assert partition_name('path', 'a/b') == 'path=a_b'
+
+
+def test_partition_router():
+    with in_temp_dir():
+        os.makedirs('sink/date_pt=2019-01-01/dir')
+        open('sink/date_pt=2019-01-01/dir/data.json.gz', 'w').close()
+
+        router = PartitionRouter('sink', 'dir/data.json.gz', 'date_pt', max_open_files=1)
+        for value in ('2019-03-10', '2019-03-11', '2019-03-10', None):
+            router.write(value, f'{{"date_pt": "{value}"}}\n'.encode())
+        assert router.reopens == 1
+
+        assert router.commit() > 0
+        assert sorted(partitioned_files('sink', 'date_pt', 'dir/data.json.gz')) == [
+            'sink/date_pt=2019-03-10/dir/data.json.gz', 'sink/date_pt=2019-03-11/dir/data.json.gz',
+            'sink/date_pt=__HIVE_DEFAULT_PARTITION__/dir/data.json.gz']
+        assert gzip.open('sink/date_pt=2019-03-10/dir/data.json.gz').read() == b'{"date_pt": "2019-03-10"}\n' * 2
+
+        router = PartitionRouter('sink', 'dir/other.json.gz', 'date_pt')
+        router.write('2019-03-10', b'{}\n')
+        router.abort()
+        assert os.listdir('sink/date_pt=2019-03-10/dir') == ['data.json.gz']
+
+        # Outputs in other partitions are only removed once the new outputs are in place
+        router = PartitionRouter('sink', 'dir/data.json.gz', 'date_pt')
+        router.write('2019-03-12', b'{}\n')
+        with patch('os.rename', side_effect=OSError('Disk full')):
+            with pytest.raises(OSError):
+                router.commit()
+        assert len(partitioned_files('sink', 'date_pt', 'dir/data.json.gz')) == 3
@@ -0,0 +1,132 @@
+import gzip
+import json
+
+import pytest
+from utils.fs import in_temp_dir
+
+from confluent.data.sinks import SINK_FORMATS, AvroSink, ParquetSink, avro_schema, get_sink_format
+from confluent.data.transformers import transform_usage_metrics
+
+
+def _records(count, **extra_metric):
+    return [{"value": i, "@timestamp": "b", "id": f"id-{i}", "@version": None, "tags": ["x", "y"],
+             "metric": {"statefulset.kubernetes.io/pod-name": "i", "_deltaSeconds": "50", "ratio": i / 2,
+                        **extra_metric},
+             "timestamp": 1234567 + i * 60}
+            for i in range(count)]
+
+
+def _read_records(sink_format, path):
+    if sink_format == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(path).to_pylist()
+
+    elif sink_format == 'avro':
+        import fastavro
+        with open(path, 'rb') as fp:
+            return list(fastavro.reader(fp))
+
+    return [json.loads(line) for line in gzip.open(path)]
+
+
+@pytest.mark.parametrize('name,compression', [('parquet', None), ('parquet', 'zstd'), ('avro', None),
+                                              ('avro', 'null')])
+def test_sink_formats_match_json(name, compression):
+    if not SINK_FORMATS[name].is_available():
+        pytest.skip(f'{name} sink format is not installed')
+
+    with in_temp_dir():
+        with gzip.open('input.json.gz', 'wt') as fp:
+            for record in _records(100):
+                fp.write(json.dumps(record) + '\n')
+
+        transform_usage_metrics('input.json.gz', 'golden.json.gz')
+        transform_usage_metrics('input.json.gz', 'output', buffer_size=4096, sink_format=name,
+                                sink_compression=compression)
+
+        golden = _read_records('json', 'golden.json.gz')
+        output = _read_records(name, 'output')
+
+        if name == 'parquet':
+            import pyarrow.parquet
+            metadata = pyarrow.parquet.ParquetFile('output').metadata
+            assert metadata.num_row_groups > 1
+            assert metadata.row_group(0).column(0).compression.lower() == (compression or 'snappy')
+
+    assert len(golden) == 100
+    assert output == golden
+
+
+@pytest.mark.parametrize('sink', [ParquetSink, AvroSink])
+def test_sink_schema_evolution(sink):
+    if not sink.is_available():
+        pytest.skip(f'{sink.NAME} sink format is not installed')
+
+    with in_temp_dir():
+        with sink.open('output') as fp:
+            output = sink(fp)
+            output.write(output.serialize([{'a': 1, 'b': {'c': 'x'}}]))
+
+            # Missing fields are null
+            output.write(output.serialize([{'a': 2}]))
+
+            # Floats and new fields evolve the schema instead of being truncated or failing the file
+            output.write(output.serialize([{'a': 2.7, 'b': {'c': 'y', 'd': 1}, 'e': True}]))
+            output.write(output.serialize([{'a': 4}]))
+
+            with pytest.raises(ValueError) as e:
+                output.serialize([{'a': 'not a number'}])
+            assert str(e.value).startswith('Records do not match the schema of earlier records')
+
+            output.close()
+
+        assert _read_records(sink.NAME, 'output') == [
+            {'a': 1, 'b': {'c': 'x', 'd': None}, 'e': None},
+            {'a': 2, 'b': None, 'e': None},
+            {'a': 2.7, 'b': {'c': 'y', 'd': 1}, 'e': True},
+            {'a': 4, 'b': None, 'e': None}]
+        assert [type(record['a']) for record in _read_records(sink.NAME, 'output')] == [float] * 4
+
+
+@pytest.mark.parametrize('sink', [ParquetSink, AvroSink])
+def test_sink_int_then_float_and_new_fields(sink):
+    if not sink.is_available():
+        pytest.skip(f'{sink.NAME} sink format is not installed')
+
+    with in_temp_dir():
+        with gzip.open('input.json.gz', 'wt') as fp:
+            for i in range(200):
+                metric = {'_deltaSeconds': 60, 'value': i if i < 100 else i + 0.5}
+                if i >= 150:
+                    metric['new-label'] = 'x'
+                fp.write(json.dumps({'id': i, 'metric': metric, 'timestamp': 1234567}) + '\n')
+
+        transform_usage_metrics('input.json.gz', 'output', buffer_size=1024, sink_format=sink.NAME)
+
+        metrics = [record['metric'] for record in _read_records(sink.NAME, 'output')]
+        assert [metric['value'] for metric in metrics] == [i if i < 100 else i + 0.5 for i in range(200)]
+        assert [metric['new_label'] for metric in metrics] == [None] * 150 + ['x'] * 50
+
+
+def test_avro_schema():
+    pyarrow = pytest.importorskip('pyarrow')
+
+    schema = pyarrow.schema([('a', pyarrow.int64()), ('b', pyarrow.struct([('c', pyarrow.string())])),
+                             ('d', pyarrow.list_(pyarrow.float64())), ('e', pyarrow.null())])
+    assert avro_schema(schema) == {'type': 'record', 'name': 'Record', 'fields': [
+        {'name': 'a', 'type': ['null', 'long'], 'default': None},
+        {'name': 'b', 'type': ['null', {'type': 'record', 'name': 'Record_b', 'fields': [
+            {'name': 'c', 'type': ['null', 'string'], 'default': None}]}], 'default': None},
+        {'name': 'd', 'type': ['null', {'type': 'array', 'items': ['null', 'double']}], 'default': None},
+        {'name': 'e', 'type': 'null', 'default': None}]}
+
+
+def test_get_sink_format():
+    assert get_sink_format().NAME == 'json'
+    assert get_sink_format('json').is_available()
+
+    with pytest.raises(ValueError):
+        get_sink_format('csv')
+
+    with pytest.raises(ValueError):
+        ParquetSink.check_compression('deflate')
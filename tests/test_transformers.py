@@ -1,11 +1,25 @@
+from datetime import datetime
+import glob
 import json
 import gzip
+import io
+import multiprocessing
 import os
 
+from click.testing import CliRunner
+from mock import patch
 import pytest
+import pytz
 from utils.fs import in_temp_dir
 
-from confluent.data.transformers import Transformer, transform_usage_metrics
+from confluent.data.manifests import TransformManifest
+from confluent.data.metrics import TransformMetrics
+from confluent.data.transformers import (DEFAULT_BUFFER_SIZE, Transformer, KeyPlan, _clean_bigquery_keys,
+                                         compile_key_plan, iter_line_batches, iter_line_chunks, iter_transform,
+                                         local_time_strings,
+                                         local_time_strings_batch, transform_usage_metrics,
+                                         transform_usage_metrics_chunk, transform_usage_metrics_columnar,
+                                         transform_usage_metrics_record)
 from confluent.data.scripts import transform
 
 
@@ -33,7 +47,7 @@ def test_usage_metrics_without_options(cli_runner, mock_data):
     result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
 
     assert ('Transforming data files from "data" and writing them to "transformed-data" '
-            'using 5 parallel processes\n') in result.output
+            f'using {multiprocessing.cpu_count()} parallel processes\n') in result.output
     assert 'Transformed 1 data file(s)' in result.output
 
     expected_record = {'value': 'a', 'date_pt': '1970-01-14', 'datetime_pt': '1970-01-14 22:56:00',
@@ -76,7 +90,7 @@ def test_usage_metrics_select_fields(cli_runner, mock_data):
         'usage-metrics', '--select-fields', 'id,metric,metric.user,metric.type,timestamp,@version'])
 
     assert ('Transforming data files from "data" and writing them to "transformed-data" '
-            'using 5 parallel processes\n') in result.output
+            f'using {multiprocessing.cpu_count()} parallel processes\n') in result.output
     assert 'Transformed 1 data file(s)' in result.output
     assert 'Only extracting these fields: @version, id, metric, metric.type, metric.user, timestamp' in result.output
 
@@ -101,7 +115,7 @@ def test_usage_metrics_exclude_fields_with_others(cli_runner, mock_data):
         'usage-metrics', '--select-fields', 'id,metric,-metric.user,metric.type,-timestamp,@version'])
 
     assert ('Transforming data files from "data" and writing them to "transformed-data" '
-            'using 5 parallel processes\n') in result.output
+            f'using {multiprocessing.cpu_count()} parallel processes\n') in result.output
     assert 'Transformed 1 data file(s)' in result.output
     assert 'Only extracting these fields: @version, id, metric, metric.type' in result.output
     assert 'Excluding these fields: metric.user, timestamp' in result.output
@@ -125,7 +139,7 @@ def test_usage_metrics_exclude_fields_only(cli_runner, mock_data):
         'usage-metrics', '--select-fields', '-metric.user'])
 
     assert ('Transforming data files from "data" and writing them to "transformed-data" '
-            'using 5 parallel processes\n') in result.output
+            f'using {multiprocessing.cpu_count()} parallel processes\n') in result.output
     assert 'Transformed 1 data file(s)' in result.output
     assert 'Only extracting these fields' not in result.output
     assert 'Excluding these fields: metric.user' in result.output
@@ -151,6 +165,161 @@ def test_usage_metrics_exclude_fields_only(cli_runner, mock_data):
     assert count == 10
 
 
+def test_usage_metrics_processes(cli_runner, mock_data):
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--processes', '2'])
+
+    assert ('Transforming data files from "data" and writing them to "transformed-data" '
+            'using 2 parallel processes\n') in result.output
+    assert 'Transformed 1 data file(s)' in result.output
+    assert os.path.exists('transformed-data/test.json.gz')
+
+
+def test_transformer_schedule():
+    data_files = [(10, 'tiny1'), (3 * Transformer.SMALL_FILE_SIZE, 'big'), (20, 'tiny2'),
+                  (5 * Transformer.SMALL_FILE_SIZE, 'bigger'), (Transformer.SMALL_FILE_SIZE - 1, 'small')]
+
+    transformer = Transformer(transform_usage_metrics, '.', 'sink')
+    assert transformer._schedule(data_files) == [['bigger'], ['big'], ['small', 'tiny2', 'tiny1']]
+
+    transformer.SMALL_FILES_BATCH_COUNT = 2
+    assert transformer._schedule(data_files) == [['bigger'], ['big'], ['small', 'tiny2'], ['tiny1']]
+
+
+def test_usage_metrics_manifest(cli_runner, mock_data):
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
+    assert os.path.exists('transformed-data/.transform-manifest.sqlite')
+
+    # Unchanged
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
+    assert 'Skipping 1 data file(s) that are unchanged since the last transform' in result.output
+    assert 'Transformed 0 data file(s)' in result.output
+
+    # Touched, but same content
+    os.utime('transformed-data/test.json.gz', (0, 0))
+    os.utime('data/test.json.gz', (0, 0))
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
+    assert os.path.getmtime('transformed-data/test.json.gz') == 0
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
+    assert 'Skipping 1 data file(s) that are unchanged since the last transform' in result.output
+
+    # Changed content
+    with gzip.open('data/test.json.gz', 'ab') as fp:
+        fp.write(b'{"metric": {"_deltaSeconds": 10}, "timestamp": 1552208399}\n')
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
+    assert len(gzip.open('transformed-data/test.json.gz').readlines()) == 11
+
+    # Stale output as field selection changed
+    manifest = TransformManifest('transformed-data', Transformer(transform_usage_metrics, 'data', 'transformed-data',
+                                                                 select_fields={'id'})._settings())
+    assert manifest.stale_files() == ['test.json.gz']
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--select-fields', 'id'])
+    assert 'Re-transforming 1 data file(s) with stale output as the settings have changed' in result.output
+    assert json.loads(gzip.open('transformed-data/test.json.gz').readline()) == {'id': 'c'}
+    assert manifest.stale_files() == []
+
+    # Stale output as transform options changed
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--timezone', 'UTC'])
+    assert 'Re-transforming 1 data file(s) with stale output as the settings have changed' in result.output
+    assert json.loads(gzip.open('transformed-data/test.json.gz').readline())['datetime_pt'] == '1970-01-15 06:56:00'
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--timezone', 'UTC',
+                                                              '--compress-level', '1'])
+    assert 'Re-transforming 1 data file(s) with stale output as the settings have changed' in result.output
+
+
+def test_usage_metrics_transformed_count(cli_runner, mock_data):
+    with open('data/bad.json.gz', 'wb') as fp:
+        fp.write(b'not gzip')
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
+    assert 'Transformed 1 data file(s)' in result.output
+    assert 'Failed to transform 1 data file(s):' in result.output
+
+
+def test_usage_metrics_split_size(cli_runner, mock_data):
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--split-size', '1'])
+    assert 'Transforming data/test.json.gz in chunks' in result.output
+    assert 'Transformed 1 data file(s)' in result.output
+
+    transform_usage_metrics('data/test.json.gz', 'expected.json.gz', exclude_fields={'metric.another'})
+    expected = gzip.open('expected.json.gz').read()
+    assert gzip.open('transformed-data/test.json.gz').read() == expected
+
+    transformer = Transformer(transform_usage_metrics, 'data', 'split-data', parallel_processes=2, split_size=1,
+                              chunk_transform=transform_usage_metrics_chunk,
+                              select_fields={'-metric.another'})
+    transformer.SPLIT_CHUNK_SIZE = 100
+    transformer.transform()
+
+    with open('split-data/test.json.gz', 'rb') as fp:
+        assert fp.read().count(b'\x1f\x8b\x08') > 1, 'Expected multiple gzip members'
+    assert gzip.open('split-data/test.json.gz').read() == expected
+
+    with pytest.raises(ValueError):
+        Transformer(transform_usage_metrics, 'data', 'split-data', split_size=1)
+
+
+def test_usage_metrics_metrics(cli_runner, mock_data):
+    with open('data/bad.json.gz', 'wb') as fp:
+        fp.write(b'garbage')
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
+    assert '[2/2 files] 10 records' in result.output
+    assert "Failed to transform 1 data file(s):\n  - data/bad.json.gz: Not a gzipped file (b'ga')" in result.output
+    assert 'Time spent per stage: decompress' in result.output
+
+    with open('transformed-data/.transform-summary.json') as fp:
+        summary = json.load(fp)
+    assert summary['files'] == 2
+    assert summary['records'] == 10
+    assert set(summary['stage_seconds']) == {'decompress', 'parse', 'transform', 'serialize', 'compress'}
+    assert summary['errors'] == [{'input_file': 'data/bad.json.gz', 'error': "Not a gzipped file (b'ga')"}]
+    assert [m['input_file'] for m in summary['slowest_files']] == ['data/test.json.gz', 'data/bad.json.gz']
+
+    # Failed file is not recorded in the manifest, so it is retried
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics'])
+    assert 'Skipping 1 data file(s) that are unchanged since the last transform' in result.output
+    assert 'Failed to transform 1 data file(s)' in result.output
+
+
+def _copy_transform(input_file, output_file, select_fields=None, exclude_fields=None):
+    """ Custom transform callable from before metrics were reported """
+    with open(input_file, 'rb') as input_fp, open(output_file, 'wb') as output_fp:
+        output_fp.write(input_fp.read())
+
+
+def _copy_chunk_transform(chunk, select_fields=None, exclude_fields=None):
+    return gzip.compress(chunk)
+
+
+def test_transformer_custom_callables_without_metrics(mock_data):
+    Transformer(_copy_transform, 'data', 'transformed-data', parallel_processes=1).transform()
+    assert gzip.open('transformed-data/test.json.gz').read() == gzip.open('data/test.json.gz').read()
+
+    Transformer(_copy_transform, 'data', 'split-data', parallel_processes=2, split_size=1,
+                chunk_transform=_copy_chunk_transform).transform()
+    assert gzip.open('split-data/test.json.gz').read() == gzip.open('data/test.json.gz').read()
+
+
+def test_transform_metrics():
+    metrics = TransformMetrics('data/test.json.gz')
+    with in_temp_dir():
+        os.mkdir('data')
+        with gzip.open('data/test.json.gz', 'wt') as fp:
+            fp.write('{"metric": {"_deltaSeconds": 10}, "timestamp": 1552208399}\n' * 3)
+        transform_usage_metrics('data/test.json.gz', 'output.json.gz', metrics=metrics)
+
+    assert metrics.records == 3
+    assert all(metrics.stage_seconds[stage] > 0 for stage in TransformMetrics.STAGES)
+
+
+def test_iter_line_chunks():
+    fp = io.BytesIO(b'a\nbb\n\nccc\ndddd')
+
+    assert list(iter_line_chunks(fp, 3)) == [b'a\n', b'bb\n\n', b'ccc\n', b'dddd']
+
+
 def test_usage_metrics_path_contains(cli_runner, mock_data):
     # No match
     result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--path-contains', 'blah'])
@@ -158,4 +327,403 @@ def test_usage_metrics_path_contains(cli_runner, mock_data):
 
     result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--path-contains', 'data'])
     assert ('Transforming data files from "data" and writing them to "transformed-data" '
-            'using 5 parallel processes\n') in result.output
+            f'using {multiprocessing.cpu_count()} parallel processes\n') in result.output
+
+
+@pytest.mark.parametrize('select_fields,exclude_fields', [
+    (None, None),
+    ({'id', 'metric', 'metric.user', 'metric.pod-name', '@version'}, None),
+    ({'id', 'metric'}, None),
+    (None, {'metric.user', 'timestamp'}),
+    ({'id', 'metric', 'metric.user', 'metric.type'}, {'metric.user'}),
+])
+def test_key_plan(select_fields, exclude_fields):
+    record = {'id': 'c', '@version': 'e', 'timestamp': 1234560,
+              'metric': {'user': 'g', 'type': 'j', 'pod-name': 'm', 'nested': {'a.b': 1}}}
+
+    key_plan = KeyPlan(select_fields, exclude_fields)
+    for _ in range(2):
+        assert key_plan.clean(record) == _clean_bigquery_keys(record, select_fields, exclude_fields)
+
+    assert compile_key_plan(select_fields, exclude_fields) is compile_key_plan(select_fields, exclude_fields)
+
+
+def test_key_plan_prunes_unselected_subtrees():
+    key_plan = KeyPlan({'id', 'metric'})
+
+    assert key_plan.clean({'id': 'c', 'metric': {'user': 'g'}}) == {'id': 'c', 'metric': {}}
+    assert key_plan._keys['metric'][1].prune
+    assert not key_plan._keys['metric'][1]._keys
+
+
+def test_key_plan_renames():
+    key_plan = compile_key_plan(renames={'metric.pod-name': 'pod/name', 'id': 'record_id'})
+
+    assert key_plan.clean({'id': 'c', 'metric': {'pod-name': 'm', 'user': 'g'}, 'pod-name': 'x'}) == {
+        'record_id': 'c', 'metric': {'pod_name': 'm', 'user': 'g'}, 'pod_name': 'x'}
+    assert compile_key_plan(renames={'id': 'record_id', 'metric.pod-name': 'pod/name'}) is key_plan
+
+
+@pytest.mark.parametrize('select_fields,exclude_fields', [
+    (None, None),
+    ({'id', 'metric', 'metric.user', 'metric.nested', 'metric.nested.a.b'}, None),
+    (None, {'metric.user', 'timestamp'}),
+])
+def test_key_plan_clean_in_place(select_fields, exclude_fields):
+    def record():
+        return {'id': 'c', '@version': 'e', 'timestamp': 1234560,
+                'metric': {'user': 'g', 'pod-name': 'm', 'nested': {'a.b': 1, 'c': {}}, 'clean': {'d': 1}}}
+
+    key_plan = KeyPlan(select_fields, exclude_fields)
+    dirty_record = record()
+    clean_record = key_plan.clean_in_place(dirty_record)
+
+    assert clean_record is dirty_record
+    assert json.dumps(clean_record) == json.dumps(_clean_bigquery_keys(record(), select_fields, exclude_fields))
+
+
+def test_key_plan_clean_in_place_deep_record():
+    record = leaf = {}
+    for _ in range(10000):
+        leaf['a-b'] = leaf = {}
+    leaf['c'] = 1
+
+    KeyPlan().clean_in_place(record)
+    for _ in range(10000):
+        record = record['a_b']
+    assert record == {'c': 1}
+
+
+def test_local_time_strings():
+    # Around the 2019-03-10 and 2019-11-03 DST transitions in US/Pacific
+    timestamps = [t + m * 60 for t in (1552208400, 1572771600) for m in range(-90, 90, 7)]
+    pacific = pytz.timezone('US/Pacific')
+
+    expected = []
+    for timestamp in timestamps:
+        pacific_time = datetime.fromtimestamp(timestamp, pacific)
+        expected.append((pacific_time.strftime('%Y-%m-%d %H:%M:%S'), pacific_time.strftime('%Y-%m-%d')))
+
+    assert [local_time_strings(t) for t in timestamps] == expected
+    assert local_time_strings_batch(timestamps + timestamps) == expected + expected
+    assert local_time_strings(1234560, 'UTC') == ('1970-01-15 06:56:00', '1970-01-15')
+
+
+def test_usage_metrics_timezone(cli_runner, mock_data):
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--timezone', 'UTC'])
+
+    for serialized_record in gzip.open('transformed-data/test.json.gz'):
+        record = json.loads(serialized_record)
+        assert record['datetime_pt'] == '1970-01-15 06:56:00'
+        assert record['date_pt'] == '1970-01-15'
+
+    result = cli_runner.invoke_and_assert_exit(2, transform, ['usage-metrics', '--timezone', 'Mars/Olympus'])
+    assert 'Unknown timezone: Mars/Olympus' in result.output
+
+
+def test_transform_usage_metrics_blocks(mock_data):
+    with gzip.open('data/test.json.gz', 'ab') as fp:
+        fp.write(json.dumps({'id': 'é', 'metric': {'_deltaSeconds': 10}, 'timestamp': 1552208399}).encode())
+
+    expected = b''
+    for line in gzip.open('data/test.json.gz', 'rt'):
+        record = transform_usage_metrics_record(json.loads(line))
+        expected += (json.dumps(record) + '\n').encode()
+
+    for buffer_size in (1, 100, DEFAULT_BUFFER_SIZE):
+        transform_usage_metrics('data/test.json.gz', 'output.json.gz', json_codec='json', compress_level=1,
+                                buffer_size=buffer_size)
+        assert gzip.open('output.json.gz').read() == expected
+
+
+def test_iter_line_batches():
+    fp = io.BytesIO(b'a\nbb\n\nccc')
+
+    assert list(iter_line_batches(fp, 3)) == [[b'a'], [b'bb', b''], [b'ccc']]
+
+
+@pytest.mark.parametrize('select_fields,exclude_fields', [
+    (None, None),
+    ({'id', 'timestamp', 'metric', 'metric.a.b', 'metric._deltaSeconds', 'date_pt'}, None),
+    (None, {'metric.nested', 'id'}),
+])
+def test_transform_usage_metrics_columnar(select_fields, exclude_fields):
+    pytest.importorskip('numpy')
+
+    def records():
+        return [
+            {'id': 'a', '@timestamp': 'x', 'metric': {'_deltaSeconds': '50', 'a.b': 1}, 'timestamp': 1234567},
+            {'id': 'b', 'metric': {'a.b': 2, '_deltaSeconds': 10}, 'timestamp': 1552208399.7},
+            {'metric': {'_deltaSeconds': 95.5, 'nested': {'c-d': {}}, 'a_b': 3}, 'timestamp': -89, 'id': 'c'},
+            {'id': 'd', '@timestamp': 'x', 'metric': {'_deltaSeconds': '50', 'a.b': 1}, 'timestamp': 1234567},
+            {'id': 'e', 'metric': {'_deltaSeconds': 0}, 'timestamp': 1572771600, 'date_pt': 'old'},
+        ]
+
+    expected = [transform_usage_metrics_record(record, select_fields, exclude_fields) for record in records()]
+    actual = transform_usage_metrics_columnar(records(), select_fields, exclude_fields)
+
+    assert json.dumps(actual) == json.dumps(expected)
+
+    # Falls back to transforming one record at a time for values that can not be rounded exactly as floats
+    huge_records = [{'metric': {'_deltaSeconds': 2 ** 70 + 1}, 'timestamp': 1234567}]
+    assert transform_usage_metrics_columnar(huge_records) == [
+        transform_usage_metrics_record({'metric': {'_deltaSeconds': 2 ** 70 + 1}, 'timestamp': 1234567})]
+    assert transform_usage_metrics_columnar([]) == []
+
+
+def test_usage_metrics_columnar_engine(cli_runner, mock_data):
+    pytest.importorskip('numpy')
+
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--sink-dir', 'record-data'])
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--engine', 'columnar'])
+
+    assert gzip.open('transformed-data/test.json.gz').read() == gzip.open('record-data/test.json.gz').read()
+
+
+def test_usage_metrics_sink_format(cli_runner, mock_data):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--sink-format', 'parquet',
+                                                     '--sink-compression', 'zstd'])
+
+    assert 'test.parquet' in os.listdir('transformed-data')
+    records = pyarrow_parquet.read_table('transformed-data/test.parquet').to_pylist()
+    assert len(records) == 10
+    assert records[0]['metric']['pod_name'] == 'm'
+
+    result = cli_runner.invoke_and_assert_exit(2, transform, ['usage-metrics', '--sink-format', 'parquet',
+                                                              '--split-size', '100'])
+    assert 'Large files can not be split for the parquet sink format' in result.output
+
+    result = cli_runner.invoke_and_assert_exit(2, transform, ['usage-metrics', '--sink-format', 'avro',
+                                                              '--sink-compression', 'zstd'])
+    assert 'Compression zstd is not supported by the avro sink format' in result.output
+
+
+@pytest.mark.parametrize('engine', ['record', 'columnar'])
+def test_iter_transform(engine):
+    if engine == 'columnar':
+        pytest.importorskip('numpy')
+
+    def records():
+        for i in range(5):
+            yield {'id': i, '@timestamp': 'x', 'metric': {'_deltaSeconds': '50', 'a.b': i}, 'timestamp': 1234567 + i}
+
+    transformed = iter_transform(records(), exclude_fields={'id'}, engine=engine, batch_size=2)
+    assert next(transformed) == transform_usage_metrics_record(next(records()), exclude_fields={'id'})
+    assert list(transformed) == [transform_usage_metrics_record(record, exclude_fields={'id'})
+                                 for record in records()][1:]
+
+
+@pytest.mark.parametrize('processes', ['1', '2'])
+def test_usage_metrics_stdin_stdout(mock_data, processes):
+    transform_usage_metrics('data/test.json.gz', 'expected.json.gz', exclude_fields={'metric.another'})
+    expected = gzip.open('expected.json.gz').read()
+
+    cli_runner = CliRunner(mix_stderr=False)
+    with open('data/test.json.gz', 'rb') as fp:
+        gzipped_lines = fp.read()
+
+    for stdin in (gzipped_lines, gzip.decompress(gzipped_lines), gzipped_lines * 2):
+        result = cli_runner.invoke(transform, ['usage-metrics', '--stdin', '--stdout', '--processes', processes],
+                                   input=stdin)
+        assert result.exit_code == 0, result.stderr
+        assert gzip.decompress(result.stdout_bytes) == expected * (2 if stdin == gzipped_lines * 2 else 1)
+        assert 'records in' in result.stderr
+
+    assert not os.path.exists('transformed-data'), 'Nothing should be written to the sink dir'
+
+    result = cli_runner.invoke(transform, ['usage-metrics', '--stdin'])
+    assert result.exit_code == 2
+    assert '--stdin and --stdout must be used together' in result.stderr
+
+
+def test_usage_metrics_compaction(cli_runner, mock_data):
+    for day in range(1, 4):
+        with gzip.open(f'data/day{day}.json.gz', 'wt') as fp:
+            for i in range(20):
+                fp.write(json.dumps({'id': i, 'metric': {'_deltaSeconds': 60},
+                                     'timestamp': 1552208400 + day * 86400 + i}) + '\n')
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--compact-size', '1'])
+    assert 'Compacted 4 output file(s) into 4 shard(s) in "transformed-data-compacted"' in result.output
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--compact-size', '100000'])
+    assert 'Compacted 4 output file(s) into 1 shard(s) in "transformed-data-compacted"' in result.output
+    assert sorted(os.listdir('transformed-data-compacted')) == ['.compaction-index.json', 'part-00000.json.gz'], \
+        'Stale shards should be removed'
+
+    outputs = b''.join(gzip.open(os.path.join('transformed-data', name)).read()
+                       for name in sorted(os.listdir('transformed-data')) if not name.startswith('.'))
+    assert gzip.open('transformed-data-compacted/part-00000.json.gz').read() == outputs
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--compact-size', '100000',
+                                                              '--compact-dir', 'partitioned',
+                                                              '--partition-by', 'date_pt'])
+    assert 'Compacted 4 output file(s) into 4 shard(s) and 4 partition(s) in "partitioned"' in result.output
+    assert sorted(os.listdir('partitioned')) == ['.compaction-index.json', 'date_pt=1970-01-14', 'date_pt=2019-03-11',
+                                                 'date_pt=2019-03-12', 'date_pt=2019-03-13']
+    for partition in glob.glob('partitioned/date_pt=*'):
+        records = [json.loads(line) for line in gzip.open(f'{partition}/part-00000.json.gz')]
+        assert len(records) in (10, 20)
+        assert {record['date_pt'] for record in records} == {partition.split('=')[1]}
+
+    # Only partitions fed by changed output files are compacted again
+    partition_mtimes = {path: os.stat(path).st_mtime_ns for path in glob.glob('partitioned/*/*.json.gz')}
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--compact-size', '100000',
+                                                              '--compact-dir', 'partitioned',
+                                                              '--partition-by', 'date_pt'])
+    assert 'Transformed 0 data file(s)' in result.output
+    assert 'Shards in "partitioned" are up to date with 4 output file(s)' in result.output
+
+    with gzip.open('data/day3.json.gz', 'wt') as fp:
+        for i in range(5):
+            fp.write(json.dumps({'id': i, 'metric': {'_deltaSeconds': 60}, 'timestamp': 1552208400 + 4 * 86400}) + '\n')
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--compact-size', '100000',
+                                                              '--compact-dir', 'partitioned',
+                                                              '--partition-by', 'date_pt'])
+    assert 'Compacted 1 output file(s) into 1 shard(s) and 1 partition(s) in "partitioned"' in result.output
+    assert sorted(os.listdir('partitioned')) == ['.compaction-index.json', 'date_pt=1970-01-14', 'date_pt=2019-03-11',
+                                                 'date_pt=2019-03-12', 'date_pt=2019-03-14']
+    assert len([json.loads(line) for line in gzip.open('partitioned/date_pt=2019-03-14/part-00000.json.gz')]) == 5
+    for path in glob.glob('partitioned/date_pt=2019-03-1[12]/*.json.gz'):
+        assert os.stat(path).st_mtime_ns == partition_mtimes[path], 'Unchanged partitions should be kept'
+
+    result = cli_runner.invoke_and_assert_exit(2, transform, ['usage-metrics', '--partition-by', 'date_pt'])
+    assert '--partition-by requires --compact-size' in result.output
+
+    for compact_dir, name in (('transformed-data/shards', 'sink'), ('transformed-data', 'sink'), ('.', 'sink'),
+                              ('data', 'source'), ('data/shards', 'source')):
+        result = cli_runner.invoke_and_assert_exit(2, transform, ['usage-metrics', '--compact-size', '1',
+                                                                  '--compact-dir', compact_dir])
+        assert f'Compact dir can not be the {name} dir, contain it, or be inside it' in result.output
+
+
+def test_usage_metrics_compaction_failure(cli_runner, mock_data):
+    with gzip.open('data/day1.json.gz', 'wt') as fp:
+        fp.write(json.dumps({'id': 1, 'metric': {'_deltaSeconds': 60}, 'timestamp': 1552208400}) + '\n')
+
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--compact-size', '1'])
+    open('transformed-data-compacted/important.txt', 'w').close()
+    shards = sorted(os.listdir('transformed-data-compacted'))
+
+    with patch('confluent.data.shards.ShardWriter.write_file', side_effect=[None, OSError('Disk full')]):
+        result = cli_runner.invoke(transform, ['usage-metrics', '--compact-size', '100000'])
+    assert isinstance(result.exception, OSError)
+    assert sorted(os.listdir('transformed-data-compacted')) == shards, 'Previous shards should be kept as they were'
+
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--compact-size', '100000'])
+    assert sorted(os.listdir('transformed-data-compacted')) == ['.compaction-index.json', 'important.txt',
+                                                                'part-00000.json.gz']
+
+    for path in glob.glob('transformed-data/*.json.gz'):
+        os.unlink(path)
+    assert Transformer(transform_usage_metrics, 'data', 'transformed-data', compact_size=100000).compact() == []
+    assert sorted(os.listdir('transformed-data-compacted')) == ['.compaction-index.json', 'important.txt'], \
+        'Shards should be removed when there are no output files'
+
+
+def test_usage_metrics_route_by(cli_runner, mock_data):
+    for day in range(1, 3):
+        with gzip.open(f'data/day{day}.json.gz', 'wt') as fp:
+            for i in range(20):
+                fp.write(json.dumps({'id': i, 'metric': {'_deltaSeconds': 60},
+                                     'timestamp': 1552208400 + day * 86400 + i * 7200}) + '\n')
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--route-by', 'date_pt',
+                                                              '--max-open-files', '1'])
+    assert 'Transformed 3 data file(s)' in result.output
+
+    outputs = sorted(os.path.relpath(os.path.join(dirpath, name), 'transformed-data')
+                     for dirpath, _, names in os.walk('transformed-data') for name in names if name[0] != '.')
+    assert outputs == ['date_pt=1970-01-14/test.json.gz', 'date_pt=2019-03-11/day1.json.gz',
+                       'date_pt=2019-03-12/day1.json.gz', 'date_pt=2019-03-12/day2.json.gz',
+                       'date_pt=2019-03-13/day2.json.gz']
+
+    for output in outputs:
+        date_pt = output.split('/')[0].split('=')[1]
+        assert {json.loads(line)['date_pt'] for line in gzip.open(f'transformed-data/{output}')} == {date_pt}
+    assert sum(1 for output in outputs for _ in gzip.open(f'transformed-data/{output}')) == 50
+
+    cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--route-by', 'date_pt', '--no-manifest'])
+    with open('transformed-data/.transform-summary.json') as fp:
+        assert json.load(fp)['skipped_files'] == 3, 'Should skip as routed output files exist'
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--route-by', 'date_pt'])
+    assert 'Skipping 3 data file(s) that are unchanged since the last transform' in result.output
+
+    result = cli_runner.invoke_and_assert_exit(2, transform, ['usage-metrics', '--route-by', 'date_pt',
+                                                              '--split-size', '1'])
+    assert 'Records can only be routed for gzipped JSON lines output' in result.output
+
+
+def test_usage_metrics_schema(cli_runner, mock_data):
+    with gzip.open('data/collisions.json.gz', 'wt') as fp:
+        fp.write(json.dumps({'id': 1, 'metric': {'_deltaSeconds': 60, 'pod-name': 'a', 'pod/name': 'b'},
+                             'tags': ['x'], 'ratio': 1, 'timestamp': 1552208400}) + '\n')
+        fp.write(json.dumps({'id': 2, 'metric': {'_deltaSeconds': 60}, 'ratio': 0.5, 'timestamp': 1552208400}) + '\n')
+
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--schema', '--split-size', '200'])
+    assert 'Wrote BigQuery schema for 26 key(s) to "transformed-data/.transform-schema.json"' in result.output
+    assert ('Found 1 key(s) that multiple raw keys sanitize to, so their values overwrite each other:\n'
+            '  - metric.pod_name: metric.pod-name, metric.pod/name\n') in result.output
+
+    with open('transformed-data/.transform-schema.json') as fp:
+        schema = {field['name']: field for field in json.load(fp)}
+    assert sorted(schema) == ['_version', 'date_pt', 'datetime_pt', 'id', 'metric', 'ratio', 'source', 'tags',
+                              'timestamp', 'value']
+    assert schema['id'] == {'name': 'id', 'type': 'JSON', 'mode': 'NULLABLE'}, 'Strings and ints'
+    assert schema['ratio']['type'] == 'FLOAT'
+    assert schema['tags'] == {'name': 'tags', 'type': 'STRING', 'mode': 'REPEATED'}
+    assert schema['timestamp']['type'] == 'INTEGER'
+    assert {field['name']: field['type'] for field in schema['metric']['fields']}['_deltaSeconds'] == 'INTEGER'
+
+    # Keys of files that are not transformed again are preloaded from the cache
+    os.unlink('data/collisions.json.gz')
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--schema'])
+    assert 'Skipping 1 data file(s) that are unchanged since the last transform' in result.output
+    assert 'Wrote BigQuery schema for 26 key(s)' in result.output
+
+    # Keys are learned again when the settings change
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--schema', '--select-fields',
+                                                              'id,metric,metric.user,timestamp'])
+    assert 'Wrote BigQuery schema for 4 key(s)' in result.output
+    assert 'sanitize to' not in result.output
+
+    result = cli_runner.invoke_and_assert_exit(2, transform, ['usage-metrics', '--schema', '--stdin', '--stdout'])
+    assert '--schema can not be used with --stdout' in result.output
+
+
+@pytest.mark.parametrize('split_size', [None, '100'])
+def test_usage_metrics_record_guard(cli_runner, mock_data, split_size):
+    record = {'id': 'x', 'metric': {'_deltaSeconds': 60}, 'timestamp': 1552208400}
+    too_large = json.dumps(dict(record, value='x' * 2000))
+    too_deep = json.dumps(dict(record, value=json.loads('[' * 50 + ']' * 50)))
+    with gzip.open('data/pathological.json.gz', 'wt') as fp:
+        fp.write('\n'.join([json.dumps(record), too_large, too_deep, json.dumps(record)]) + '\n')
+
+    args = ['usage-metrics', '--max-record-size', '1000', '--max-depth', '20', '--max-memory', str(2 ** 40)]
+    if split_size:
+        args += ['--split-size', split_size]
+    result = cli_runner.invoke_and_assert_exit(0, transform, args)
+    assert ('Quarantined 2 record(s) (1 too deep, 1 too large) from 1 data file(s) '
+            'to "transformed-data-quarantine"') in result.output
+    assert 'Peak memory per process:' in result.output
+
+    assert len(gzip.open('transformed-data/pathological.json.gz').read().splitlines()) == 2
+    assert gzip.open('transformed-data-quarantine/pathological.json.gz').read() == (
+        too_large + '\n' + too_deep + '\n').encode()
+    assert not os.path.exists('transformed-data-quarantine/test.json.gz')
+
+    with open('transformed-data/.transform-summary.json') as fp:
+        summary = json.load(fp)
+    assert summary['quarantined'] == {'too_large': 1, 'too_deep': 1}
+    assert summary['quarantined_files'] == 1
+
+    # Files are transformed again when the limits change, and a process that exceeds the memory cap fails the file
+    result = cli_runner.invoke_and_assert_exit(0, transform, ['usage-metrics', '--max-depth', '100',
+                                                              '--max-memory', '1'])
+    assert 'Re-transforming 2 data file(s) with stale output as the settings have changed' in result.output
+    assert 'Failed to transform 2 data file(s):' in result.output
+    assert 'exceeded the cap of 0.0 MB' in result.output
+    assert not os.path.exists('transformed-data-quarantine/pathological.json.gz')
@@ -0,0 +1,59 @@
+from confluent.data.views import ViewGraph, rewrite_table_references, table_references
+
+
+def test_table_references():
+    assert table_references("""
+        SELECT a.*, 'FROM dataset.not_a_table' AS note  -- JOIN dataset.commented_out
+        FROM `project-2.dataset.table1` a
+        JOIN `dataset`.`table2` USING (id)
+        JOIN dataset.table3 USING (id)
+        /* FROM dataset.commented_out */
+        LEFT JOIN [example.com:project-3:dataset.table4] USING (id)
+    """, default_project='project-1') == {
+        ('project-2', 'dataset', 'table1'),
+        ('project-1', 'dataset', 'table2'),
+        ('project-1', 'dataset', 'table3'),
+        ('example.com:project-3', 'dataset', 'table4'),
+    }
+
+
+def test_rewrite_table_references():
+    assert rewrite_table_references("""
+        SELECT a.*, 'FROM `project-1.sales.t`' AS note  -- JOIN sales.commented_out
+        FROM `project-1.sales.table1` a
+        JOIN `project-1.sales_eu.table1` USING (id)
+        JOIN `sales`.`table2` USING (id)
+        JOIN sales.table3 USING (id)
+        JOIN project-1.sales.table4 USING (id)
+        LEFT JOIN [ project-1:sales.table5] USING (id)
+        LEFT JOIN [project-1:sales_eu.table5] USING (id)
+    """, default_project='project-1', datasets={('project-1', 'sales'): ('project-2', 'sales_copy')},
+                                    target_project='project-2') == """
+        SELECT a.*, 'FROM `project-1.sales.t`' AS note  -- JOIN sales.commented_out
+        FROM `project-2.sales_copy.table1` a
+        JOIN `project-1.sales_eu.table1` USING (id)
+        JOIN `sales_copy.table2` USING (id)
+        JOIN sales_copy.table3 USING (id)
+        JOIN project-2.sales_copy.table4 USING (id)
+        LEFT JOIN [ project-2:sales_copy.table5] USING (id)
+        LEFT JOIN [project-1:sales_eu.table5] USING (id)
+    """
+
+
+def test_view_graph():
+    graph = ViewGraph()
+    graph.add(('p', 'd', 'view_c'), 'SELECT * FROM d.view_b JOIN d.view_a USING (id)')
+    graph.add(('p', 'd', 'view_b'), 'SELECT * FROM `p.d.view_a`')
+    graph.add(('p', 'd', 'view_a'), 'SELECT * FROM d.table')
+    graph.add(('p', 'd', 'view_a2'), 'SELECT * FROM d.table_2')
+    graph.add(('p', 'd', 'view_x'), 'SELECT * FROM d.view_y')
+    graph.add(('p', 'd', 'view_y'), 'SELECT * FROM d.view_x')
+
+    assert graph.levels() == [
+        [('p', 'd', 'view_a'), ('p', 'd', 'view_a2')],
+        [('p', 'd', 'view_b')],
+        [('p', 'd', 'view_c')],
+        [('p', 'd', 'view_x'), ('p', 'd', 'view_y')],
+    ]
+    assert graph.skipped({('p', 'd', 'table')}) == {('p', 'd', 'view_a'), ('p', 'd', 'view_b'), ('p', 'd', 'view_c')}
+    assert graph.skipped({('p', 'd', 'tab')}) == set()